@@ -4,11 +4,16 @@ from google.oauth2 import service_account
 from ee import oauth
 import geemap.foliumap as geemap 
 from streamlit import errors # import errors library
+from apps import ee_client
 
 def ee_to_st():
     """
     Authenticate Earth Engine using a service account on Streamlit Cloud.
     """
+    # Recorded sessions are replayed without credentials (EE_CASSETTE_MODE)
+    if ee_client.cassette_mode == "replay":
+        return ee_client.initialize_replay()
+
     try:
         service_account_keys = st.secrets["ee_keys"]
         credentials = service_account.Credentials.from_service_account_info(
@@ -17,6 +22,9 @@ def ee_to_st():
         ee.Initialize(credentials)
         geemap.ee_initialize()
 
-        return "Successfully authenticated with Google Earth Engine"
+        authentication_status = "Successfully authenticated with Google Earth Engine"
     except errors.StreamlitSecretNotFoundError:
-        return geemap.ee_initialize()
+        authentication_status = geemap.ee_initialize()
+
+    ee_client.start_recording()
+    return authentication_status
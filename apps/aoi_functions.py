@@ -0,0 +1,81 @@
+import hashlib
+import streamlit as st
+import geopandas as gpd
+import shapely
+import geemap
+
+# Simplification tolerance (metres) for each analysis scale. Vertices closer
+# together than a pixel of the dataset being clipped/reduced add payload to
+# every Earth Engine request without changing the result.
+analysis_scales = {
+    "Sentinel-2": 10,
+    "iSDA Soil": 250,
+    "CHIRPS": 5000,
+}
+
+def get_gdf_key(gdf):
+    """Stable digest of a GeoDataFrame's geometry and CRS, used as a cache key."""
+    digest = hashlib.sha1(str(gdf.crs).encode())
+    for wkb in gdf.geometry.to_wkb():
+        digest.update(wkb if wkb is not None else b"")
+    return digest.hexdigest()
+
+gdf_hash_funcs = {gpd.GeoDataFrame: get_gdf_key}
+
+def count_vertices(gdf):
+    return int(shapely.get_num_coordinates(gdf.geometry.values).sum())
+
+def get_payload_bytes(gdf):
+    return len(gdf.to_json().encode())
+
+@st.cache_data(hash_funcs=gdf_hash_funcs, persist="disk", show_spinner=False)
+def get_simplified_aoi_gdf(aoi_gdf, analysis_scale):
+    """Topology-preserving simplification of an AOI at the tolerance for the analysis scale."""
+    tolerance = analysis_scales[analysis_scale]
+
+    # Simplify in metres rather than degrees
+    metric_crs = aoi_gdf.estimate_utm_crs()
+    simplified_gdf = aoi_gdf.to_crs(metric_crs)
+    simplified_gdf["geometry"] = simplified_gdf.geometry.simplify(tolerance, preserve_topology=True)
+    simplified_gdf = simplified_gdf.to_crs(aoi_gdf.crs)
+
+    # Keep the original geometry where simplification collapsed a small polygon
+    collapsed = simplified_gdf.geometry.is_empty
+    simplified_gdf.loc[collapsed, "geometry"] = aoi_gdf.geometry[collapsed]
+
+    return simplified_gdf
+
+def get_aoi_report(aoi_gdf, analysis_scale):
+    """Vertex and GeoJSON payload reduction achieved by simplifying an AOI."""
+    simplified_gdf = get_simplified_aoi_gdf(aoi_gdf, analysis_scale)
+
+    original_vertices = count_vertices(aoi_gdf)
+    simplified_vertices = count_vertices(simplified_gdf)
+    original_bytes = get_payload_bytes(aoi_gdf)
+    simplified_bytes = get_payload_bytes(simplified_gdf)
+
+    report = {
+        "analysis_scale": analysis_scale,
+        "tolerance_m": analysis_scales[analysis_scale],
+        "original_vertices": original_vertices,
+        "simplified_vertices": simplified_vertices,
+        "vertex_reduction": round(1 - simplified_vertices / max(original_vertices, 1), 4),
+        "original_bytes": original_bytes,
+        "simplified_bytes": simplified_bytes,
+        "payload_reduction": round(1 - simplified_bytes / max(original_bytes, 1), 4),
+    }
+    return report
+
+@st.cache_resource(hash_funcs=gdf_hash_funcs, show_spinner=False)
+def get_aoi_ee(aoi_gdf, analysis_scale):
+    """Earth Engine FeatureCollection of the simplified AOI, built once per AOI and scale."""
+    simplified_gdf = get_simplified_aoi_gdf(aoi_gdf, analysis_scale)
+
+    report = get_aoi_report(aoi_gdf, analysis_scale)
+    print(
+        f"AOI simplified for {analysis_scale}: "
+        f"{report['original_vertices']} -> {report['simplified_vertices']} vertices, "
+        f"{report['original_bytes']} -> {report['simplified_bytes']} bytes"
+    )
+
+    return geemap.gdf_to_ee(simplified_gdf)
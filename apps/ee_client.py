@@ -0,0 +1,298 @@
+import atexit
+import base64
+import collections
+import copy
+import io
+import json
+import os
+import sys
+import threading
+import time
+import ee
+import numpy as np
+import pandas as pd
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from apps import trace_functions
+
+# Every Earth Engine round trip of the app goes through this module so calls
+# can be attributed to the function making them. Results are cached by the
+# callers' st.cache_data/st.cache_resource functions, whose hits never reach
+# Earth Engine; a call made to fill one of them is recorded as a cache miss.
+ee_process_records_size = 100000
+ee_summary_dir = os.path.join("data", "cache", "traces")
+
+ee_process_records = collections.deque(maxlen=ee_process_records_size)
+ee_lock = threading.Lock()
+
+# Responses can be recorded to a cassette during a real session and replayed
+# offline, so timings of our own code do not vary with Earth Engine latency:
+#   EE_CASSETTE_MODE=record streamlit run streamlit_app.py
+#   EE_CASSETTE_MODE=replay streamlit run streamlit_app.py
+# Requests are matched on their serialized expression and parameters; a
+# replay answers at once unless EE_CASSETTE_TIMINGS=1 (recorded latencies).
+cassette_path = os.environ.get("EE_CASSETTE", os.path.join("data", "cache", "cassettes", "ee_cassette.jsonl"))
+cassette_mode = os.environ.get("EE_CASSETTE_MODE", "")
+cassette_timings = os.environ.get("EE_CASSETTE_TIMINGS", "0") == "1"
+
+cassette = None
+cassette_lock = threading.Lock()
+cassette_started = False
+
+def get_caller(depth=2):
+    """Module and function name of the code calling into the client."""
+    frame = sys._getframe(depth)
+    module_name = frame.f_globals.get('__name__', '').split('.')[-1]
+    return f"{module_name}.{frame.f_code.co_name}"
+
+def get_response_size(response):
+    if isinstance(response, np.ndarray):
+        return int(response.nbytes)
+    return len(json.dumps(response, default=str))
+
+def get_session_records():
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    if 'ee_call_records' not in st.session_state:
+        st.session_state['ee_call_records'] = []
+    return st.session_state['ee_call_records']
+
+def record_call(kind, caller, latency_ms, response_size, cache_status):
+    rerun_trace = trace_functions.get_rerun_trace()
+    call_record = {
+        'kind': kind,
+        'caller': caller,
+        'latency_ms': round(latency_ms, 2),
+        'bytes': response_size,
+        'cache': cache_status,
+        'rerun_id': rerun_trace['rerun_id'] if rerun_trace else None,
+        'page': rerun_trace['page'] if rerun_trace else None,
+        'time': round(time.time(), 3),
+    }
+    with ee_lock:
+        ee_process_records.append(call_record)
+
+    session_records = get_session_records()
+    if session_records is not None:
+        session_records.append(call_record)
+
+def get_cache_status():
+    """"miss" when the call fills a Streamlit cache, "uncached" otherwise."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_code.co_name == "_handle_cache_miss" and frame.f_globals.get('__name__', '').startswith("streamlit"):
+            return "miss"
+        frame = frame.f_back
+    return "uncached"
+
+def get_request_key(ee_object, params=None):
+    """Cassette key of a request: its serialized expression and parameters."""
+    def serialize_param(value):
+        return value.serialize() if hasattr(value, "serialize") else str(value)
+    return json.dumps([ee_object.serialize(), params], sort_keys=True, default=serialize_param)
+
+def encode_response(kind, response):
+    """JSON form of a response for the cassette."""
+    if kind == "getMapId":
+        return {'mapid': response['mapid'], 'token': response['token'], 'url_format': response['tile_fetcher'].url_format}
+    if kind == "computePixels":
+        npy_buffer = io.BytesIO()
+        np.save(npy_buffer, response, allow_pickle=False)
+        return {'npy': base64.b64encode(npy_buffer.getvalue()).decode()}
+    return response
+
+def decode_response(kind, recorded_response):
+    if kind == "getMapId":
+        return {
+            'mapid': recorded_response['mapid'],
+            'token': recorded_response['token'],
+            'tile_fetcher': ee.data.TileFetcher(recorded_response['url_format'], map_name=recorded_response['mapid']),
+        }
+    if kind == "computePixels":
+        return np.load(io.BytesIO(base64.b64decode(recorded_response['npy'])), allow_pickle=False)
+    return copy.deepcopy(recorded_response)
+
+def write_cassette_entry(cassette_entry):
+    with cassette_lock:
+        os.makedirs(os.path.dirname(os.path.abspath(cassette_path)), exist_ok=True)
+        with open(cassette_path, "a") as cassette_file:
+            cassette_file.write(json.dumps(cassette_entry) + "\n")
+
+def load_cassette():
+    """Recorded responses by (kind, request key), read once per process."""
+    global cassette
+    with cassette_lock:
+        if cassette is None:
+            loaded_cassette = {'algorithms': None, 'responses': collections.defaultdict(list), 'replayed': collections.Counter()}
+            with open(cassette_path) as cassette_file:
+                for line in cassette_file:
+                    cassette_entry = json.loads(line)
+                    if cassette_entry['kind'] == "algorithms":
+                        loaded_cassette['algorithms'] = cassette_entry['response']
+                    else:
+                        loaded_cassette['responses'][(cassette_entry['kind'], cassette_entry['key'])].append(cassette_entry)
+            cassette = loaded_cassette
+        return cassette
+
+def replay_request(kind, request_key):
+    """Recorded response of a request; repeated requests get their responses in recorded order."""
+    loaded_cassette = load_cassette()
+    with cassette_lock:
+        recorded_entries = loaded_cassette['responses'].get((kind, request_key))
+        if not recorded_entries:
+            raise ee.EEException(f"No recorded {kind} response for this request in {cassette_path}")
+        replay_index = min(loaded_cassette['replayed'][(kind, request_key)], len(recorded_entries) - 1)
+        loaded_cassette['replayed'][(kind, request_key)] += 1
+        cassette_entry = recorded_entries[replay_index]
+
+    if cassette_timings:
+        time.sleep(cassette_entry['latency_ms'] / 1000)
+    return decode_response(kind, cassette_entry['response'])
+
+def start_recording():
+    """Save the algorithm signatures a replay builds expressions from, once per process."""
+    global cassette_started
+    with cassette_lock:
+        if cassette_mode != "record" or cassette_started:
+            return
+        cassette_started = True
+    write_cassette_entry({'kind': "algorithms", 'key': None, 'response': ee.data.getAlgorithms(), 'latency_ms': 0})
+
+def initialize_replay():
+    """Initialise Earth Engine from the cassette, without credentials or network access."""
+    global cassette_started
+    algorithms = load_cassette()['algorithms']
+    with cassette_lock:
+        if not cassette_started:
+            # Expressions are built from the recorded signatures; nothing is
+            # requested from the server, so the data module needs no session
+            ee.data.getAlgorithms = lambda: algorithms
+            ee.data.initialize = lambda **kwargs: None
+            ee.Initialize(credentials=None, project="ee-cassette-replay")
+            cassette_started = True
+    return "Replaying recorded Earth Engine responses"
+
+def call_ee(kind, request, caller, request_key=None):
+    """Run one Earth Engine request, recording its latency, size and cache status.
+
+    `request_key` identifies the request in a cassette (see get_request_key).
+    """
+    with trace_functions.span(f"ee.{kind}") as current_span:
+        start_counter = time.perf_counter()
+        if cassette_mode == "replay":
+            response = replay_request(kind, request_key)
+        else:
+            response = request()
+        latency_ms = (time.perf_counter() - start_counter) * 1000
+
+        if cassette_mode == "record":
+            write_cassette_entry({
+                'kind': kind, 'key': request_key, 'response': encode_response(kind, response),
+                'latency_ms': round(latency_ms, 2),
+            })
+
+        response_size = get_response_size(response)
+        current_span['bytes'] = response_size
+        record_call(kind, caller, latency_ms, response_size, get_cache_status())
+
+    return response
+
+def get_info(ee_object, kind="getInfo"):
+    """ee_object.getInfo(); use kind="reduce" for reductions so they are reported apart."""
+    return call_ee(kind, ee_object.getInfo, get_caller(), request_key=ee_object.serialize())
+
+def get_map_id(ee_image, visparams):
+    # Replayed map ids are those of the recording and stop serving tiles when they expire
+    return call_ee(
+        "getMapId", lambda: ee_image.getMapId(visparams), get_caller(),
+        request_key=get_request_key(ee_image, visparams)
+        )
+
+def compute_pixels(request):
+    params = {name: value for name, value in request.items() if name != 'expression'}
+    return call_ee(
+        "computePixels", lambda: ee.data.computePixels(request), get_caller(),
+        request_key=get_request_key(request['expression'], params)
+        )
+
+def get_download_url(ee_image, params):
+    return call_ee(
+        "getDownloadURL", lambda: ee_image.getDownloadURL(params), get_caller(),
+        request_key=get_request_key(ee_image, params)
+        )
+
+def get_call_stats(call_records):
+    """Calls, p50/p95 latency, bytes and share of cache misses per call kind and caller."""
+    columns = ['kind', 'caller', 'calls', 'p50_ms', 'p95_ms', 'bytes', 'miss_rate']
+    if not call_records:
+        return pd.DataFrame(columns=columns)
+
+    calls_df = pd.DataFrame(call_records)
+    calls_df['miss'] = calls_df['cache'] == "miss"
+    call_stats = calls_df.groupby(['kind', 'caller']).agg(
+        calls=('latency_ms', 'size'),
+        p50_ms=('latency_ms', lambda latency: latency.quantile(0.5)),
+        p95_ms=('latency_ms', lambda latency: latency.quantile(0.95)),
+        bytes=('bytes', 'sum'),
+        miss_rate=('miss', 'mean'),
+    ).reset_index().sort_values('calls', ascending=False)
+
+    return call_stats[columns].round(2)
+
+def get_call_summary(call_records):
+    """Totals across all calls, including the calls per page view (rerun)."""
+    if not call_records:
+        return {
+            'calls': 0, 'cache_misses': 0, 'page_views': 0, 'calls_per_page_view': None,
+            'p50_ms': None, 'p95_ms': None, 'bytes': 0,
+        }
+
+    calls_df = pd.DataFrame(call_records)
+    latency = calls_df['latency_ms']
+    page_views = calls_df['rerun_id'].dropna().nunique()
+
+    call_summary = {
+        'calls': len(calls_df),
+        'cache_misses': int((calls_df['cache'] == "miss").sum()),
+        'page_views': page_views,
+        'calls_per_page_view': round(len(calls_df) / page_views, 2) if page_views else None,
+        'p50_ms': round(float(latency.quantile(0.5)), 2) if len(latency) else None,
+        'p95_ms': round(float(latency.quantile(0.95)), 2) if len(latency) else None,
+        'bytes': int(calls_df['bytes'].sum()),
+    }
+    return call_summary
+
+def get_process_records():
+    with ee_lock:
+        return list(ee_process_records)
+
+def show_ee_panel():
+    """Optional sidebar summary of the Earth Engine calls of this session and process."""
+    with st.sidebar:
+        if not st.checkbox("Show Earth Engine calls", value=False, key="show_ee_panel"):
+            return
+
+        session_records = get_session_records() or []
+        st.caption("This session")
+        st.json(get_call_summary(session_records), expanded=False)
+        st.dataframe(get_call_stats(session_records), hide_index=True)
+
+        st.caption("All sessions of this process")
+        st.json(get_call_summary(get_process_records()), expanded=False)
+
+def write_process_summary():
+    """Write the process's call statistics when the server shuts down."""
+    process_records = get_process_records()
+    if not process_records:
+        return
+
+    os.makedirs(ee_summary_dir, exist_ok=True)
+    summary_path = os.path.join(ee_summary_dir, f"ee_summary_{os.getpid()}_{int(time.time())}.json")
+    process_summary = {
+        'summary': get_call_summary(process_records),
+        'by_caller': get_call_stats(process_records).to_dict(orient='records'),
+    }
+    with open(summary_path, "w") as summary_file:
+        json.dump(process_summary, summary_file, indent=2, default=str)
+
+atexit.register(write_process_summary)
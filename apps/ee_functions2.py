@@ -6,7 +6,9 @@ import ee
 import pandas as pd
 import folium
 import altair as alt
+from apps import aoi_functions, map_functions, task_functions, trace_functions, ee_client
 
+@trace_functions.traced
 def get_buffered_farm_gdf(selected_farm_gdf):
     proj_selected_farm_gdf = selected_farm_gdf.to_crs(epsg=3857)
     proj_selected_farm_gdf["geometry"] = proj_selected_farm_gdf.geometry.buffer(50)
@@ -14,10 +16,11 @@ def get_buffered_farm_gdf(selected_farm_gdf):
 
     return buffered_selected_farm_gdf
 
+@trace_functions.traced
 def get_available_images(selected_farm_gdf, selected_start_date, selected_end_date, max_cloud_cover):
     buffered_selected_farm_gdf = get_buffered_farm_gdf(selected_farm_gdf)
 
-    buffered_selected_farm_ee = geemap.gdf_to_ee(buffered_selected_farm_gdf)
+    buffered_selected_farm_ee = aoi_functions.get_aoi_ee(buffered_selected_farm_gdf, "Sentinel-2")
 
     available_images =  ee.ImageCollection("COPERNICUS/S2_SR_HARMONIZED") \
         .filterBounds(buffered_selected_farm_ee) \
@@ -27,10 +30,11 @@ def get_available_images(selected_farm_gdf, selected_start_date, selected_end_da
 
     return available_images
 
+@trace_functions.traced
 def get_available_image(selected_farm_gdf, selected_start_date, selected_end_date, max_cloud_cover):
     buffered_selected_farm_gdf = get_buffered_farm_gdf(selected_farm_gdf)
 
-    buffered_selected_farm_ee = geemap.gdf_to_ee(buffered_selected_farm_gdf)
+    buffered_selected_farm_ee = aoi_functions.get_aoi_ee(buffered_selected_farm_gdf, "Sentinel-2")
 
     available_images = get_available_images(
         selected_farm_gdf, selected_start_date, selected_end_date, max_cloud_cover
@@ -80,6 +84,7 @@ def get_vis_params(selected_index):
 
         return indices_vis
 
+@trace_functions.traced
 def calculate_index(selected_index, true_color_image):
     """
     Calculate a vegetation/moisture index from an EE image.
@@ -102,8 +107,9 @@ def calculate_index(selected_index, true_color_image):
     #     return true_color_image.normalizedDifference(["B8", "B12"])
 
 # Group selected index pixel values
+@trace_functions.traced
 def classifiy_index_values(selected_farm_gdf, calculated_index, selected_index):
-    aoi = geemap.gdf_to_ee(selected_farm_gdf)
+    aoi = aoi_functions.get_aoi_ee(selected_farm_gdf, "Sentinel-2")
     intervals = index_intervals(selected_index)
 
     # Start with a blank image (type byte for classification)
@@ -139,6 +145,7 @@ def legend_params(selected_index):
 
     return reversed_labels, reversed_colors
 
+@trace_functions.traced
 def get_imagery_date(true_color_image):
     """
     Return a human-friendly capture date for an EE Image.
@@ -155,14 +162,16 @@ def get_imagery_date(true_color_image):
                 ee.Date(true_color_image.get("system:time_start")).format("dd MMMM YYYY"),
                 "Imagery date unavailable",
             )
-        ).getInfo()
+        )
+        date_str = ee_client.get_info(date_str)
         return date_str
     except Exception:
         return "Imagery date unavailable"
 
 # Calculate area of pixels per index category
-def index_class_pixels_area(farm_gdf, classified_index, selected_index):
-    aoi = geemap.gdf_to_ee(farm_gdf)
+@trace_functions.traced
+def index_class_pixels_area(farm_gdf, classified_index, selected_index, cancel_event=None):
+    aoi = aoi_functions.get_aoi_ee(farm_gdf, "Sentinel-2")
     intervals = index_intervals(selected_index)
 
     indices_area_ha = {}
@@ -173,6 +182,9 @@ def index_class_pixels_area(farm_gdf, classified_index, selected_index):
 
     # Iterate through index intervals
     for _, _, index_value_class, color, class_id in intervals:
+        # Stop between requests if the selection changed while running in the background
+        task_functions.check_cancelled(cancel_event)
+
         # Create mask for range
         mask = classified_index.gte(class_id).And(classified_index.lt(class_id + 1))
 
@@ -188,7 +200,7 @@ def index_class_pixels_area(farm_gdf, classified_index, selected_index):
         # Extract the area using the band name
         value = total_area_m2.get(band_name)
         if value:
-            total_area_ha = ee.Number(value).divide(10000).getInfo()
+            total_area_ha = ee_client.get_info(ee.Number(value).divide(10000), kind="reduce")
         else:
             total_area_ha = 0
 
@@ -198,9 +210,10 @@ def index_class_pixels_area(farm_gdf, classified_index, selected_index):
 
     return indices_area_ha, bar_colors
 
-def area_chart_df(selected_farm_gdf, classified_index, selected_index):
+@trace_functions.traced
+def area_chart_df(selected_farm_gdf, classified_index, selected_index, cancel_event=None):
     pixel_class_area, colors = index_class_pixels_area(
-        selected_farm_gdf, classified_index, selected_index
+        selected_farm_gdf, classified_index, selected_index, cancel_event
     )
 
     # Build a DataFrame
@@ -244,6 +257,7 @@ def altair_chart(figure_df, selected_index):
 
     return chart
 
+@trace_functions.traced
 def add_ee_layer(self, ee_object, visparams=None, name="Layer", shown=True, opacity=1.0):
     """
     Lightweight version of geemap's add_ee_layer for Folium maps.
@@ -258,7 +272,7 @@ def add_ee_layer(self, ee_object, visparams=None, name="Layer", shown=True, opac
     try:
         # Vector data as GeoJSON
         if isinstance(ee_object, (ee.Geometry, ee.Feature, ee.FeatureCollection)):
-            folium.GeoJson(data=ee_object.getInfo(), name=name).add_to(self)
+            folium.GeoJson(data=ee_client.get_info(ee_object), name=name).add_to(self)
             return
 
         # Everything else is treated as raster imagery.
@@ -269,7 +283,7 @@ def add_ee_layer(self, ee_object, visparams=None, name="Layer", shown=True, opac
             # This will also handle plain Images and many computed objects.
             img = ee.Image(ee_object)
 
-        map_id_dict = img.getMapId(visparams)
+        map_id_dict = ee_client.get_map_id(img, visparams)
         folium.raster_layers.TileLayer(
             tiles=map_id_dict["tile_fetcher"].url_format,
             attr="Google Earth Engine",
@@ -325,14 +339,16 @@ def add_crop_monitor_image_date_selectors(available_image_dates):
                     )
             return image1, image2, image3, image4
 
+@trace_functions.traced
 def available_imagery_dates_list(image_collection):
     # Create empty list for available images
     available_images_list = []
 
     # Loop to loop through available images and add info to list
-    for i in range(len(image_collection.getInfo()['features'])):
+    image_features = ee_client.get_info(image_collection)['features']
+    for i in range(len(image_features)):
         # Get date imagery was captured
-        start_date = image_collection.getInfo()['features'][i]['properties']['system:time_start']
+        start_date = image_features[i]['properties']['system:time_start']
 
         # Change format for the date the image was captured
         dates = datetime.utcfromtimestamp(start_date/1000).strftime("%d %B %Y")
@@ -359,10 +375,11 @@ def selected_date_range(selected_date):
 
     return start_date, end_date
 
+@trace_functions.traced
 def get_images_list(selected_image_dates_list, image_collection, selected_farm_gdf):
     buffered_selected_farm_gdf = get_buffered_farm_gdf(selected_farm_gdf)
 
-    buffered_selected_farm_ee = geemap.gdf_to_ee(buffered_selected_farm_gdf)
+    buffered_selected_farm_ee = aoi_functions.get_aoi_ee(buffered_selected_farm_gdf, "Sentinel-2")
 
     images_list = []
 
@@ -377,6 +394,7 @@ def get_images_list(selected_image_dates_list, image_collection, selected_farm_g
 
     return images_list
 
+@trace_functions.traced
 def get_index_images_list(images_list, selected_index, selected_farm_gdf):
     index_images_list = []
 
@@ -388,6 +406,7 @@ def get_index_images_list(images_list, selected_index, selected_farm_gdf):
 
     return index_images_list
 
+@trace_functions.traced
 def add_specific_map(selected_farm_gdf, selected_date, ee_image, index_image, selected_index, true_color_visparams, index_visparams):
     m = geemap.Map()
     m.add_ee_layer = add_ee_layer.__get__(m)
@@ -410,8 +429,9 @@ def add_specific_map(selected_farm_gdf, selected_date, ee_image, index_image, se
                     position="topright",
                     fontsize= 12, bold=True)
     m.add_gdf(selected_farm_gdf, layer_name="Farm")
-    m.to_streamlit(height=300)
+    map_functions.show_map(m, "ee_functions2", height=300)
 
+@trace_functions.traced
 def add_all_maps(images_list, index_image_list, selected_index, image_dates, selected_farm_gdf):
     true_color_visparams = get_vis_params("True Color")
 
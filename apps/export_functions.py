@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import time
+import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import streamlit as st
+from apps import aoi_functions, task_functions, trace_functions, variables
+
+# Tables behind the charts are exported by writing them chunk by chunk to
+# files under data/cache/exports, so the table is never held in memory whole
+# while it is read. The finished file is handed to a download button, which
+# only the session that exported it can use (exports hold farmer names).
+# Exports with the same contents are written once and reused until they are
+# older than EXPORT_MAX_AGE_HOURS.
+export_dir = os.path.join(variables.cache_dir, "exports")
+export_chunk_rows = int(os.environ.get("EXPORT_CHUNK_ROWS", 50000))
+export_max_age_hours = float(os.environ.get("EXPORT_MAX_AGE_HOURS", 24))
+
+# Exports are written by the background workers (see task_functions). Class
+# areas take a few Earth Engine requests per farm or catchment, so at most
+# EXPORT_MAX_ZONES of them are exported at once.
+export_max_zones = int(os.environ.get("EXPORT_MAX_ZONES", 25))
+
+# Export formats and their file extensions and MIME types; tables without
+# geometry are written as plain Parquet
+export_formats = {"CSV": "csv", "GeoParquet": "parquet"}
+export_mime_types = {"CSV": "text/csv", "GeoParquet": "application/vnd.apache.parquet"}
+
+def get_export_path(file_stem, export_key, export_format):
+    """Path of an export, named by a digest of everything its contents depend on."""
+    export_digest = hashlib.sha1(json.dumps(export_key, sort_keys=True, default=str).encode()).hexdigest()[:12]
+    return os.path.join(export_dir, f"{file_stem}_{export_digest}.{export_formats[export_format]}")
+
+def get_row_chunks(chunks, chunk_rows, cancel_event=None):
+    """Chunks of about `chunk_rows` rows from chunks of any size, e.g. one row per farm."""
+    pending = []
+    pending_rows = 0
+    for chunk in chunks:
+        task_functions.check_cancelled(cancel_event)
+        pending.append(chunk)
+        pending_rows += len(chunk)
+        if pending_rows >= chunk_rows:
+            yield pd.concat(pending, ignore_index=True)
+            pending = []
+            pending_rows = 0
+    if pending:
+        yield pd.concat(pending, ignore_index=True)
+
+def write_csv_chunks(chunks, export_file):
+    """Write DataFrame chunks as one CSV table; geometries are written as WKT."""
+    header = True
+    for chunk in chunks:
+        chunk.to_csv(export_file, header=header, index=False)
+        header = False
+
+def get_geo_metadata(gdf):
+    """GeoParquet metadata of a table with a WKB geometry column, as geopandas writes it."""
+    geometry_column = {'encoding': "WKB", 'geometry_types': []}
+    if gdf.crs is not None:
+        geometry_column['crs'] = gdf.crs.to_json_dict()
+    return {'version': "1.0.0", 'primary_column': gdf.geometry.name, 'columns': {gdf.geometry.name: geometry_column}}
+
+def to_arrow_table(chunk):
+    if isinstance(chunk, gpd.GeoDataFrame):
+        return pa.table(chunk.to_arrow(geometry_encoding="WKB", index=False))
+    return pa.Table.from_pandas(chunk, preserve_index=False)
+
+def write_parquet_chunks(chunks, export_file):
+    """Write DataFrame chunks as one (Geo)Parquet table, a row group per chunk."""
+    writer = None
+    try:
+        for chunk in chunks:
+            table = to_arrow_table(chunk)
+            if writer is None:
+                schema = table.schema
+                if isinstance(chunk, gpd.GeoDataFrame):
+                    schema = schema.with_metadata({**(schema.metadata or {}), b"geo": json.dumps(get_geo_metadata(chunk))})
+                writer = pq.ParquetWriter(export_file, schema)
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+def remove_old_exports():
+    """Remove exports older than the maximum age."""
+    if not os.path.isdir(export_dir):
+        return
+    oldest_time = time.time() - export_max_age_hours * 3600
+    for file_name in os.listdir(export_dir):
+        export_path = os.path.join(export_dir, file_name)
+        try:
+            if os.path.getmtime(export_path) < oldest_time:
+                os.remove(export_path)
+        except OSError:
+            # Removed by another process in between
+            pass
+
+@trace_functions.traced
+def export_table(file_stem, export_key, get_chunks, export_format, cancel_event=None):
+    """Path of an export of the DataFrame chunks `get_chunks()` yields, written unless it exists.
+
+    Chunks are regrouped into chunks of about `export_chunk_rows` rows as they
+    arrive; a cancelled or failed export leaves no file behind.
+    """
+    remove_old_exports()
+    export_path = get_export_path(file_stem, export_key, export_format)
+    if os.path.exists(export_path):
+        return export_path
+
+    os.makedirs(export_dir, exist_ok=True)
+    chunks = get_row_chunks(get_chunks(), export_chunk_rows, cancel_event)
+    with variables.temp_write_path(export_path) as temp_path:
+        if export_format == "CSV":
+            with open(temp_path, "w", encoding="utf-8", newline="") as export_file:
+                write_csv_chunks(chunks, export_file)
+        else:
+            write_parquet_chunks(chunks, temp_path)
+    return export_path
+
+def show_export_download(export_path, file_stem, export_format, key):
+    """Button downloading an export, named after its table."""
+    size_kb = os.path.getsize(export_path) / 1024
+    with open(export_path, "rb") as export_file:
+        st.download_button(
+            f"Download ({size_kb:,.0f} KB)", export_file,
+            file_name=f"{file_stem}.{export_formats[export_format]}", mime=export_mime_types[export_format],
+            on_click="ignore", key=f"{key}_download",
+        )
+
+def add_export_controls(file_stem, export_key, get_chunks, key):
+    """Format selector and export button for a table, written in the background;
+    its download button appears once it is written.
+    """
+    export_format = st.selectbox("Export format", export_formats.keys(), index=0, key=f"{key}_format")
+    task_name = f"{key}_export"
+    task_key = (export_key, export_format)
+    if st.button("Export table", key=f"{key}_button"):
+        task_functions.submit_task(task_name, task_key, export_table, file_stem, export_key, get_chunks, export_format)
+
+    export_future = task_functions.get_task(task_name, task_key)
+    if export_future is None:
+        # An export of a previous selection is no longer needed
+        task_functions.cancel_task(task_name)
+    else:
+        task_functions.show_task_result(
+            export_future,
+            lambda export_path: show_export_download(export_path, file_stem, export_format, key),
+            pending_message="Exporting...", error_message="Unable to export the table",
+            )
+
+# Class areas of farms and catchments (the tables behind ee_functions.altair_chart)
+# are stored once calculated, so exports of many farms reuse those already
+# calculated on the page or by an earlier export
+def get_class_areas_path(stats_key):
+    stats_digest = hashlib.sha1(json.dumps(stats_key, default=str).encode()).hexdigest()
+    return variables.get_cache_path("class_areas", f"{stats_digest}.parquet")
+
+def get_class_areas(stats_key, area_chart_df, zone_gdf, classified_index, selected_index, cancel_event=None):
+    """Class areas of a farm or catchment (`area_chart_df`), stored by `stats_key` and reused.
+
+    `stats_key` identifies the page, zone, image date, index and cloud cover.
+    """
+    class_areas_path = get_class_areas_path(stats_key)
+    if os.path.exists(class_areas_path):
+        return pd.read_parquet(class_areas_path)
+
+    class_areas_df = area_chart_df(zone_gdf, classified_index, selected_index, cancel_event=cancel_event)
+    with variables.temp_write_path(class_areas_path) as temp_path:
+        class_areas_df.to_parquet(temp_path, index=False)
+    return class_areas_df
+
+def iter_zone_class_areas(page, zones_gdf, id_cols, ee_module, get_classified_index, selected_index,
+                          selected_start_date, selected_end_date, max_cloud_cover):
+    """Class areas of each farm or catchment of `zones_gdf`, one GeoDataFrame row per zone.
+
+    Each zone is measured on its latest image in the date range, classified
+    by `get_classified_index(zone_gdf, image_date)`, with one area column per
+    class. Zones without an image have no image date or areas.
+    """
+    class_names = [index_value_class for _, _, index_value_class, _, _ in ee_module.index_intervals(selected_index)]
+    for zone_index in range(len(zones_gdf)):
+        zone_gdf = zones_gdf.iloc[[zone_index]]
+        row = zone_gdf[id_cols + [zone_gdf.geometry.name]].reset_index(drop=True)
+
+        image_collection = ee_module.get_available_images(zone_gdf, selected_start_date, selected_end_date, max_cloud_cover)
+        image_dates = ee_module.available_imagery_dates_list(image_collection)
+        image_date = image_dates[0] if image_dates else None
+        # Typed, so zones without an image leave the column's type unchanged
+        row.insert(len(id_cols), "Image date", pd.array([image_date], dtype="string"))
+
+        class_areas = dict.fromkeys(class_names, float("nan"))
+        if image_date is not None:
+            stats_key = (page, aoi_functions.get_gdf_key(zone_gdf), image_date, selected_index, max_cloud_cover)
+            class_areas_df = get_class_areas(
+                stats_key, ee_module.area_chart_df, zone_gdf, get_classified_index(zone_gdf, image_date), selected_index
+                )
+            class_areas.update(zip(class_areas_df[selected_index], class_areas_df["Area (Ha)"]))
+
+        for class_name in class_names:
+            row.insert(row.shape[1] - 1, f"{class_name} (Ha)", float(class_areas[class_name]))
+        yield row
+
+def add_class_area_export(page, zones_gdf, id_cols, name_col, zone_label, ee_module, get_classified_index,
+                          selected_index, selected_start_date, selected_end_date, max_cloud_cover, key):
+    """Selector of farms or catchments (`zone_label`) and export of their class areas, a row per zone."""
+    zone_names = zones_gdf[name_col].astype(str).sort_values().unique().tolist()
+    selected_zone_names = st.multiselect(
+        f"Select {zone_label} to export (up to {export_max_zones})", zone_names,
+        max_selections=export_max_zones, key=f"{key}_zones"
+        )
+    if not selected_zone_names:
+        return
+    selected_zones_gdf = zones_gdf[zones_gdf[name_col].astype(str).isin(selected_zone_names)]
+
+    export_key = (
+        page, aoi_functions.get_gdf_key(selected_zones_gdf), id_cols, selected_index,
+        selected_start_date, selected_end_date, max_cloud_cover,
+    )
+    file_stem = f"{page}_{selected_index.lower().replace(' ', '_')}_class_areas"
+    add_export_controls(
+        file_stem, export_key,
+        lambda: iter_zone_class_areas(
+            page, selected_zones_gdf, id_cols, ee_module, get_classified_index, selected_index,
+            selected_start_date, selected_end_date, max_cloud_cover,
+            ),
+        key,
+    )
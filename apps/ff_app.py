@@ -3,13 +3,136 @@ import geopandas as gpd
 import pandas as pd
 import folium
 import leafmap.foliumap as leafmap
-from apps import variables
+from apps import variables, map_functions, map_cache_functions, trace_functions
+
+# Files the farm map is built from; a change to any of them renders it anew
+farm_map_sources = [
+    __file__, map_functions.__file__, r"data/vector/Foundation_Farm_Boundary.gpkg",
+    r"data/vector/Buildings_2.gpkg", r"data/vector/Crop_Blocks.gpkg", "planting_records.csv",
+]
+
+# Define crop colors
+crop_colors = {
+    "Apples": "red",
+    "Beans": "purple",
+    "Cow Pea": "pink",
+    "Groundnuts": "saddlebrown",
+    "Maize": "gold",
+    "Oranges": "darkorange",
+    "Soy Bean": "lightgreen",
+    "Sunflower": "khaki",
+    "Sunhemp": "seagreen",
+}
+default_color = "grey"
+
+def get_gardens_history(gardens, filtered_history):
+    """Gardens with the first matching planting record of each block and its colour."""
+    history_cols = ["crop_type", "year", "season", "rotation_order"]
+    first_records = filtered_history.drop_duplicates("Block_name", keep="first")
+    first_records = first_records[["Block_name"] + history_cols].astype({"year": str, "rotation_order": str})
+
+    gardens_history = gardens.merge(first_records, on="Block_name", how="left")
+
+    gardens_history["color"] = gardens_history["crop_type"].map(crop_colors).fillna(default_color)
+    gardens_history["crop_type"] = gardens_history["crop_type"].fillna("No crop data")
+    gardens_history[history_cols[1:]] = gardens_history[history_cols[1:]].fillna("N/A")
+
+    return gardens_history
+
+def build_farm_map(selected_year, selected_season, selected_rotation):
+    """Farm map for one filter state.
+
+    All basemaps are part of the map and switched in the browser, so the
+    vector layers are built once per filter state and never for a basemap change.
+    """
+    # --------------------------
+    # Step 1: Load GIS layers
+    # --------------------------
+    facility = variables.get_foundation_farm_boundaries()
+    buildings = variables.get_buildings()
+    gardens = variables.get_Crop_blocks()
+
+    # Set CRS for each GeoDataFrame (assuming WGS84)
+    facility.crs = "EPSG:4326"
+    buildings.crs = "EPSG:4326"
+    gardens.crs = "EPSG:4326"
+
+    # --------------------------
+    # Step 2: Rename columns and normalize strings
+    # --------------------------
+    # Planting history is loaded and normalised once by variables.get_planting_history
+    gardens = gardens.rename(columns={"Block_Name": "Block_name"})
+    gardens["Block_name"] = gardens["Block_name"].str.strip().str.lower()
+
+    # --------------------------
+    # Step 3: Filter history
+    # --------------------------
+    filtered_history = variables.get_filtered_planting_history(
+        selected_year, selected_season, selected_rotation
+    )
+
+    # Join the first matching record of each block to the gardens in one pass
+    gardens_history = get_gardens_history(gardens, filtered_history)
+
+    # --------------------------
+    # Step 4: Create the map
+    # --------------------------
+    m = leafmap.Map(locate_control=True, draw_control=True, tiles=None)
+
+    # Set the initial view based on the facility layer bounds
+    bounds = facility.total_bounds  # [minx, miny, maxx, maxy]
+    m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
+    map_functions.add_switchable_basemaps(m)
+
+    # Add Facility Layer
+    map_functions.add_gdf_layer(
+        m, facility, "Facilities",
+        style={"color": "white", "weight": 2, "fillOpacity": 0},
+        tooltip_fields=["Name"], tooltip_aliases=["Facility:"]
+    )
+
+    # Add Buildings Layer
+    map_functions.add_gdf_layer(
+        m, buildings, "Buildings",
+        style={"color": "blue", "weight": 1, "fillOpacity": 0.2},
+        tooltip_fields=["Name"], tooltip_aliases=["Building:"]
+    )
+
+    # Add gardens layer with color coding from the joined history
+    map_functions.add_gdf_layer(
+        m, gardens_history, "Gardens",
+        style={"fillColor": "transparent", "weight": 2, "fillOpacity": 0},
+        tooltip_fields=["Block_name", "crop_type", "year", "season", "rotation_order"],
+        tooltip_aliases=["Block:", "Crop:", "Year:", "Season:", "Rotation:"],
+        color_col="color"
+    )
+
+    return m
+
+@trace_functions.traced
+def get_farm_map_html(selected_year, selected_season, selected_rotation):
+    """Rendered farm map for one filter state, with its payload by layer kind."""
+    return map_cache_functions.get_cached_map_html(
+        "ff_app",
+        {'year': selected_year, 'season': selected_season, 'rotation': selected_rotation},
+        lambda: build_farm_map(selected_year, selected_season, selected_rotation),
+        farm_map_sources, basemap="OpenStreetMap",
+        )
+
+def get_hot_map_filters():
+    """Filter states opened most often: all records and each year."""
+    years = sorted(variables.get_filtered_planting_history()["year"].unique())
+    return [
+        {'selected_year': selected_year, 'selected_season': "All", 'selected_rotation': "All"}
+        for selected_year in ["All"] + years
+    ]
 
 # --------------------------
 
 # Step 0: Streamlit page config
 # --------------------------
 # st.set_page_config(layout="wide")
+@trace_functions.traced
 def app():
     """This function adds the app that displays the Foundation Farm management
     """
@@ -17,187 +140,31 @@ def app():
     # st.header('Foundation Farm Crop Health Monitoring')
 
     ff_health_tab, = st.tabs(['Individual crop health monitor'])
-    with ff_health_tab:
-        # st.header('Analyse Crop health')
-# --------------------------
-# define GIS layers
-        gdf2 = variables.get_foundation_farm_boundaries()
-        gdf3 = variables.get_buildings()
-        gdf4 = variables.get_Crop_blocks()
-# --------------------------
-# Step 1: Load GIS layers
-# --------------------------
-    facility = gdf2
-    buildings = gdf3
-    gardens = gdf4
-    history = pd.read_csv("planting_records.csv")
-
-# Set CRS for each GeoDataFrame (assuming WGS84)
-    facility.crs = "EPSG:4326"
-    buildings.crs = "EPSG:4326"
-    gardens.crs = "EPSG:4326"
-
-
-# Step 2: Rename columns
-# --------------------------
-    gardens = gardens.rename(columns={"Block_Name": "Block_name"})
-    history = history.rename(columns={"Name": "Block_name", "rotation_o": "rotation_order"})
 
 # --------------------------
-# Step 3: Normalize strings
+# Step 5: Create three columns of filters; the basemap is switched on the map
 # --------------------------
-    gardens["Block_name"] = gardens["Block_name"].str.strip().str.lower()
-    history["Block_name"] = history["Block_name"].str.strip().str.lower()
-    history["season"] = history["season"].str.strip().str.lower()
-
-# --------------------------
-# Step 4: Create two columns: filters left, map right
-# --------------------------
-    col1, col2, col3 , col4 = st.columns(4)
+    col1, col2, col3 = st.columns(3)
 
     with col1:
+        history = variables.get_filtered_planting_history()
         years_options = ["All"] + sorted(history["year"].unique())
         selected_year = st.selectbox("Select Year", years_options)
     with col2:
-        if selected_year != "All":
-            filtered_history = history[history["year"] == selected_year]
-        else :
-            filtered_history = history.copy()
+        filtered_history = variables.get_filtered_planting_history(selected_year)
         seasons_options = ["All"] + sorted(filtered_history["season"].unique())
         selected_season = st.selectbox("Select Season", seasons_options)
     with col3:
         if selected_year != "All" and selected_season != "All":
-            filtered_history = history[
-                (history["year"] == selected_year) &
-                (history["season"] == selected_season)
-            ]
+            filtered_history = variables.get_filtered_planting_history(selected_year, selected_season)
         else:
-            filtered_history = history.copy() 
+            filtered_history = history
 
         rotation_options = ["All"] + sorted(filtered_history["rotation_order"].unique())
         selected_rotation = st.selectbox("Select Rotation Order", rotation_options)
-    with col4:
-        # Basemap selection
-        basemap_options = {
-            "OpenStreetMap": "OpenStreetMap",
-            "Google Satellite": "SATELLITE",
-            "Google Hybrid": "HYBRID",
-            "CartoDB Dark": "CartoDB.DarkMatter",
-        }
-        selected_basemap = st.selectbox("Select Basemap", list(basemap_options.keys()))
-
-    # --------------------------
-    # Step 5: Filter history
-    # --------------------------
-    filtered_history = history.copy()
-    if selected_year != "All":
-        filtered_history = filtered_history[filtered_history["year"] == selected_year]
-    if selected_season != "All":
-        filtered_history = filtered_history[filtered_history["season"] == selected_season]
-    if selected_rotation != "All":
-        filtered_history = filtered_history[
-            filtered_history["rotation_order"] == selected_rotation
-        ]
-
-# --------------------------
-# Step 6: Function to create the map
-# --------------------------
-    def create_map(basemap):
-        m = leafmap.Map(locate_control=True, draw_control=True)
-        
-        # Set the initial view based on the facility layer bounds
-        bounds = facility.total_bounds  # [minx, miny, maxx, maxy]
-        m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
-        m.add_basemap(basemap)
-
-        # Add Facility Layer
-        facility_layer = folium.FeatureGroup(name="Facilities").add_to(m)
-        for _, f_row in facility.iterrows():
-            folium.GeoJson(
-                f_row['geometry'],
-                style_function=lambda x: {
-                    "color": "white",
-                    "weight": 2,
-                    "fillOpacity": 0
-                },
-                tooltip=f"<b>Facility:</b> {f_row['Name']}"
-            ).add_to(facility_layer)
-
-        # Add Buildings Layer
-        buildings_layer = folium.FeatureGroup(name="Buildings").add_to(m)
-        for _, b_row in buildings.iterrows():
-            folium.GeoJson(
-                b_row['geometry'],
-                style_function=lambda x: {
-                    "color": "blue",
-                    "weight": 1,
-                    "fillOpacity": 0.2
-                },
-                tooltip=f"<b>Building:</b> {b_row['Name']}"
-            ).add_to(buildings_layer)
-
-        # Define crop colors
-        crop_colors = {
-            "Apples": "red",
-            "Beans": "purple",
-            "Cow Pea": "pink",
-            "Groundnuts": "saddlebrown",   
-            "Maize": "gold",              
-            "Oranges": "darkorange",
-            "Soy Bean": "lightgreen",
-            "Sunflower": "khaki",         
-            "Sunhemp": "seagreen",
-        }
-        default_color = "grey"
-
-
-    # Create a Gardens layer
-        gardens_layer = folium.FeatureGroup(name="Gardens").add_to(m)
-
-    # Add gardens layer with filtering and color coding
-        for _, g_row in gardens.iterrows():
-            plot_history = filtered_history[filtered_history["Block_name"] == g_row["Block_name"]]
-
-            # Default values for tooltip
-            crop = "No crop data"
-            year = "N/A"
-            season = "N/A"
-            rotation = "N/A"
-            color = default_color
-
-            if not plot_history.empty:
-                for _, h_row in plot_history.iterrows():
-                    crop = h_row["crop_type"]
-                    year = h_row["year"]
-                    season = h_row["season"]
-                    rotation = h_row["rotation_order"]
-                    color = crop_colors.get(crop, default_color)
-                    break  # Use the first matching record
-
-            # Create the GeoJson with custom styles and tooltip
-            geojson = folium.GeoJson(
-                g_row["geometry"],
-                style_function=lambda x, col=color: {
-                    "fillColor": "transparent",
-                    "color": col,
-                    "weight": 2,
-                    "fillOpacity": 0,
-                },
-                tooltip=(
-                    f"<b>Block:</b> {g_row['Block_name']}<br>"
-                    f"<b>Crop:</b> {crop}<br>"
-                    f"<b>Year:</b> {year}<br>"
-                    f"<b>Season:</b> {season}<br>"
-                    f"<b>Rotation:</b> {rotation}"
-                )
-            )
-            geojson.add_to(gardens_layer)
-
-        return m
 
 # --------------------------
-# Step 7: Create and display the map
+# Step 6: Display the map
 # --------------------------
-    m = create_map(basemap_options[selected_basemap])
-    # with col2:
-    m.to_streamlit(width=1200, height=500)
\ No newline at end of file
+    map_html, map_payload = get_farm_map_html(selected_year, selected_season, selected_rotation)
+    map_functions.show_map_html("ff_app", map_html, map_payload, height=500, width=1200)
\ No newline at end of file
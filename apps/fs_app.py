@@ -6,8 +6,9 @@ from folium.plugins import MeasureControl
 import folium
 import ee
 import pandas as pd
+import pyarrow as pa
 
-from apps import ee_functions2, variables
+from apps import ee_functions2, variables, aoi_functions, rainfall_functions, map_functions, task_functions, trace_functions, ee_client, query_functions, kepler_functions, sh_functions, export_functions
 
 
 # Folium/streamlit JSON serialization helpers
@@ -189,26 +190,83 @@ if fs_gdf.crs is None:
 
 FS_NAME_COL = _get_name_column(fs_gdf)
 
-# Load smallholder fields once and keep in memory
-try:
-    sh_gdf = variables.get_sh_farms()
-    # Ensure smallholder layer has a CRS (assume WGS84 if missing)
-    if sh_gdf.crs is None:
-        sh_gdf.set_crs(epsg=4326, inplace=True)
-except Exception:
-    sh_gdf = None
+# Catchment outlines, drawn as compact GeoJSON (see map_functions.get_compact_geojson)
+fs_catchment_style = {"color": "#3388ff", "weight": 2, "opacity": 1, "fillOpacity": 0}
 
 
+# Columns identifying each catchment in exports of their class areas
+fs_export_cols = list(dict.fromkeys(c for c in [FS_NAME_COL, "Hub Name", "FE Region"] if c in fs_gdf.columns))
+
+
+def _get_catchment_mosaic(image_collection, catchment_gdf: gpd.GeoDataFrame):
+    """
+    True colour mosaic of all tiles intersecting a catchment, clipped to the
+    buffered catchment. For large FS catchments a single Sentinel‑2 tile
+    might not cover the whole area.
+    """
+    buffered_catchment_ee = aoi_functions.get_aoi_ee(ee_functions2.get_buffered_farm_gdf(catchment_gdf), "Sentinel-2")
+    # Mosaic may drop metadata; preserve a representative acquisition timestamp.
+    image_for_date = ee.Image(image_collection.sort("system:time_start", False).first())
+    return (
+        image_collection.mosaic()
+        .clip(buffered_catchment_ee)
+        .copyProperties(image_for_date, ["system:time_start"])
+    )
+
+
+def _get_catchment_classified_index(catchment_gdf: gpd.GeoDataFrame, image_date: str, selected_index: str, max_cloud_cover):
+    """
+    Classified index image of a catchment on an image date, as the map shows it.
+    """
+    start_date, end_date = ee_functions2.selected_date_range(image_date)
+    image_collection = ee_functions2.get_available_images(catchment_gdf, start_date, end_date, max_cloud_cover)
+    calculated_index_image = ee_functions2.calculate_index(selected_index, _get_catchment_mosaic(image_collection, catchment_gdf))
+    return ee_functions2.classifiy_index_values(catchment_gdf, calculated_index_image, selected_index)
+
+
+def _get_fs_kepler_map(catchments_gdf: gpd.GeoDataFrame, fields_gdf: gpd.GeoDataFrame | None = None):
+    """
+    Datasets and config of a WebGL map of FS catchments and the smallholder
+    fields in them, coloured by hub as on the Small Holder page.
+    """
+    datasets = {"catchments": kepler_functions.get_gdf_table(catchments_gdf, [FS_NAME_COL])}
+    layers = [kepler_functions.get_polygon_layer("catchments", "FS Catchments", color=fs_catchment_style["color"])]
+    tooltip_fields = {"catchments": [FS_NAME_COL]}
+
+    if fields_gdf is not None and not fields_gdf.empty:
+        field_columns = ["lon", "lat"] + sh_functions.kepler_tooltip_columns + ["hub_id"]
+        datasets["fields"] = pa.Table.from_pandas(fields_gdf[field_columns], preserve_index=False)
+        layers.append(kepler_functions.get_point_layer(
+            "fields", "Farmer Fields", color_column="hub_id", colors=sh_functions.get_colors("Hub", {}),
+        ))
+        tooltip_fields["fields"] = sh_functions.kepler_tooltip_columns
+
+    return datasets, kepler_functions.get_map_config(layers, tooltip_fields)
+
+
+def _show_fs_map(m, view_webgl: bool, catchments_gdf: gpd.GeoDataFrame, fields_gdf: gpd.GeoDataFrame | None = None) -> None:
+    """
+    Show the folium map, or with WebGL (where no folium map is built) only
+    the catchments and fields.
+    """
+    if view_webgl:
+        datasets, config = _get_fs_kepler_map(catchments_gdf, fields_gdf)
+        kepler_functions.show_kepler_map("fs_app", datasets, config, height=550)
+    else:
+        map_functions.show_map(m, "fs_app", height=550)
+
+
+@trace_functions.traced
 def app():
     """FS catchment crop health / moisture viewer using Sentinel‑2 imagery."""
 
     st.header("FS Catchment Crop Health")
+    view_webgl = kepler_functions.select_map_renderer(key="fs_map_renderer")
 
-    indices_list = variables.available_crop_health_metrics()
-
-    # Selector layout: FS catchment, metric, date range, cloud cover, image date
-    fs_col, index_col, start_date_col, end_date_col, cloud_col, date_col = st.columns(
-        [1.7, 1.7, 1.5, 1.5, 1.5, 2.0]
+    # Selector layout: FS catchment, date range and cloud cover select the
+    # imagery; the metric and image date are chosen in fs_imagery_fragment
+    fs_col, start_date_col, end_date_col, cloud_col = st.columns(
+        [1.7, 1.5, 1.5, 1.5]
     )
 
     with fs_col:
@@ -227,15 +285,6 @@ def app():
             key="fs_catchment_name",
         )
 
-    with index_col:
-        selected_index = st.selectbox(
-            "Select the metric to monitor",
-            indices_list,
-            index=None,
-            placeholder="Select metric...",
-            key="fs_metric",
-        )
-
     today = datetime.date.today()
     with start_date_col:
         selected_start_date = str(
@@ -265,8 +314,6 @@ def app():
             key="fs_cloud_cover",
         )
 
-    selected_available_image_date = None
-
     # Helper: get selected catchment GeoDataFrame
     def get_selected_catchment_gdf():
         if selected_fs_name is None:
@@ -276,70 +323,130 @@ def app():
 
     selected_fs_gdf = get_selected_catchment_gdf()
 
-    with st.spinner(
-        f"Getting available images for {selected_fs_name}...",
-        show_time=True,
-    ):
-        with date_col:
-            if selected_fs_name is None:
-                selected_available_image_date = st.selectbox(
-                    "Select image date",
-                    ["Select FS catchment"],
-                    index=None,
-                    placeholder="Select date...",
-                    key="fs_image_date_placeholder",
-                )
+    # Catchment rainfall from the locally cached rainy-season climatology
+    if selected_fs_gdf is not None:
+        # Rainfall is supplementary; never block the imagery viewer on it
+        try:
+            if rainfall_functions.request_rainfall_climatology() is None:
+                st.caption("Average rainy season rainfall is being downloaded and will show on a later rerun.")
             else:
-                if selected_fs_gdf is None:
-                    st.info("No geometry found for the selected FS catchment.")
-                else:
-                    image_collection = ee_functions2.get_available_images(
-                        selected_fs_gdf,
-                        selected_start_date,
-                        selected_end_date,
-                        max_cloud_cover,
+                catchment_rainfall = rainfall_functions.get_aoi_rainfall(selected_fs_gdf)
+                if catchment_rainfall["mean"] is not None:
+                    st.caption(
+                        f"Average rainy season rainfall ({rainfall_functions.default_start_year}-"
+                        f"{rainfall_functions.default_end_year}): {catchment_rainfall['mean']} mm "
+                        f"(range {catchment_rainfall['min']}-{catchment_rainfall['max']} mm)"
                     )
+        except Exception as e:
+            print(f"Could not get the rainfall of {selected_fs_name}: {e}")
+            st.caption("Average rainy season rainfall is unavailable.")
+
+    # Imagery dates depend only on the selectors above, so they are not
+    # queried again when the metric or image date changes
+    image_collection = None
+    available_image_dates_list = []
+    if selected_fs_gdf is not None:
+        with st.spinner(
+            f"Getting available images for {selected_fs_name}...",
+            show_time=True,
+        ):
+            image_collection = ee_functions2.get_available_images(
+                selected_fs_gdf,
+                selected_start_date,
+                selected_end_date,
+                max_cloud_cover,
+            )
+
+            available_image_dates_list = (
+                ee_functions2.available_imagery_dates_list(image_collection)
+            )
+
+    fs_imagery_fragment(
+        selected_fs_name, selected_fs_gdf, image_collection, available_image_dates_list, max_cloud_cover,
+        selected_start_date, selected_end_date, view_webgl
+    )
 
-                    available_image_dates_list = (
-                        ee_functions2.available_imagery_dates_list(image_collection)
-                    )
 
-                    if not available_image_dates_list:
-                        st.info(
-                            "No imagery available for the selected filters yet. "
-                            "Try widening the date range or relaxing the cloud cover."
-                        )
-                    else:
-                        selected_available_image_date = st.selectbox(
-                            "Select the image date",
-                            available_image_dates_list,
-                            index=0,
-                            key="fs_image_date",
-                        )
+@st.fragment
+@trace_functions.traced
+def fs_imagery_fragment(selected_fs_name, selected_fs_gdf, image_collection, available_image_dates_list, max_cloud_cover,
+                        selected_start_date=None, selected_end_date=None, view_webgl=False):
+    """Metric and image date selectors, map and metrics chart for the selected imagery.
+
+    Changing the metric or image date reruns only this fragment.
+    """
+    indices_list = variables.available_crop_health_metrics()
+
+    index_col, date_col, _ = st.columns([1.7, 2.0, 4.5])
+
+    with index_col:
+        selected_index = st.selectbox(
+            "Select the metric to monitor",
+            indices_list,
+            index=None,
+            placeholder="Select metric...",
+            key="fs_metric",
+        )
+
+    selected_available_image_date = None
+
+    with date_col:
+        if selected_fs_name is None:
+            selected_available_image_date = st.selectbox(
+                "Select image date",
+                ["Select FS catchment"],
+                index=None,
+                placeholder="Select date...",
+                key="fs_image_date_placeholder",
+            )
+        elif selected_fs_gdf is None:
+            st.info("No geometry found for the selected FS catchment.")
+        elif not available_image_dates_list:
+            st.info(
+                "No imagery available for the selected filters yet. "
+                "Try widening the date range or relaxing the cloud cover."
+            )
+        else:
+            selected_available_image_date = st.selectbox(
+                "Select the image date",
+                available_image_dates_list,
+                index=0,
+                key="fs_image_date",
+            )
 
     if selected_fs_name is not None and selected_available_image_date is None:
         st.info(
             "Select a different date range or FS catchment to see available imagery."
         )
 
+    # Metrics are only calculated for a selected catchment, image date and metric
+    if selected_available_image_date is None or selected_index is None:
+        task_functions.cancel_task("fs_metrics")
+
     # If nothing is selected yet, just show all FS catchments on a simple map
     if selected_fs_name is None:
-        m = geemap.Map(
-            control_scale=True,
-            draw_control=False,
-            layer_control=False,
-        )
-        m.add_child(
-            MeasureControl(
-                primary_length_unit="kilometers",
-                secondary_length_unit="meters",
-                primary_area_unit="sqmeters",
-                secondary_area_unit="hectares",
+        # The WebGL renderer draws the catchments itself, without a folium map
+        m = None
+        if not view_webgl:
+            m = geemap.Map(
+                control_scale=True,
+                draw_control=False,
+                layer_control=False,
             )
-        )
-        m.zoom_to_gdf(fs_gdf)
-        m.add_gdf(_folium_safe_gdf(fs_gdf, [FS_NAME_COL, "geometry"]), layer_name="FS Catchments")
-        m.to_streamlit(height=550)
+            m.add_child(
+                MeasureControl(
+                    primary_length_unit="kilometers",
+                    secondary_length_unit="meters",
+                    primary_area_unit="sqmeters",
+                    secondary_area_unit="hectares",
+                )
+            )
+            m.zoom_to_gdf(fs_gdf)
+            map_functions.add_gdf_layer(
+                m, fs_gdf, "FS Catchments", style=fs_catchment_style,
+                tooltip_fields=[FS_NAME_COL], display_level="Catchment",
+            )
+        _show_fs_map(m, view_webgl, fs_gdf)
         return
 
     # If FS catchment and date are selected, show imagery and metrics
@@ -366,7 +473,7 @@ def app():
 
         # If the date-range filter yields no images, the EE tile layer won't render.
         try:
-            image_count = int(image_collection.size().getInfo())
+            image_count = int(ee_client.get_info(image_collection.size()))
         except Exception:
             image_count = 0
 
@@ -375,7 +482,37 @@ def app():
                 "No Sentinel-2 imagery found for the selected catchment/date. "
                 "Try selecting a different image date, widening the date range, or increasing cloud cover."
             )
+            m = None
+            if not view_webgl:
+                m = geemap.Map(control_scale=True, draw_control=False, layer_control=False)
+                m.add_child(
+                    MeasureControl(
+                        primary_length_unit="kilometers",
+                        secondary_length_unit="meters",
+                        primary_area_unit="hectares",
+                        secondary_area_unit="sqmeters",
+                    )
+                )
+                map_functions.add_gdf_layer(
+                    m, selected_fs_gdf, "FS Catchment", style=fs_catchment_style,
+                    tooltip_fields=[FS_NAME_COL], display_level="Catchment",
+                )
+                m.zoom_to_gdf(buffered_selected_fs_gdf)
+            _show_fs_map(m, view_webgl, selected_fs_gdf)
+            return
+
+        true_color_image = _get_catchment_mosaic(image_collection, selected_fs_gdf)
+
+        true_color_visparams = ee_functions2.get_vis_params("True Color")
+        image_date = ee_functions2.get_imagery_date(true_color_image)
+
+        # The WebGL renderer draws no imagery, so neither the folium map nor
+        # its Earth Engine layers (a getMapId request each) are built for it
+        m = None
+        if not view_webgl:
             m = geemap.Map(control_scale=True, draw_control=False, layer_control=False)
+            m.add_ee_layer = ee_functions2.add_ee_layer.__get__(m)
+
             m.add_child(
                 MeasureControl(
                     primary_length_unit="kilometers",
@@ -384,44 +521,13 @@ def app():
                     secondary_area_unit="sqmeters",
                 )
             )
-            m.add_gdf(
-                _folium_safe_gdf(selected_fs_gdf, [FS_NAME_COL, "geometry"]),
-                layer_name="FS Catchment",
-            )
-            m.zoom_to_gdf(buffered_selected_fs_gdf)
-            m.to_streamlit(height=550)
-            return
-
-        buffered_selected_fs_ee = geemap.gdf_to_ee(buffered_selected_fs_gdf)
-        # Mosaic may drop metadata; preserve a representative acquisition timestamp.
-        image_for_date = ee.Image(image_collection.sort("system:time_start", False).first())
-        true_color_image = (
-            image_collection.mosaic()
-            .clip(buffered_selected_fs_ee)
-            .copyProperties(image_for_date, ["system:time_start"])
-        )
-
-        true_color_visparams = ee_functions2.get_vis_params("True Color")
-        image_date = ee_functions2.get_imagery_date(true_color_image)
-
-        m = geemap.Map(control_scale=True, draw_control=False, layer_control=False)
-        m.add_ee_layer = ee_functions2.add_ee_layer.__get__(m)
 
-        m.add_child(
-            MeasureControl(
-                primary_length_unit="kilometers",
-                secondary_length_unit="meters",
-                primary_area_unit="hectares",
-                secondary_area_unit="sqmeters",
+            # Base true color image
+            m.add_ee_layer(
+                true_color_image,
+                visparams=true_color_visparams,
+                name="True Color",
             )
-        )
-
-        # Base true color image
-        m.add_ee_layer(
-            true_color_image,
-            visparams=true_color_visparams,
-            name="True Color",
-        )
 
         # If a metric is selected, calculate index, classify, and show chart + legend
         if selected_index is not None:
@@ -438,68 +544,95 @@ def app():
             selected_index_visparams = ee_functions2.get_vis_params(selected_index)
             legend_labels, legend_colors = ee_functions2.legend_params(selected_index)
 
-            fig_df = ee_functions2.area_chart_df(
-                selected_fs_gdf, classified_index_image, selected_index
+            # Class areas over a large catchment take a while; calculate them in
+            # the background and show the map first. A calculation for a previous
+            # selection is cancelled.
+            # Class areas already calculated for the catchment (here or by an
+            # export) are read from the store.
+            metrics_key = (
+                aoi_functions.get_gdf_key(selected_fs_gdf),
+                selected_available_image_date,
+                selected_index,
+                max_cloud_cover,
+            )
+            metrics_future = task_functions.submit_task(
+                "fs_metrics",
+                metrics_key,
+                export_functions.get_class_areas,
+                ("fs_app",) + metrics_key,
+                ee_functions2.area_chart_df,
+                selected_fs_gdf,
+                classified_index_image,
+                selected_index,
             )
-            chart = ee_functions2.altair_chart(fig_df, selected_index)
 
             with st.expander(f"View {selected_index} metrics..."):
-                with st.spinner("Calculating metrics...", show_time=True):
-                    bar_chart_col, _ = st.columns([4, 1])
-                    with bar_chart_col:
-                        st.altair_chart(chart)
-
-            with st.spinner(
-                f"Adding {selected_index.lower()} to map...", show_time=True
-            ):
-                m.add_ee_layer(
-                    classified_index_image,
-                    visparams=selected_index_visparams,
-                    name=selected_index,
-                )
+                bar_chart_col, _ = st.columns([4, 1])
+                with bar_chart_col:
+                    task_functions.show_task_result(
+                        metrics_future,
+                        lambda fig_df: st.altair_chart(
+                            ee_functions2.altair_chart(fig_df, selected_index)
+                        ),
+                    )
 
-            legend_dict = dict(zip(legend_labels, legend_colors))
+            # Class areas of several catchments, each on its latest image in the date range
+            with st.expander(f"Export {selected_index.lower()} class areas of catchments..."):
+                export_functions.add_class_area_export(
+                    "fs_app", fs_gdf, fs_export_cols, FS_NAME_COL, "catchments", ee_functions2,
+                    lambda catchment_gdf, catchment_image_date: _get_catchment_classified_index(
+                        catchment_gdf, catchment_image_date, selected_index, max_cloud_cover
+                    ),
+                    selected_index, selected_start_date, selected_end_date, max_cloud_cover,
+                    key="fs_class_area_export",
+                )
 
-            from apps import soil_functions  # Local import to avoid circulars at top
+            if m is not None:
+                with st.spinner(
+                    f"Adding {selected_index.lower()} to map...", show_time=True
+                ):
+                    m.add_ee_layer(
+                        classified_index_image,
+                        visparams=selected_index_visparams,
+                        name=selected_index,
+                    )
 
-            soil_functions.add_categorical_legend(
-                m,
-                selected_index,
-                list(legend_dict.values()),
-                list(legend_dict.keys()),
-            )
+                legend_dict = dict(zip(legend_labels, legend_colors))
 
-        m.add_gdf(
-            _folium_safe_gdf(selected_fs_gdf, [FS_NAME_COL, "geometry"]),
-            layer_name="FS Catchment",
-        )
+                from apps import soil_functions  # Local import to avoid circulars at top
 
-        # Overlay smallholder fields that fall inside the selected FS catchment
-        if sh_gdf is not None and not sh_gdf.empty:
-            try:
-                # Align CRS for spatial join
-                fs_for_join = selected_fs_gdf.copy()
-                sh_for_join = sh_gdf.copy()
+                soil_functions.add_categorical_legend(
+                    m,
+                    selected_index,
+                    list(legend_dict.values()),
+                    list(legend_dict.keys()),
+                )
 
-                if fs_for_join.crs is None:
-                    fs_for_join.set_crs(epsg=4326, inplace=True)
-                if sh_for_join.crs is None:
-                    sh_for_join.set_crs(epsg=4326, inplace=True)
+        if m is not None:
+            map_functions.add_gdf_layer(
+                m, selected_fs_gdf, "FS Catchment", style=fs_catchment_style,
+                tooltip_fields=[FS_NAME_COL], display_level="Catchment",
+            )
 
-                if sh_for_join.crs != fs_for_join.crs:
-                    sh_for_join = sh_for_join.to_crs(fs_for_join.crs)
+        # Overlay smallholder fields that fall inside the selected FS catchment,
+        # queried from the fields layer instead of joined against all of it in memory
+        sh_in_catchment = None
+        try:
+            fs_for_join = selected_fs_gdf.copy()
+            if fs_for_join.crs is None:
+                fs_for_join.set_crs(epsg=4326, inplace=True)
 
-                # Spatial join: keep smallholder fields within the selected FS catchment
-                sh_in_catchment = gpd.sjoin(
-                    sh_for_join, fs_for_join[["geometry"]], how="inner", predicate="within"
-                )
+            sh_in_catchment = query_functions.get_fields_within(fs_for_join.to_crs(epsg=4326).union_all())
 
-                if not sh_in_catchment.empty:
-                    _add_smallholder_circle_layer(m, sh_in_catchment)
-            except Exception:
-                # If anything goes wrong, just skip the overlay instead of breaking the app
-                pass
-        m.zoom_to_gdf(buffered_selected_fs_gdf)
-        m.add_text(image_date, position="topright", fontsize=16, bold=True)
-        m.to_streamlit(height=550)
+            if not sh_in_catchment.empty and m is not None:
+                _add_smallholder_circle_layer(m, sh_in_catchment)
+        except Exception:
+            # If anything goes wrong, just skip the overlay instead of breaking the app
+            pass
+        if m is not None:
+            m.zoom_to_gdf(buffered_selected_fs_gdf)
+            m.add_text(image_date, position="topright", fontsize=16, bold=True)
+        else:
+            st.caption(f"Imagery of {image_date} and metric layers are only drawn by the Folium renderer.")
+        _show_fs_map(m, view_webgl, selected_fs_gdf, sh_in_catchment)
 
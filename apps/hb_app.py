@@ -2,13 +2,98 @@ import streamlit as st
 import folium
 from folium.plugins import MarkerCluster, MeasureControl
 import xyzservices.providers as xyz
-from streamlit_folium import folium_static
 import geopandas as gpd
 import pandas as pd
 import leafmap.foliumap as leafmap
-from apps import sh_functions, variables
+from apps import sh_functions, variables, map_functions, map_cache_functions, trace_functions
 
 st.set_page_config(layout="wide")
+
+# Files the hub map is built from; a change to any of them renders it anew
+hub_map_sources = [
+    __file__, map_functions.__file__, r"data/vector/Pea_locations.gpkg",
+    r"data/vector/fs_catchment_boundaries.gpkg", r"data/vector/zambia_aoi.gpkg",
+]
+
+def build_hub_map(selected_region, selected_hub, selected_fs_catchment):
+    """Hub map for one filter state.
+
+    All basemaps are part of the map and switched in the browser, so the
+    vector layers are built once per filter state and never for a basemap change.
+    """
+    # Only the selected catchments are read
+    catchment_filters = {
+        column: value
+        for column, value in [("FE Region", selected_region), ("Hub Name", selected_hub), ("Name", selected_fs_catchment)]
+        if value != "All"
+    }
+    pea_locations = variables.get_pea_locations()
+    filtered_fs_catchment_area = variables.get_fs_catchment_boundaries(filters=catchment_filters)
+    zambia_boundaries = variables.get_zambia_boundaries()
+
+    # Set CRS for each GeoDataFrame (assuming WGS84)
+    pea_locations.crs = "EPSG:4326"
+    filtered_fs_catchment_area.crs = "EPSG:4326"
+    zambia_boundaries.crs = "EPSG:4326"
+
+    # Create the map
+    m = leafmap.Map(locate_control=True, draw_control=True, tiles=None)
+    map_functions.add_switchable_basemaps(m)
+
+    # Add Zambia Boundaries Layer
+    map_functions.add_gdf_layer(
+        m, zambia_boundaries, "Zambia Boundaries",
+        style={"color": "black", "weight": 1, "fillOpacity": 0},
+        tooltip_fields=["country"], tooltip_aliases=["Country:"],
+        display_level="National"
+    )
+
+    # Add fs catchment Layer
+    map_functions.add_gdf_layer(
+        m, filtered_fs_catchment_area, "Catchments",
+        style={"color": "blue", "weight": 2, "fillOpacity": 0},
+        tooltip_fields=["Name", "Hub Name", "FE Region", "FS", "RM"],
+        tooltip_aliases=["Catchment:", "Hub:", "Region:", "FS:", "RM:"],
+        display_level="Catchment"
+    )
+
+    # Add Pea Locations as Markers
+    map_functions.add_gdf_layer(
+        m, pea_locations, "Pea Locations",
+        style={"color": "green", "fillColor": "green", "fillOpacity": 1},
+        tooltip_fields=["pea", "fs", "hub", "region"],
+        tooltip_aliases=["Pea:", "FS:", "Hub:", "Region:"],
+        marker=folium.CircleMarker(radius=1, fill=True)
+    )
+
+    # zooming to bounds of filtered catchment areas
+    if not filtered_fs_catchment_area.empty:
+        bounds = filtered_fs_catchment_area.total_bounds  # [minx, miny, maxx, maxy]
+    else:
+        bounds = zambia_boundaries.total_bounds  # [minx, miny, maxx, maxy]
+    m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
+
+    return m
+
+@trace_functions.traced
+def get_hub_map_html(selected_region, selected_hub, selected_fs_catchment):
+    """Rendered hub map for one filter state, with its payload by layer kind."""
+    return map_cache_functions.get_cached_map_html(
+        "hb_app",
+        {'region': selected_region, 'hub': selected_hub, 'fs_catchment': selected_fs_catchment},
+        lambda: build_hub_map(selected_region, selected_hub, selected_fs_catchment),
+        hub_map_sources, basemap="OpenStreetMap",
+        )
+
+def get_hot_map_filters():
+    """Filter states opened most often: the whole country and each region."""
+    regions = sorted(variables.get_fs_catchment_attributes(["FE Region"])["FE Region"].dropna().unique())
+    return [
+        {'selected_region': selected_region, 'selected_hub': "All", 'selected_fs_catchment': "All"}
+        for selected_region in ["All"] + regions
+    ]
+
+@trace_functions.traced
 def app():
     """This function adds the app that dispace the pea lovation and fs catchment boundaries
     """
@@ -22,28 +107,13 @@ def app():
         # Start of hub definition tab
     with hub_definition_tab[0]:
             st.header("View latest hub definition") # Tab header
-    # define GIS layers
-    gdf5 = variables.get_pea_locations()
-    gdf6 = variables.get_fs_catchment_boundaries()
-    gdf7 = variables.get_zambia_boundaries()
-
-    # --------------------------
-    # Step 1: Load GIS layers
-    # --------------------------
-    pea_locations = gdf5
-    fs_catchment_boundaries = gdf6
-    zambia_boundaries = gdf7
+    # Catchment attributes drive the filters; the map layers are loaded by get_hub_map_html
+    fs_catchment_boundaries = variables.get_fs_catchment_attributes(["FE Region", "Hub Name", "Name"])
 
-
-# Set CRS for each GeoDataFrame (assuming WGS84)
-    pea_locations.crs = "EPSG:4326"
-    fs_catchment_boundaries.crs = "EPSG:4326"
-    zambia_boundaries.crs = "EPSG:4326"
-
-# Step 4: Create five columns for filters
+# Step 4: Create three columns for filters; the basemap is switched on the map
 # # --------------------------
 
-    col1, col2 ,col3 ,col4 = st.columns(4)
+    col1, col2 ,col3 = st.columns(3)
 
     with col1:
         region_options = ["All"] + sorted(fs_catchment_boundaries["FE Region"].unique())
@@ -62,106 +132,8 @@ def app():
         else:
             fs_catchment_options = ["All"] + sorted(fs_catchment_boundaries["Name"].unique())
         selected_fs_catchment = st.selectbox("Select FS Catchment", fs_catchment_options)
-    with col4:
-        # Basemap selection
-        basemap_options = {
-            "OpenStreetMap": "OpenStreetMap",
-            "Google Satellite": "SATELLITE",
-            "Google Hybrid": "HYBRID",
-            "CartoDB Dark": "CartoDB.DarkMatter",
-        }
-        selected_basemap = st.selectbox("Select Basemap", list(basemap_options.keys()))
-
-    # Step 5: Filter history
-# --------------------------
-    filtered_fs_catchment_area = fs_catchment_boundaries.copy()
-    if selected_region != "All":
-        filtered_fs_catchment_area = filtered_fs_catchment_area[filtered_fs_catchment_area["FE Region"] == selected_region]
-    if selected_hub != "All":
-        filtered_fs_catchment_area = filtered_fs_catchment_area[filtered_fs_catchment_area["Hub Name"] == selected_hub]
-    if selected_fs_catchment != "All":
-        filtered_fs_catchment_area = filtered_fs_catchment_area[filtered_fs_catchment_area["Name"] == selected_fs_catchment]
-
-# Step 6: Function to create the map
-# --------------------------
-    def create_map(basemap):
-        m = leafmap.Map(locate_control=True, draw_control=True)
-
-        m.add_basemap(basemap)
-        # Add Zambia Boundaries Layer
-        zambia_boundaries_layer = folium.FeatureGroup(name="Zambia Boundaries").add_to(m)
-        for _, z_row in zambia_boundaries.iterrows():
-            folium.GeoJson(
-                z_row['geometry'],
-                style_function=lambda x: {
-                    "color": "black",
-                    "weight": 1,
-                    "fillOpacity": 0
-                },
-                tooltip=f"<b>Country:</b> {z_row['country']}"
-            ).add_to(zambia_boundaries_layer)
-
-        # Add fs catchment Layer
-        fs_catchment_boundaries_layer = folium.FeatureGroup(name="Catchments").add_to(m)
-        for _, f_row in filtered_fs_catchment_area.iterrows():
-            folium.GeoJson(
-                f_row['geometry'],
-                style_function=lambda x: {
-                    "color": "blue",
-                    "weight": 2,
-                    "fillOpacity": 0
-                },
-                tooltip=f"<b>Catchment:</b> {f_row['Name']}<br>"
-                        f"<b>Hub:</b> {f_row['Hub Name']}<br>"
-                        f"<b>Region:</b> {f_row['FE Region']}<br>"
-                        f"<b>FS:</b> {f_row['FS']}<br>"
-                        f"<b>RM:</b> {f_row['RM']}"
-            ).add_to(fs_catchment_boundaries_layer)
-
-        # # Add Pea Locations Layer
-        # pea_locations_layer = folium.FeatureGroup(name="Pea_locations").add_to(m)
-        # for _, b_row in pea_locations.iterrows():
-        #     folium.GeoJson(
-        #         b_row['geometry'],
-        #         style_function=lambda x: {
-        #             "color": "blue",
-        #             "weight": 1,
-        #             "fillOpacity": 0.2
-        #         },
-        #         tooltip=f"<b>Pea:</b> {b_row['pea']}<br>"
-        #                 f"<b>FS:</b> {b_row['fs']}<br>"
-        #                 f"<b>Hub:</b> {b_row['hub']}<br>"
-        #                 f"<b>Region:</b> {b_row['region']}"
-        #     ).add_to(pea_locations_layer)
-
-        # Add Pea Locations as Markers
-        pea_locations_layer = folium.FeatureGroup(name="Pea Locations").add_to(m)
-        for _, p_row in pea_locations.iterrows():
-            folium.CircleMarker(
-                location=[p_row.geometry.y, p_row.geometry.x],
-                radius=1 ,
-                color="green",
-                fill=True,
-                fill_color="green",
-                fill_opacity=2,
-                tooltip=f"<b>Pea:</b> {p_row['pea']}<br>"
-                        f"<b>FS:</b> {p_row['fs']}<br>"
-                        f"<b>Hub:</b> {p_row['hub']}<br>"
-                        f"<b>Region:</b> {p_row['region']}"
-            ).add_to(pea_locations_layer)
-
-        return m
 
+# Step 5: Display the map
 # --------------------------
-# Step 7: Create and display the map
-# --------------------------
-    m = create_map(basemap_options[selected_basemap])
-# zooming to bounds of filtered catchment areas
-    if not filtered_fs_catchment_area.empty:
-        bounds = filtered_fs_catchment_area.total_bounds  # [minx, miny, maxx, maxy]
-        m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
-    else:
-        bounds = zambia_boundaries.total_bounds  # [minx, miny, maxx, maxy]
-        m.fit_bounds([[bounds[1], bounds[0]], [bounds[3], bounds[2]]])
-    
-    m.to_streamlit(width=1200, height=500)
\ No newline at end of file
+    map_html, map_payload = get_hub_map_html(selected_region, selected_hub, selected_fs_catchment)
+    map_functions.show_map_html("hb_app", map_html, map_payload, height=500, width=1200)
\ No newline at end of file
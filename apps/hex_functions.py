@@ -0,0 +1,222 @@
+import os
+import threading
+import folium
+import h3
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from branca.colormap import linear
+from branca.element import MacroElement, Template
+from apps import query_functions, trace_functions, variables
+
+# Field density is aggregated on the H3 hexagon grid at these resolutions,
+# with average cell areas of about 1770, 250, 36 and 5 km²
+hex_resolutions = [4, 5, 6, 7]
+
+# Map zoom from which each resolution is drawn, and from which the fields
+# themselves are drawn instead of the finest hexagons
+hex_resolution_zooms = {4: 0, 5: 7, 6: 9, 7: 11}
+hex_points_zoom = 13
+
+# Limits on what a hexagon map sends to the browser: finer resolutions are
+# left out beyond HEX_MAX_CELLS hexagons in total (about 250 bytes each), and
+# the fields are only sent for the high zoom levels up to HEX_MAX_POINTS fields
+# (about 900 bytes each with their tooltips)
+hex_max_cells = int(os.environ.get("HEX_MAX_CELLS", 6000))
+hex_max_points = int(os.environ.get("HEX_MAX_POINTS", 2000))
+
+# The sessions of a process update the index one at a time
+hex_index_lock = threading.Lock()
+
+def get_hex_index_path():
+    return variables.get_cache_path("hex", "field_cells.parquet")
+
+def get_hex_counts_path():
+    return variables.get_cache_path("hex", "field_hex_counts.parquet")
+
+def get_field_cells(fields):
+    """Table of the H3 cell of each field at every resolution."""
+    finest_resolution = max(hex_resolutions)
+    finest_cells = [
+        h3.latlng_to_cell(lat, lon, finest_resolution)
+        for lon, lat in zip(fields['lon'].to_pylist(), fields['lat'].to_pylist())
+    ]
+    cell_columns = {
+        f"cell_{resolution}": [h3.cell_to_parent(cell, resolution) for cell in finest_cells]
+        for resolution in hex_resolutions
+    }
+    return pa.table({**{column: fields[column] for column in fields.column_names}, **cell_columns})
+
+def write_parquet(table, parquet_path):
+    with variables.temp_write_path(parquet_path) as temp_path:
+        pq.write_table(table, temp_path)
+
+@trace_functions.traced
+def update_hex_index():
+    """Bring the H3 index of the fields up to date with the fields layer.
+
+    Only fields added or moved since the last update are indexed; fields no
+    longer in the layer are dropped. The counts of the unfiltered fields per
+    hexagon are precomputed whenever the index changes.
+    """
+    fields_parquet_path = query_functions.get_parquet_layer(query_functions.query_layers['fields'])
+    hex_index_path = get_hex_index_path()
+    with hex_index_lock:
+        if os.path.exists(hex_index_path) and os.path.getmtime(hex_index_path) >= os.path.getmtime(fields_parquet_path):
+            return hex_index_path
+
+        cursor = query_functions.get_cursor('fields')
+        located_fields = "SELECT field_id, lon, lat FROM fields WHERE isfinite(lon) AND isfinite(lat)"
+        if os.path.exists(hex_index_path):
+            escaped_index_path = hex_index_path.replace("'", "''")
+            cursor.execute(f"CREATE TEMP VIEW hex_index AS SELECT * FROM read_parquet('{escaped_index_path}')")
+            kept_cells = cursor.execute(
+                f"SELECT * FROM hex_index SEMI JOIN ({located_fields}) USING (field_id, lon, lat)"
+                ).to_arrow_table()
+            new_fields = cursor.execute(
+                f"SELECT * FROM ({located_fields}) ANTI JOIN hex_index USING (field_id, lon, lat)"
+                ).to_arrow_table()
+        else:
+            kept_cells = None
+            new_fields = cursor.execute(located_fields).to_arrow_table()
+
+        new_cells = get_field_cells(new_fields)
+        hex_index = new_cells if kept_cells is None else pa.concat_tables([kept_cells, new_cells.cast(kept_cells.schema)])
+        print(f"Indexed {new_cells.num_rows} new fields in H3 cells ({hex_index.num_rows} in total)")
+
+        cursor.register("updated_hex_index", hex_index)
+        hex_counts = cursor.execute(" UNION ALL ".join(
+            f"""SELECT {resolution} AS resolution, h.cell_{resolution} AS cell,
+                count(DISTINCT f.field_id) AS fields, count(DISTINCT f.farmer_id) AS farmers,
+                count(DISTINCT f.camp_id) AS camps
+            FROM fields f JOIN updated_hex_index h USING (field_id, lon, lat)
+            GROUP BY ALL"""
+            for resolution in hex_resolutions
+            )).to_arrow_table()
+
+        write_parquet(hex_counts, get_hex_counts_path())
+        write_parquet(hex_index, hex_index_path)
+    return hex_index_path
+
+@trace_functions.traced
+def get_hex_counts(filters, resolution):
+    """Fields, farmers and camps in each hexagon of a resolution, among the filtered fields."""
+    hex_index_path = update_hex_index().replace("'", "''")
+    cursor = query_functions.get_cursor('fields')
+
+    where, params = query_functions.get_field_filter(filters)
+    if not params:
+        hex_counts_path = get_hex_counts_path().replace("'", "''")
+        query = f"SELECT cell, fields, farmers, camps FROM read_parquet('{hex_counts_path}') WHERE resolution = ?"
+        return cursor.execute(query, [resolution]).df()
+
+    query = f"""
+        SELECT cell_{resolution} AS cell, count(DISTINCT field_id) AS fields,
+            count(DISTINCT farmer_id) AS farmers, count(DISTINCT camp_id) AS camps
+        FROM fields JOIN read_parquet('{hex_index_path}') USING (field_id, lon, lat)
+        {where}
+        GROUP BY cell
+    """
+    return cursor.execute(query, params).df()
+
+def get_hex_geojson(hex_counts):
+    """GeoJSON of hexagons coloured by their number of fields, on a log scale per layer."""
+    colormap = linear.YlOrRd_09.scale(0, np.log1p(hex_counts['fields'].max()))
+    features = []
+    for row in hex_counts.itertuples(index=False):
+        ring = [[round(lng, 5), round(lat, 5)] for lat, lng in h3.cell_to_boundary(row.cell)]
+        features.append({
+            'type': "Feature",
+            'geometry': {'type': "Polygon", 'coordinates': [ring + ring[:1]]},
+            'properties': {
+                'Fields': int(row.fields), 'Farmers': int(row.farmers), 'Camps': int(row.camps),
+                'color': colormap(np.log1p(row.fields)),
+            },
+        })
+    return {'type': "FeatureCollection", 'features': features}
+
+class ZoomLayers(MacroElement):
+    """Shows each layer only within its range of zoom levels, switching as the map zooms."""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var zoomLayers = [
+                {%- for layer, min_zoom, max_zoom in this.zoom_layers %}
+                [{{ layer.get_name() }}, {{ min_zoom }}, {{ max_zoom }}],
+                {%- endfor %}
+            ];
+            function showZoomLayers() {
+                var zoom = map.getZoom();
+                zoomLayers.forEach(function(zoomLayer) {
+                    var visible = zoom >= zoomLayer[1] && zoom < zoomLayer[2];
+                    if (visible && !map.hasLayer(zoomLayer[0])) { map.addLayer(zoomLayer[0]); }
+                    if (!visible && map.hasLayer(zoomLayer[0])) { map.removeLayer(zoomLayer[0]); }
+                });
+            }
+            map.on('zoomend', showZoomLayers);
+            showZoomLayers();
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, zoom_layers):
+        super().__init__()
+        self._name = "ZoomLayers"
+        self.zoom_layers = zoom_layers
+
+@trace_functions.traced
+def add_hex_layers(m, filters, points_layer=None):
+    """Add the filtered fields' hexagons to a map, coarsest at low zoom and finer as it zooms in.
+
+    `points_layer` (the fields themselves) replaces the finest hexagons from
+    `hex_points_zoom` on. The map is fitted to the hexagons; returns False if
+    no field is located.
+    """
+    hex_layers = []
+    cell_count = 0
+    for resolution in hex_resolutions:
+        hex_counts = get_hex_counts(filters, resolution)
+        if hex_counts.empty or (hex_layers and cell_count + len(hex_counts) > hex_max_cells):
+            break
+        cell_count += len(hex_counts)
+
+        hex_layer = folium.GeoJson(
+            get_hex_geojson(hex_counts),
+            name=f"Field density (H3 resolution {resolution})",
+            style_function=lambda feature: {
+                'fillColor': feature['properties']['color'], 'fillOpacity': 0.6,
+                'color': "#ffffff", 'weight': 0.5, 'opacity': 0.6,
+            },
+            tooltip=folium.GeoJsonTooltip(fields=['Fields', 'Farmers', 'Camps']),
+            control=False,
+        )
+        hex_layer.add_to(m)
+        hex_layers.append((hex_layer, hex_resolution_zooms[resolution]))
+
+    if not hex_layers:
+        return False
+
+    # Fitted before the layers are first switched, so they match the initial zoom
+    coarsest_features = hex_layers[0][0].data['features']
+    coordinates = np.array([
+        coordinate for feature in coarsest_features for coordinate in feature['geometry']['coordinates'][0]
+    ])
+    m.fit_bounds([[coordinates[:, 1].min(), coordinates[:, 0].min()], [coordinates[:, 1].max(), coordinates[:, 0].max()]])
+
+    # Each resolution is drawn until the next one takes over
+    finest_max_zoom = hex_points_zoom if points_layer is not None else 99
+    max_zooms = [min_zoom for _, min_zoom in hex_layers[1:]] + [finest_max_zoom]
+    zoom_layers = [
+        (hex_layer, min_zoom, max_zoom) for (hex_layer, min_zoom), max_zoom in zip(hex_layers, max_zooms)
+    ]
+    if points_layer is not None:
+        points_layer.add_to(m)
+        zoom_layers.append((points_layer, hex_points_zoom, 99))
+    m.add_child(ZoomLayers(zoom_layers))
+    return True
+
+if __name__ == "__main__":
+    # Index the fields ahead of the app processes:
+    # python -m apps.hex_functions
+    update_hex_index()
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+from importlib import metadata
+import pyarrow as pa
+import streamlit as st
+import streamlit.components.v1 as components
+from apps import trace_functions, variables
+
+# Maps drawn with WebGL by kepler.gl (deck.gl layers) in the browser rather
+# than as folium's SVG markers, for point and polygon sets too large for those.
+# The kepler.gl bundle (about 11 MB) is served once as a component that the
+# browser keeps, and each map only sends its data, as Arrow, and its config.
+kepler_component_dir = os.path.join(variables.cache_dir, "kepler")
+
+# Renderers offered by the pages' map renderer selectors
+map_renderers = ["Folium", "WebGL (kepler.gl)"]
+
+# Basemap of the WebGL maps, as the folium maps' CartoDB dark_matter
+kepler_map_style = "dark-matter"
+
+# Runs in the component's page: waits for the map's data and config from the
+# app, then loads the bundle, which reads them from window.__keplerglDataConfig
+# as in the page keplergl writes for notebooks
+kepler_loader_script = """
+(function() {
+    var mapId = null;
+    function toBase64(bytes) {
+        var chunks = [];
+        for (var i = 0; i < bytes.length; i += 0x8000) {
+            chunks.push(String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000)));
+        }
+        return btoa(chunks.join(""));
+    }
+    window.addEventListener("message", function(event) {
+        if (event.data.type !== "streamlit:render") { return; }
+        var args = event.data.args;
+        if (mapId !== null) {
+            // kepler.gl only reads its data when it loads, so another map loads the page anew
+            if (args.map_id !== mapId) { window.location.reload(); }
+            return;
+        }
+        mapId = args.map_id;
+        var data = {};
+        args.dataset_ids.forEach(function(datasetId, i) {
+            data[datasetId] = toBase64(args["dataset_" + i]);
+        });
+        window.__keplerglDataConfig = {
+            data: data, config: args.config, options: {readOnly: args.read_only, centerMap: true}
+        };
+        window.parent.postMessage({isStreamlitMessage: true, type: "streamlit:setFrameHeight", height: args.height}, "*");
+        var bundle = document.createElement("script");
+        bundle.src = "BUNDLE_NAME";
+        document.body.appendChild(bundle);
+    });
+    window.parent.postMessage({isStreamlitMessage: true, type: "streamlit:componentReady", apiVersion: 1}, "*");
+})();
+"""
+
+def write_component_file(file_name, content):
+    with variables.temp_write_path(os.path.join(kepler_component_dir, file_name)) as temp_path:
+        with open(temp_path, "w", encoding="utf-8") as temp_file:
+            temp_file.write(content)
+
+def write_kepler_component():
+    """Split the page keplergl ships into the component's page and its bundle, named by version."""
+    keplergl = metadata.distribution("keplergl")
+    keplergl_html = keplergl.locate_file("keplergl/static/keplergl.html").read_text(encoding="utf-8")
+    head, _, body = keplergl_html.partition("<body>")
+
+    # A script in a page cannot hold a closing script tag, so the bundle is
+    # the body's last script; the analytics script before it is left out
+    bundle = body.split("</script>")[-2].partition("<script>")[2]
+    bundle_name = f"keplergl-{keplergl.version}.js"
+
+    os.makedirs(kepler_component_dir, exist_ok=True)
+    if not os.path.exists(os.path.join(kepler_component_dir, bundle_name)):
+        write_component_file(bundle_name, bundle)
+    loader_script = kepler_loader_script.replace("BUNDLE_NAME", bundle_name)
+    write_component_file("index.html", f"{head}<body><script>{loader_script}</script></body></html>")
+
+@st.cache_resource(show_spinner=False)
+def get_kepler_component():
+    write_kepler_component()
+    return components.declare_component("kepler_map", path=kepler_component_dir)
+
+def select_map_renderer(key):
+    """Map renderer selector of a page; returns whether its maps are drawn with WebGL."""
+    map_renderer = st.radio(
+        "Map renderer", map_renderers, index=0, key=key, horizontal=True,
+        help="WebGL draws hundreds of thousands of fields smoothly; imagery layers need Folium",
+    )
+    return map_renderer == map_renderers[1]
+
+def get_arrow_bytes(table):
+    """Arrow IPC stream of a table, as kepler.gl reads it."""
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def get_gdf_table(gdf, columns):
+    """Arrow table of some columns of a GeoDataFrame, with its geometry in lon/lat as GeoArrow."""
+    layer_gdf = gdf[list(columns) + [gdf.geometry.name]].to_crs(epsg=4326)
+    return pa.table(layer_gdf.to_arrow(geometry_encoding="geoarrow", interleaved=True, index=False))
+
+def to_rgb(hex_color):
+    return [int(hex_color[i:i + 2], 16) for i in (1, 3, 5)]
+
+def get_color_range(colors):
+    """Colour range mapping each value (as a string) to its colour, e.g. from sh_functions.get_colors."""
+    color_map = [[str(value), color] for value, color in colors.items() if value is not None and value == value]
+    return {
+        'name': "Custom", 'type': "custom", 'category': "Custom",
+        'colors': [color for _, color in color_map], 'colorMap': color_map,
+    }
+
+def get_point_layer(dataset_id, label, color="#ffffff", color_column=None, colors=None, radius=2):
+    """Point layer of a dataset's lon and lat columns, coloured by the string `color_column` with `colors`."""
+    layer = {
+        'id': dataset_id, 'type': "point",
+        'config': {
+            'dataId': dataset_id, 'label': label, 'color': to_rgb(color), 'isVisible': True,
+            'columnMode': "points", 'columns': {'lat': "lat", 'lng': "lon", 'altitude': None},
+            'visConfig': {'radius': radius, 'opacity': 0.8, 'filled': True},
+        },
+        'visualChannels': {},
+    }
+    if color_column is not None:
+        layer['config']['visConfig']['colorRange'] = get_color_range(colors)
+        layer['visualChannels'] = {
+            'colorField': {'name': color_column, 'type': "string"}, 'colorScale': "ordinal",
+        }
+    return layer
+
+def get_polygon_layer(dataset_id, label, color="#3388ff", thickness=2):
+    """Outline layer of a dataset's GeoArrow geometry column."""
+    return {
+        'id': dataset_id, 'type': "geojson",
+        'config': {
+            'dataId': dataset_id, 'label': label, 'color': to_rgb(color), 'strokeColor': to_rgb(color),
+            'isVisible': True, 'columnMode': "geojson", 'columns': {'geojson': "geometry"},
+            'visConfig': {'opacity': 1, 'thickness': thickness, 'stroked': True, 'filled': False},
+        },
+        'visualChannels': {},
+    }
+
+def get_map_config(layers, tooltip_fields):
+    """kepler.gl map config of layers, with the tooltip columns of each dataset."""
+    return {
+        'version': "v1",
+        'config': {
+            'visState': {
+                'layers': layers,
+                'interactionConfig': {
+                    'tooltip': {
+                        'enabled': True,
+                        'fieldsToShow': {
+                            dataset_id: [{'name': column, 'format': None} for column in columns]
+                            for dataset_id, columns in tooltip_fields.items()
+                        },
+                    },
+                },
+            },
+            'mapStyle': {'styleType': kepler_map_style},
+        },
+    }
+
+def show_kepler_map(name, datasets, config, height=550, read_only=False):
+    """Draw Arrow tables (by dataset id) with a kepler.gl config, recording the data sent in the trace."""
+    with trace_functions.span(f"{name}.show_kepler_map") as current_span:
+        dataset_args = {
+            f"dataset_{i}": get_arrow_bytes(table) for i, table in enumerate(datasets.values())
+        }
+        map_hash = hashlib.sha1(json.dumps(config, sort_keys=True).encode())
+        for dataset_bytes in dataset_args.values():
+            map_hash.update(dataset_bytes)
+
+        current_span['bytes'] = sum(len(dataset_bytes) for dataset_bytes in dataset_args.values())
+        current_span['rows'] = sum(table.num_rows for table in datasets.values())
+        get_kepler_component()(
+            map_id=map_hash.hexdigest(), dataset_ids=list(datasets), config=config,
+            height=height, read_only=read_only, key=f"{name}_kepler_map", default=None,
+            **dataset_args,
+        )
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import streamlit as st
+from apps import map_functions, trace_functions, variables
+
+# Rendered maps of a page are the same for every user with the same filter
+# selections, so their HTML is kept on disk and shared by all sessions and
+# processes. The least recently used maps are removed beyond the size limit.
+map_cache_dir = os.path.join(variables.cache_dir, "maps")
+map_cache_max_mb = float(os.environ.get("MAP_CACHE_MAX_MB", 1024))
+
+# Set MAP_CACHE_PREWARM=0 to skip rendering the hot states at startup
+prewarm_enabled = os.environ.get("MAP_CACHE_PREWARM", "1") != "0"
+
+# Filters whose zero value is no selection, e.g. an empty Farmer ID box (0.0),
+# as the field queries read it
+zero_unselected_filters = {"selected_farmer_id"}
+
+def normalize_filters(filters):
+    """Filter selections in one form for every page: no selection is "All", numbers are plain Python."""
+    normalized_filters = {}
+    for filter_name, value in sorted(filters.items()):
+        if value is None or value == "" or value == "All" or (filter_name in zero_unselected_filters and not value):
+            value = "All"
+        elif isinstance(value, np.generic):
+            value = value.item()
+        normalized_filters[filter_name] = value
+    return normalized_filters
+
+def get_data_version(source_paths):
+    """Version of the files a map is built from, changing whenever one of them does."""
+    file_stats = []
+    for source_path in source_paths:
+        stat = os.stat(source_path)
+        file_stats.append([os.path.abspath(source_path), stat.st_mtime_ns, stat.st_size])
+    return hashlib.sha1(json.dumps(file_stats).encode()).hexdigest()[:16]
+
+def get_map_cache_key(page, filters, basemap, source_paths):
+    key_parts = {
+        'page': page,
+        'filters': normalize_filters(filters),
+        'basemap': basemap,
+        'data_version': get_data_version(source_paths),
+    }
+    return hashlib.sha1(json.dumps(key_parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_map_cache_paths(cache_key):
+    return os.path.join(map_cache_dir, f"{cache_key}.html"), os.path.join(map_cache_dir, f"{cache_key}.json")
+
+def read_cached_map(cache_key):
+    """Rendered map and payload of a cache entry, or None if it is missing."""
+    html_path, payload_path = get_map_cache_paths(cache_key)
+    try:
+        with open(payload_path) as payload_file:
+            payload = json.load(payload_file)
+        with open(html_path, encoding="utf-8") as html_file:
+            map_html = html_file.read()
+        # The entry's modification time is its last use
+        os.utime(html_path)
+    except (OSError, ValueError):
+        # Missing, or removed by another process in between
+        return None
+    return map_html, payload
+
+def write_cached_map(cache_key, map_html, payload):
+    os.makedirs(map_cache_dir, exist_ok=True)
+    html_path, payload_path = get_map_cache_paths(cache_key)
+
+    # The payload file is written last and marks the entry as complete
+    for path, content in ((html_path, map_html), (payload_path, json.dumps(payload))):
+        with variables.temp_write_path(path) as temp_path:
+            with open(temp_path, "w", encoding="utf-8") as temp_file:
+                temp_file.write(content)
+
+    evict_cached_maps()
+
+def evict_cached_maps():
+    """Remove the least recently used maps until the cache is within its size limit."""
+    entries = []
+    for file_name in os.listdir(map_cache_dir):
+        if not file_name.endswith(".html"):
+            continue
+        html_path = os.path.join(map_cache_dir, file_name)
+        try:
+            stat = os.stat(html_path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, file_name[:-len(".html")]))
+
+    cache_size = sum(size for _, size, _ in entries)
+    for _, size, cache_key in sorted(entries):
+        if cache_size <= map_cache_max_mb * 1024 ** 2:
+            break
+        for path in get_map_cache_paths(cache_key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        cache_size -= size
+
+def clear_map_cache():
+    if os.path.exists(map_cache_dir):
+        for file_name in os.listdir(map_cache_dir):
+            os.remove(os.path.join(map_cache_dir, file_name))
+
+def get_cached_map_html(page, filters, build_map, source_paths, basemap=None):
+    """Rendered map and payload for a page's filter state.
+
+    `build_map` makes the folium map when the state is not cached yet;
+    `source_paths` are the data and code files the map is built from.
+    """
+    cache_key = get_map_cache_key(page, filters, basemap, source_paths)
+    with trace_functions.span(f"{page}.cached_map") as current_span:
+        cached_map = read_cached_map(cache_key)
+        current_span['cache'] = "miss" if cached_map is None else "hit"
+    if cached_map is not None:
+        return cached_map
+
+    map_html, payload = map_functions.render_map(build_map())
+    write_cached_map(cache_key, map_html, payload)
+    return map_html, payload
+
+def prewarm_page_maps(page, hot_filters, get_map_html):
+    """Render the hot filter states of a page into the cache, skipping failed states."""
+    for filters in hot_filters():
+        try:
+            get_map_html(**filters)
+        except Exception as e:
+            print(f"Could not prewarm the {page} map for {filters}: {e}")
+
+@st.cache_resource(show_spinner=False)
+def prewarm_map_cache(_pages):
+    """Render the hot states of the pages' maps in the background, once per process.
+
+    `_pages` maps each page name to its (hot_filters, get_map_html) functions.
+    A single worker renders them one after the other, leaving the background
+    task workers to the sessions.
+    """
+    if not prewarm_enabled:
+        return []
+    prewarm_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="map_prewarm")
+    prewarm_tasks = [
+        prewarm_executor.submit(prewarm_page_maps, page, hot_filters, get_map_html)
+        for page, (hot_filters, get_map_html) in _pages.items()
+    ]
+    prewarm_executor.shutdown(wait=False)
+    return prewarm_tasks
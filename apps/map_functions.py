@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import streamlit as st
+import streamlit.components.v1 as components
+import folium
+import folium.plugins
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from branca.colormap import ColorMap
+from branca.element import MacroElement
+from apps import aoi_functions, trace_functions
+
+# Basemaps sent together with each map and switched in the browser's layer
+# control, so changing the basemap needs no rerun
+basemap_tiles = {
+    "OpenStreetMap": ("https://tile.openstreetmap.org/{z}/{x}/{y}.png", "&copy; OpenStreetMap contributors"),
+    "Google Satellite": ("https://mt1.google.com/vt/lyrs=s&x={x}&y={y}&z={z}", "Google"),
+    "Google Hybrid": ("https://mt1.google.com/vt/lyrs=y&x={x}&y={y}&z={z}", "Google"),
+    "CartoDB Dark": ("https://a.basemaps.cartocdn.com/dark_all/{z}/{x}/{y}.png", "&copy; OpenStreetMap contributors &copy; CARTO"),
+}
+
+# Simplification tolerance (metres) for static boundary layers at each display
+# level, and the decimals kept in their coordinates (5 decimals is ~1 m)
+display_levels = {
+    "National": 250,
+    "Catchment": 25,
+}
+display_coordinate_precision = 5
+
+# Rendered map size (the HTML sent to the browser on every rerun) above which
+# a warning is printed; set MAP_PAYLOAD_BUDGET_KB to change it
+map_payload_budget_kb = float(os.environ.get("MAP_PAYLOAD_BUDGET_KB", 2048))
+
+# Payload categories of map elements; elements nested in a layer (popups,
+# tooltips, icons) count towards that layer
+map_layer_kinds = {
+    'markers': (folium.Marker, folium.CircleMarker, folium.Circle, folium.plugins.MarkerCluster),
+    'geojson': (folium.GeoJson, folium.TopoJson, folium.Choropleth),
+    'tiles': (folium.TileLayer, folium.WmsTileLayer, folium.raster_layers.ImageOverlay),
+    'legends': (ColorMap,),
+}
+
+def get_layer_gdf(gdf, property_cols):
+    """Keep only the properties a layer needs, as JSON-safe strings."""
+    layer_gdf = gdf[list(dict.fromkeys(property_cols)) + ["geometry"]].copy()
+    for col in property_cols:
+        layer_gdf[col] = layer_gdf[col].apply(lambda value: None if pd.isna(value) else str(value))
+    return layer_gdf
+
+def get_layer_key(layer_gdf):
+    """Digest of a layer's geometry, CRS and properties, used as a cache key."""
+    digest = hashlib.sha1(aoi_functions.get_gdf_key(layer_gdf).encode())
+    properties = layer_gdf.drop(columns=layer_gdf.geometry.name)
+    digest.update(json.dumps(list(properties.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(properties, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def simplify_boundaries(geometries, tolerance):
+    """Simplify polygons, keeping borders shared by neighbouring polygons identical."""
+    # Coverage simplification (shapely >= 2.1) simplifies each shared border
+    # once, so neighbouring catchments never show gaps or overlaps
+    if hasattr(shapely, "coverage_simplify") and shapely.coverage_is_valid(geometries):
+        return shapely.coverage_simplify(geometries, tolerance)
+    return shapely.simplify(geometries, tolerance, preserve_topology=True)
+
+# Layers are cached by their properties as well, so edited names and
+# attributes show in their tooltips
+@st.cache_data(hash_funcs={gpd.GeoDataFrame: get_layer_key}, persist="disk", show_spinner=False)
+def get_compact_geojson(layer_gdf, display_level):
+    """GeoJSON of a static boundary layer (from get_layer_gdf), simplified for a display level with fixed-precision coordinates."""
+    # Simplify in metres rather than degrees
+    metric_crs = layer_gdf.estimate_utm_crs()
+    geometries = layer_gdf.geometry.to_crs(metric_crs).values
+    simplified = simplify_boundaries(geometries, display_levels[display_level])
+
+    # Keep the original geometry where simplification collapsed a small polygon
+    simplified = gpd.GeoSeries(simplified, crs=metric_crs).to_crs(epsg=4326).values
+    collapsed = shapely.is_empty(simplified)
+    simplified[collapsed] = layer_gdf.geometry.to_crs(epsg=4326).values[collapsed]
+
+    layer_gdf = layer_gdf.set_geometry(
+        shapely.transform(simplified, lambda coords: np.round(coords, display_coordinate_precision)),
+        crs="EPSG:4326"
+    )
+    return json.loads(layer_gdf.to_json(drop_id=True))
+
+def add_gdf_layer(m, gdf, name, style, tooltip_fields, tooltip_aliases=None,
+                  color_col=None, marker=None, show=True, display_level=None):
+    """Add a whole GeoDataFrame to a map as a single GeoJSON layer.
+
+    Styles come from `style`, with the line colour optionally taken from the
+    `color_col` property of each feature; tooltips are built client-side from
+    `tooltip_fields`. Point layers are drawn with `marker` (e.g. a CircleMarker).
+    Static boundary layers can be sent in compact form by giving a `display_level`.
+    """
+    property_cols = tooltip_fields + ([color_col] if color_col else [])
+    if display_level is None:
+        layer_gdf = get_layer_gdf(gdf, property_cols)
+    else:
+        layer_gdf = get_compact_geojson(get_layer_gdf(gdf, property_cols), display_level)
+
+    def style_function(feature):
+        feature_style = dict(style)
+        if color_col:
+            feature_style["color"] = feature["properties"][color_col]
+        return feature_style
+
+    folium.GeoJson(
+        layer_gdf,
+        name=name,
+        style_function=style_function,
+        tooltip=folium.GeoJsonTooltip(
+            fields=tooltip_fields,
+            aliases=tooltip_aliases or tooltip_fields,
+        ),
+        marker=marker,
+        show=show,
+    ).add_to(m)
+    return m
+
+def add_switchable_basemaps(m, default_basemap="OpenStreetMap"):
+    """Register every basemap as a base layer, showing `default_basemap` first."""
+    for basemap_name, (tiles, attribution) in basemap_tiles.items():
+        folium.TileLayer(
+            tiles=tiles,
+            attr=attribution,
+            name=basemap_name,
+            max_zoom=22,
+            overlay=False,
+            control=True,
+            show=basemap_name == default_basemap,
+        ).add_to(m)
+    return m
+
+def get_layer_kind(element):
+    """Payload category of a map element, or None if it has none of its own."""
+    for layer_kind, layer_types in map_layer_kinds.items():
+        if isinstance(element, layer_types):
+            return layer_kind
+    # Legends and colorbars are plain macros holding their own template
+    if type(element) is MacroElement:
+        return 'legends'
+    return None
+
+def get_element_kinds(element, parent_kind='other'):
+    """Payload category of every element below `element`, by element name."""
+    element_kinds = {}
+    for child in element._children.values():
+        child_kind = get_layer_kind(child) or parent_kind
+        element_kinds[child.get_name()] = child_kind
+        element_kinds.update(get_element_kinds(child, child_kind))
+    return element_kinds
+
+def render_map(m):
+    """HTML of a map as sent to the browser, and its size in bytes by layer kind."""
+    # Leafmap maps get their layer control when rendered, as in to_streamlit
+    if hasattr(m, "add_layer_control"):
+        m.add_layer_control()
+
+    figure = m.get_root()
+    map_html = figure.render()
+
+    # Rendering leaves each element's header, html and script parts in the
+    # figure under the element's name
+    element_kinds = get_element_kinds(figure)
+    payload = dict.fromkeys(['markers', 'geojson', 'legends', 'tiles', 'other'], 0)
+    for section in (figure.header, figure.html, figure.script):
+        for element_name, rendered_element in section._children.items():
+            layer_kind = element_kinds.get(element_name, 'other')
+            payload[layer_kind] += len((rendered_element._template_str or "").encode())
+
+    payload['total'] = len(map_html.encode())
+    payload['other'] = payload['total'] - sum(payload[layer_kind] for layer_kind in map_layer_kinds)
+    return map_html, payload
+
+def check_map_payload(name, payload):
+    """Warn when a map exceeds the payload budget; returns whether it fits."""
+    total_kb = payload['total'] / 1024
+    if total_kb <= map_payload_budget_kb:
+        return True
+
+    largest = ", ".join(
+        f"{layer_kind} {payload[layer_kind] / 1024:.0f} KB"
+        for layer_kind in sorted(map_layer_kinds, key=payload.get, reverse=True)
+        if payload[layer_kind]
+    )
+    print(f"Map {name} is {total_kb:.0f} KB, over the {map_payload_budget_kb:.0f} KB budget ({largest})")
+    return False
+
+def show_map_html(name, map_html, payload, height=550, width=None):
+    """Show a rendered map, recording its payload by layer kind in the trace."""
+    with trace_functions.span(f"{name}.show_map") as current_span:
+        current_span['bytes'] = payload['total']
+        current_span['layers'] = payload
+        check_map_payload(name, payload)
+        components.html(map_html, width=width, height=height)
+
+def show_map(m, name, height=550, width=None):
+    """Render a folium or leafmap map into the page (replaces to_streamlit and folium_static)."""
+    with trace_functions.span(f"{name}.render_map"):
+        map_html, payload = render_map(m)
+    show_map_html(name, map_html, payload, height=height, width=width)
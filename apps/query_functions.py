@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+import duckdb
+import geopandas as gpd
+import pyarrow.parquet as pq
+import shapely
+import streamlit as st
+from apps import trace_functions, variables
+
+# Attribute queries over the vector layers (selector options, scorecards,
+# chart counts) run in an embedded DuckDB database against GeoParquet copies
+# of the layers, written once per file version, so filtering and aggregating
+# never loads a layer into a GeoDataFrame. Each query is parallelised over
+# QUERY_THREADS threads (all cores by default).
+query_threads = int(os.environ.get("QUERY_THREADS", os.cpu_count() or 1))
+
+# Layers that can be queried, by the view name queries use for them
+query_layers = {
+    'fields': r"data/vector/field_measure_farms.gpkg",
+    'farms': r"data/vector/ce_farms.gpkg",
+    'catchments': r"data/vector/fs_catchment_boundaries.gpkg",
+}
+
+# Field filter selections of the Small Holder page and the columns they select on
+field_filter_columns = {
+    'selected_region': 'region', 'selected_district': 'district', 'selected_hub': 'hub',
+    'selected_camp': 'camp', 'selected_fs': 'fs', 'selected_pea': 'pea',
+    'selected_farmer_id': 'farmer_id',
+}
+
+# The sessions of a process check and write the GeoParquet copies one at a time
+parquet_lock = threading.Lock()
+
+def get_parquet_path(vector_path):
+    file_name = os.path.splitext(os.path.basename(vector_path))[0]
+    return variables.get_cache_path("parquet", f"{file_name}.parquet")
+
+def write_parquet_layer(vector_path, parquet_path):
+    """Write a vector layer to GeoParquet, with the coordinates of point layers as lon and lat columns."""
+    gdf = gpd.read_file(vector_path)
+    if not gdf.empty and (gdf.geom_type == "Point").all():
+        gdf['lon'] = gdf.geometry.x
+        gdf['lat'] = gdf.geometry.y
+
+    with variables.temp_write_path(parquet_path) as temp_path:
+        gdf.to_parquet(temp_path, index=False)
+
+def get_parquet_layer(vector_path):
+    """Path of the GeoParquet copy of a layer, written anew when the layer has changed."""
+    parquet_path = get_parquet_path(vector_path)
+    with parquet_lock:
+        if not os.path.exists(parquet_path) or os.path.getmtime(parquet_path) < os.path.getmtime(vector_path):
+            write_parquet_layer(vector_path, parquet_path)
+    return parquet_path
+
+@st.cache_resource(show_spinner=False)
+def get_connection():
+    """In-memory DuckDB database, shared by the sessions of the process."""
+    return duckdb.connect(config={'threads': query_threads})
+
+def get_cursor(*layer_names):
+    """Connection of one query to the shared database, with a view of each layer it reads.
+
+    A connection is not safe to use from several threads, so each query uses its own.
+    """
+    cursor = get_connection().cursor()
+    for layer_name in layer_names:
+        parquet_path = get_parquet_layer(query_layers[layer_name]).replace("'", "''")
+        cursor.execute(
+            f"CREATE TEMP VIEW {layer_name} AS SELECT * FROM read_parquet('{parquet_path}', file_row_number = true)"
+            )
+    return cursor
+
+def to_gdf(table, layer_name):
+    """GeoDataFrame of an Arrow table of query results holding the WKB geometry column of a layer."""
+    geo_metadata = json.loads(pq.read_schema(get_parquet_path(query_layers[layer_name])).metadata[b"geo"])
+    crs = geo_metadata['columns']['geometry'].get('crs', "OGC:CRS84")
+    geometry = gpd.GeoSeries.from_wkb(table['geometry'].to_numpy(zero_copy_only=False), crs=crs)
+    return gpd.GeoDataFrame(table.drop_columns(['geometry']).to_pandas(), geometry=geometry)
+
+@trace_functions.traced
+def run_query(query, params=None, layer_names=None):
+    """DataFrame of an ad-hoc query over the views of `layer_names`, by default of every layer present.
+
+    For example, the fields per camp of each FS:
+    run_query("SELECT fs, camp, count(DISTINCT field_id) AS fields FROM fields GROUP BY ALL")
+    """
+    if layer_names is None:
+        layer_names = [layer_name for layer_name, vector_path in query_layers.items() if os.path.exists(vector_path)]
+    return get_cursor(*layer_names).execute(query, params).df()
+
+def get_field_filter(filters, conditions=()):
+    """WHERE clause and parameters of field filter selections; empty selections select all fields."""
+    conditions = list(conditions)
+    params = []
+    for filter_name, column in field_filter_columns.items():
+        value = filters.get(filter_name)
+        if value:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return where, params
+
+@trace_functions.traced
+def get_field_options(column, filters):
+    """Sorted distinct values of a column among the filtered fields, for a selector."""
+    where, params = get_field_filter(filters, [f"{column} IS NOT NULL"])
+    query = f"SELECT DISTINCT {column} FROM fields {where} ORDER BY {column}"
+    return [value for value, in get_cursor('fields').execute(query, params).fetchall()]
+
+@trace_functions.traced
+def get_field_values(column, filters):
+    """Distinct values of a column among the filtered fields, in the order they first appear in the layer."""
+    where, params = get_field_filter(filters)
+    query = f"SELECT {column} FROM fields {where} GROUP BY {column} ORDER BY min(file_row_number)"
+    return get_cursor('fields').execute(query, params).df()[column].tolist()
+
+@trace_functions.traced
+def get_field_metrics(filters):
+    """Number of distinct regions, districts, hubs, camps, FSs, PEAs and fields among the filtered fields."""
+    where, params = get_field_filter(filters)
+    query = f"""
+        SELECT
+            count(DISTINCT region_id) AS regions, count(DISTINCT district_id) AS districts,
+            count(DISTINCT hub) AS hubs, count(DISTINCT camp_id) AS camps, count(DISTINCT fs_id) AS fss,
+            count(DISTINCT pea_id) AS peas, count(DISTINCT field_id) AS fields
+        FROM fields {where}
+    """
+    cursor = get_cursor('fields').execute(query, params)
+    metric_names = [column[0] for column in cursor.description]
+    return dict(zip(metric_names, cursor.fetchone()))
+
+@trace_functions.traced
+def get_field_counts(filters, group_columns, count_column, sort_column):
+    """Distinct `count_column` values per group of the filtered fields, as a `count` column.
+
+    Groups with a missing key are left out. Rows are ordered by count, largest
+    first, then by `sort_column` and the group columns.
+    """
+    query, params = get_field_counts_query(filters, group_columns, count_column, sort_column)
+    return get_cursor('fields').execute(query, params).df()
+
+def get_field_counts_query(filters, group_columns, count_column, sort_column, percentage=False):
+    """Query and parameters of get_field_counts, optionally with each group's `percentage` of the total."""
+    group_by = ", ".join(group_columns)
+    where, params = get_field_filter(filters, [f"{column} IS NOT NULL" for column in group_columns])
+    percentage_column = ", round(100 * count / sum(count) OVER (), 1) AS percentage" if percentage else ""
+    query = f"""
+        SELECT {group_by}, count(DISTINCT {count_column}) AS count{percentage_column}
+        FROM fields {where}
+        GROUP BY {group_by}
+        ORDER BY count DESC, {sort_column}, {group_by}
+    """
+    return query, params
+
+def get_field_counts_batches(filters, group_columns, count_column, sort_column, batch_rows):
+    """Field counts as get_field_counts, with their percentage, read as DataFrames of `batch_rows` rows."""
+    query, params = get_field_counts_query(filters, group_columns, count_column, sort_column, percentage=True)
+    # The cursor is kept until the last batch is read
+    cursor = get_cursor('fields')
+    for batch in cursor.execute(query, params).fetch_record_batch(batch_rows):
+        yield batch.to_pandas()
+
+@trace_functions.traced
+def get_fields_gdf(filters):
+    """GeoDataFrame of the filtered fields, with their lon and lat."""
+    where, params = get_field_filter(filters)
+    query = f"SELECT * EXCLUDE (file_row_number) FROM fields {where}"
+    return to_gdf(get_cursor('fields').execute(query, params).to_arrow_table(), 'fields')
+
+@trace_functions.traced
+def get_fields_table(filters, columns):
+    """Arrow table of columns (or SQL expressions) of the filtered fields, without their geometry."""
+    where, params = get_field_filter(filters)
+    query = f"SELECT {', '.join(columns)} FROM fields {where}"
+    return get_cursor('fields').execute(query, params).to_arrow_table()
+
+@trace_functions.traced
+def get_fields_within(polygon):
+    """GeoDataFrame of the fields within a polygon given in lon/lat.
+
+    Fields in the polygon's bounding box are selected in the query, and only
+    those are tested against the polygon itself.
+    """
+    minx, miny, maxx, maxy = polygon.bounds
+    table = get_cursor('fields').execute(
+        "SELECT * EXCLUDE (file_row_number) FROM fields WHERE lon BETWEEN ? AND ? AND lat BETWEEN ? AND ?",
+        [minx, maxx, miny, maxy],
+        ).to_arrow_table()
+    within = shapely.contains_xy(polygon, table['lon'].to_numpy(), table['lat'].to_numpy())
+    return to_gdf(table.filter(within), 'fields')
+
+@trace_functions.traced
+def get_catchment_field_counts(catchment_name, group_columns=("camp", "fs")):
+    """Fields per group (by default per camp and FS) within an FS catchment, largest groups first."""
+    catchment = get_cursor('catchments').execute(
+        "SELECT geometry FROM catchments WHERE Name = ?", [catchment_name]
+        ).to_arrow_table()
+    if catchment.num_rows == 0:
+        return None
+    polygon = shapely.union_all(shapely.from_wkb(catchment['geometry'].to_numpy(zero_copy_only=False)))
+    fields = get_fields_within(polygon)
+    return (
+        fields.groupby(list(group_columns))['field_id'].nunique()
+        .rename("fields").reset_index()
+        .sort_values("fields", ascending=False, kind="stable").reset_index(drop=True)
+    )
+
+if __name__ == "__main__":
+    # Write the GeoParquet files before starting the app processes:
+    # python -m apps.query_functions
+    for layer_name, vector_path in query_layers.items():
+        if os.path.exists(vector_path):
+            print(f"Writing {vector_path} to GeoParquet...")
+            write_parquet_layer(vector_path, get_parquet_path(vector_path))
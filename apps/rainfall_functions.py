@@ -0,0 +1,137 @@
+import os
+import shutil
+import urllib.request
+import streamlit as st
+import ee
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio import features
+from apps import aoi_functions, variables, ee_client, task_functions
+
+# Rainy seasons (Nov to Mar) starting in default_start_year up to default_end_year - 1
+default_start_year = 2019
+default_end_year = 2024
+
+# Native CHIRPS grid (0.05 degrees) so the cached raster is not resampled
+chirps_crs_transform = [0.05, 0, -180, 0, -0.05, 50]
+
+# Seconds the download may wait for data before it fails and is tried again
+climatology_download_timeout = float(os.environ.get("CLIMATOLOGY_DOWNLOAD_TIMEOUT", 120))
+
+def get_rain_season_images(start_year, end_year):
+    """CHIRPS pentads for the rainy seasons starting in start_year to end_year - 1."""
+    rain_season_images = ee.ImageCollection("UCSB-CHG/CHIRPS/PENTAD") \
+        .select('precipitation') \
+        .filterDate(f'{start_year}-11-01', f'{end_year}-04-01') \
+        .filter(ee.Filter.calendarRange(11, 3, 'month'))
+
+    return rain_season_images
+
+def get_rainfall_climatology(start_year, end_year):
+    """Mean total rainfall of the Nov to Mar season over the year range."""
+    no_years = end_year - start_year
+    rainfall_climatology = get_rain_season_images(start_year, end_year).sum().divide(no_years)
+
+    return rainfall_climatology
+
+def get_climatology_file_path(start_year, end_year):
+    return variables.get_cache_path("rainfall", f"chirps_rainy_season_{start_year}_{end_year}.tif")
+
+def get_rainfall_climatology_path(start_year=default_start_year, end_year=default_end_year):
+    """Path of the climatology raster for the Zambia AOI, downloading it on first use."""
+    climatology_path = get_climatology_file_path(start_year, end_year)
+
+    if not os.path.exists(climatology_path):
+        zambia_gdf = variables.get_zambia_boundaries()
+        zambia_ee = aoi_functions.get_aoi_ee(zambia_gdf, "CHIRPS")
+
+        rainfall_climatology = get_rainfall_climatology(start_year, end_year).clip(zambia_ee)
+        download_url = ee_client.get_download_url(rainfall_climatology, {
+            'region': zambia_ee.geometry().bounds(),
+            'crs': 'EPSG:4326',
+            'crs_transform': chirps_crs_transform,
+            'format': 'GEO_TIFF',
+        })
+
+        # Write to a temporary file first so a failed download is never cached
+        with variables.temp_write_path(climatology_path) as temp_path:
+            with urllib.request.urlopen(download_url, timeout=climatology_download_timeout) as response, \
+                    open(temp_path, "wb") as climatology_file:
+                shutil.copyfileobj(response, climatology_file)
+
+    return climatology_path
+
+@st.cache_resource(show_spinner=False)
+def get_climatology_download(start_year, end_year):
+    """Download of the climatology raster in a background worker, started once per process."""
+    return task_functions.get_background_executor().submit(get_rainfall_climatology_path, start_year, end_year)
+
+def request_rainfall_climatology(start_year=default_start_year, end_year=default_end_year):
+    """Path of the climatology raster, or None while it is downloaded in the background.
+
+    Raises the error of a failed download, which is tried again on the next request.
+    """
+    climatology_path = get_climatology_file_path(start_year, end_year)
+    if os.path.exists(climatology_path):
+        return climatology_path
+
+    climatology_download = get_climatology_download(start_year, end_year)
+    if not climatology_download.done():
+        return None
+    get_climatology_download.clear(start_year, end_year)
+    return climatology_download.result()
+
+def read_rainfall_values(src, geometries):
+    """Read only the window of the climatology raster covering the geometries."""
+    window = features.geometry_window(src, geometries)
+    rainfall = src.read(1, window=window, masked=True)
+
+    # all_touched keeps the pixel under farms smaller than a CHIRPS pixel
+    inside_mask = features.geometry_mask(
+        geometries, out_shape=rainfall.shape, transform=src.window_transform(window),
+        invert=True, all_touched=True
+        )
+    values = rainfall.data[inside_mask & ~np.ma.getmaskarray(rainfall)]
+
+    return values
+
+def summarise_rainfall(values):
+    if values.size == 0:
+        return {'mean': None, 'min': None, 'max': None}
+
+    rainfall_summary = {
+        'mean': round(float(values.mean()), 1),
+        'min': round(float(values.min()), 1),
+        'max': round(float(values.max()), 1),
+    }
+    return rainfall_summary
+
+@st.cache_data(hash_funcs=aoi_functions.gdf_hash_funcs, show_spinner=False)
+def get_aoi_rainfall(aoi_gdf, start_year=default_start_year, end_year=default_end_year):
+    """Rainy-season rainfall (mm) over an AOI from the cached climatology raster."""
+    with rasterio.open(get_rainfall_climatology_path(start_year, end_year)) as src:
+        geometries = aoi_gdf.to_crs(src.crs).geometry
+        values = read_rainfall_values(src, geometries)
+
+    return summarise_rainfall(values)
+
+@st.cache_data(hash_funcs=aoi_functions.gdf_hash_funcs, show_spinner=False)
+def get_features_rainfall(gdf, name_col, start_year=default_start_year, end_year=default_end_year):
+    """Rainy-season rainfall (mm) for each feature of a layer, e.g. farms or FS catchments."""
+    rows = []
+    with rasterio.open(get_rainfall_climatology_path(start_year, end_year)) as src:
+        projected_gdf = gdf.to_crs(src.crs)
+        for name, geometry in zip(projected_gdf[name_col], projected_gdf.geometry):
+            rainfall_summary = summarise_rainfall(read_rainfall_values(src, [geometry]))
+            rows.append({name_col: name, **rainfall_summary})
+
+    rainfall_df = pd.DataFrame(rows, columns=[name_col, 'mean', 'min', 'max'])
+    return rainfall_df
+
+if __name__ == "__main__":
+    # Download the climatology raster ahead of the app processes:
+    # python -m apps.rainfall_functions
+    from apps import access
+    access.ee_to_st()
+    print(f"Downloading the rainfall climatology to {get_rainfall_climatology_path()}...")
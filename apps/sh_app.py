@@ -1,98 +1,121 @@
 import streamlit as st
-import folium
-from folium.plugins import MarkerCluster, MeasureControl
-import xyzservices.providers as xyz
-from streamlit_folium import folium_static
-from apps import sh_functions, variables
+from apps import sh_functions, query_functions, hex_functions, kepler_functions, map_functions, map_cache_functions, trace_functions
 
 st.set_page_config(layout="wide")
 
-gdf = variables.get_sh_farms()
-
 rename_color_by = {'Region': 'region_id', 'District': 'district_id', 'Hub': 'hub_id',
                    'Camp': 'camp_id', 'FS': 'fs_id', 'PEA': 'pea_id'}
 
-def app():
-    st.header("Field Locations")
-
-    with st.expander("Click to filter map and metrics"):
-        selected_region, selected_district, selected_hub, selected_camp = sh_functions.add_sh_location_filter_selectboxes(gdf)
-        selected_fs, selected_pea, selected_farmer_id = sh_functions.add_sh_personnel_filter_selectboxes(gdf)
+# Files the fields map is built from; a change to any of them renders it anew
+fields_map_sources = [
+    __file__, sh_functions.__file__, query_functions.__file__, hex_functions.__file__, map_functions.__file__,
+    query_functions.query_layers['fields'],
+]
+
+@trace_functions.traced
+def get_fields_map_html(selected_filters, view_cluster, selected_color_by, view_hexagons=False):
+    """Rendered map of the filtered fields for one view, with its payload by layer kind."""
+    def build_fields_map():
+        if view_hexagons:
+            return sh_functions.get_fields_hex_map(selected_filters)
+
+        filtered_gdf = query_functions.get_fields_gdf(selected_filters)
+        gotten_colors = None if view_cluster else sh_functions.get_colors(selected_color_by, selected_filters)
+        return sh_functions.get_fields_map(
+            filtered_gdf, view_cluster, gotten_colors, selected_color_by, rename_color_by
+            )
 
-    filtered_gdf = sh_functions.get_filtered_gdf(
-        gdf, selected_region, selected_district, selected_hub, selected_camp, 
-        selected_fs, selected_pea, selected_farmer_id
+    return map_cache_functions.get_cached_map_html(
+        "sh_app",
+        {**selected_filters, 'view_cluster': view_cluster, 'color_by': selected_color_by, 'view_hexagons': view_hexagons},
+        build_fields_map, fields_map_sources, basemap="CartoDB dark_matter",
         )
 
-    view_cluster_col, color_by_col = st.columns([3,3])
-    with view_cluster_col:
-        view_cluster = st.checkbox("View fields as clusters", value=True, key=41)
-
-    if not view_cluster:
+def get_hot_map_filters():
+    """Views opened most often: all fields and each region, as hexagons."""
+    no_filters = dict.fromkeys([
+        'selected_region', 'selected_district', 'selected_hub', 'selected_camp',
+        'selected_fs', 'selected_pea', 'selected_farmer_id',
+        ])
+    regions = query_functions.get_field_options('region', {})
+    return [
+        {
+            'selected_filters': {**no_filters, 'selected_region': selected_region},
+            'view_cluster': True, 'selected_color_by': "None", 'view_hexagons': True,
+        }
+        for selected_region in [None] + regions
+    ]
+
+@st.fragment
+@trace_functions.traced
+def chart_fragment(selected_filters, selected_color_by, gotten_colors):
+    """Chart and its selectors; changing them reruns only the chart."""
+    sh_functions.get_altair_chart(selected_filters, selected_color_by, gotten_colors)
+
+@st.fragment
+@trace_functions.traced
+def fields_view_fragment(selected_filters, view_webgl=False):
+    """Colour options, metrics and map of the filtered fields.
+
+    Changing the view options reruns only this part of the page; the filters
+    above it rerun the whole page. The WebGL map draws every field, coloured.
+    """
+    view_hexagons_col, view_cluster_col, color_by_col = st.columns([2,2,3])
+    view_hexagons = False
+    view_cluster = False
+    if not view_webgl:
+        with view_hexagons_col:
+            view_hexagons = st.checkbox("View field density as hexagons", value=True, key=43)
+
+        view_cluster = True
+        if not view_hexagons:
+            with view_cluster_col:
+                view_cluster = st.checkbox("View fields as clusters", value=True, key=41)
+
+    if not view_hexagons and not view_cluster:
         with color_by_col:
             selected_color_by = st.radio(
                 "Color fields by...", rename_color_by.keys(), index=0, key=42, horizontal=True
             )
 
-        gotten_colors = sh_functions.get_colors(selected_color_by, filtered_gdf)
+        gotten_colors = sh_functions.get_colors(selected_color_by, selected_filters)
 
     else:
         selected_color_by="None"
         gotten_colors = None
 
     with st.expander("Click to view metrics"):
-        sh_functions.get_scorecards(filtered_gdf)
+        sh_functions.get_scorecards(selected_filters)
 
         # view_graph = st.checkbox("View graph", value=False, key=40)
         with st.expander("View chart"):
-            sh_functions.get_altair_chart(filtered_gdf, selected_color_by, gotten_colors)
-
-    m = folium.Map(tiles="CartoDB dark_matter", control_scale=True,
-                   draw_control=False, layer_control=False)
-    
-    folium.TileLayer(
-        tiles=xyz.Esri.WorldImagery.build_url(),
-        name="Esri WorldImagery",
-        attr=xyz.Esri.WorldImagery.attribution,  # ✅ required
-        overlay=False,
-        control=True,
-        show=False
-    ).add_to(m)
-            
-    m.add_child(MeasureControl(
-        primary_length_unit='kilometers',
-        secondary_length_unit='meters',
-        primary_area_unit='sqmeters',
-        secondary_area_unit='hectares'
-    ))
-
-    # Get bounds: [minx, miny, maxx, maxy]
-    minx, miny, maxx, maxy = filtered_gdf.total_bounds
-
-    # Fit map to bounds
-    m.fit_bounds([[miny, minx], [maxy, maxx]])
-
-    # Create a FeatureGroup named "Farms"
-    farms_group = folium.FeatureGroup(name="Farms")
-
-    if view_cluster:
-        # Add marker cluster to the feature group
-        marker_cluster = MarkerCluster().add_to(farms_group)
-    else:
-        marker_cluster = m
+            chart_fragment(selected_filters, selected_color_by, gotten_colors)
 
     with st.spinner("Patience makes the crop work...", show_time=True):
-        sh_functions.add_map_cicle_markers(
-            filtered_gdf, gotten_colors, selected_color_by, rename_color_by, marker_cluster
-            )
-
-        # Add the feature group (with clustered points) to the map
-        farms_group.add_to(m)
+        if view_webgl:
+            fields_datasets, fields_config = sh_functions.get_fields_kepler_map(
+                selected_filters, gotten_colors, selected_color_by, rename_color_by
+                )
+            kepler_functions.show_kepler_map("sh_app", fields_datasets, fields_config, height=510)
+        else:
+            map_html, map_payload = get_fields_map_html(selected_filters, view_cluster, selected_color_by, view_hexagons)
+            map_functions.show_map_html("sh_app", map_html, map_payload, height=510)
+
+@trace_functions.traced
+def app():
+    st.header("Field Locations")
+    view_webgl = kepler_functions.select_map_renderer(key=44)
 
-        # Add layer control
-        folium.LayerControl(collapsed=True).add_to(m)
-        
-        folium_static(m, width=None)
+    with st.expander("Click to filter map and metrics"):
+        selected_region, selected_district, selected_hub, selected_camp = sh_functions.add_sh_location_filter_selectboxes()
+        selected_fs, selected_pea, selected_farmer_id = sh_functions.add_sh_personnel_filter_selectboxes()
+
+    selected_filters = {
+        'selected_region': selected_region, 'selected_district': selected_district,
+        'selected_hub': selected_hub, 'selected_camp': selected_camp, 'selected_fs': selected_fs,
+        'selected_pea': selected_pea, 'selected_farmer_id': selected_farmer_id,
+    }
+    fields_view_fragment(selected_filters, view_webgl)
 
     disclaimer_col, data_source_col = st.columns([6,2])
     with disclaimer_col:
@@ -1,74 +1,61 @@
+import os
 import streamlit as st
 import random
 import folium
-from folium.plugins import MarkerCluster
+from folium.plugins import MarkerCluster, MeasureControl
+import xyzservices.providers as xyz
 import altair as alt
+from apps import export_functions, hex_functions, kepler_functions, query_functions, trace_functions
 
-def add_sh_location_filter_selectboxes(gdf):
+def add_sh_location_filter_selectboxes():
+    """Region, district, hub and camp selectors, each offering the options within the selections before it."""
     region_col, district_col, hub_col, camp_col, = st.columns([3, 3, 3, 3])
 
     with region_col:
-        regions = sorted(gdf['region'].dropna().unique())
+        regions = query_functions.get_field_options('region', {})
         selected_region = st.selectbox(
             "Region", regions, index=None, placeholder="Select region...", key=30
             )
 
-    filtered_df = gdf.copy()
-    if selected_region:
-        filtered_df = filtered_df[filtered_df['region'] == selected_region]
-
     with district_col:
-        districts = sorted(filtered_df['district'].dropna().unique())
+        districts = query_functions.get_field_options('district', {'selected_region': selected_region})
         selected_district = st.selectbox(
             "District", districts, index=None, placeholder="Select district...", key=31
             )
 
-    if selected_district:
-        filtered_df = filtered_df[filtered_df['district'] == selected_district]
-
     with hub_col:
-        hubs = sorted(filtered_df['hub'].dropna().unique())
+        hubs = query_functions.get_field_options(
+            'hub', {'selected_region': selected_region, 'selected_district': selected_district}
+            )
         selected_hub = st.selectbox(
             "Hub", hubs, index=None, placeholder="Select hub...", key=32
             )
 
-    if selected_hub:
-        filtered_df = filtered_df[filtered_df['hub'] == selected_hub]
-
     with camp_col:
-        camps = sorted(filtered_df['camp'].dropna().unique())
+        camps = query_functions.get_field_options(
+            'camp', {'selected_region': selected_region, 'selected_district': selected_district, 'selected_hub': selected_hub}
+            )
         selected_camp = st.selectbox(
             "Camp", camps, index=None, placeholder="Select camp...", key=33
             )
 
-    if selected_camp:
-        filtered_df = filtered_df[filtered_df['camp'] == selected_camp]
-
     return selected_region, selected_district, selected_hub, selected_camp
 
-def add_sh_personnel_filter_selectboxes(gdf):
+def add_sh_personnel_filter_selectboxes():
     fs_col, pea_col, farmer_col = st.columns([3, 3, 3])
 
-    filtered_df = gdf.copy()
-
     with fs_col:
-        fss = sorted(filtered_df['fs'].dropna().unique())
+        fss = query_functions.get_field_options('fs', {})
         selected_fs = st.selectbox(
             "FS", fss, index=None, placeholder="Select FS...", key=34
             )
 
-    if selected_fs:
-        filtered_df = filtered_df[filtered_df['fs'] == selected_fs]
-
     with pea_col:
-        peas = sorted(filtered_df['pea'].dropna().unique())
+        peas = query_functions.get_field_options('pea', {'selected_fs': selected_fs})
         selected_pea = st.selectbox(
             "PEA", peas, index=None, placeholder="Select PEA...", key=35
             )
 
-    if selected_pea:
-        filtered_df = filtered_df[filtered_df['pea'] == selected_pea]
-
     with farmer_col:
         selected_farmer_id = st.number_input(
             "Farmer ID", placeholder="Enter Farmer ID...", format="%0f", key=36
@@ -76,32 +63,9 @@ def add_sh_personnel_filter_selectboxes(gdf):
 
     return selected_fs, selected_pea, selected_farmer_id
 
-def get_filtered_gdf(gdf, selected_region, selected_district, selected_hub, selected_camp, selected_fs, selected_pea, selected_farmer_id):
-    filtered_df = gdf.copy()
-    if selected_region:
-        filtered_df = filtered_df[filtered_df['region'] == selected_region]
-
-    if selected_district:
-        filtered_df = filtered_df[filtered_df['district'] == selected_district]
-
-    if selected_hub:
-        filtered_df = filtered_df[filtered_df['hub'] == selected_hub]
-
-    if selected_camp:
-        filtered_df = filtered_df[filtered_df['camp'] == selected_camp]
-
-    if selected_fs:
-        filtered_df = filtered_df[filtered_df['fs'] == selected_fs]
-
-    if selected_pea:
-        filtered_df = filtered_df[filtered_df['pea'] == selected_pea]
-
-    if selected_farmer_id:
-        filtered_df = filtered_df[filtered_df['farmer_id'] == selected_farmer_id]
-
-    return filtered_df
-
-def get_colors(selected_color_by, filtered_gdf):
+@trace_functions.traced
+def get_colors(selected_color_by, selected_filters):
+    """Colour of each value of the `selected_color_by` column among the filtered fields."""
     rename_selected_color_by = {'Region': 'region_id', 'District': 'district_id', 'Hub': 'hub_id',
                         'Camp': 'camp_id', 'FS': 'fs_id', 'PEA': 'pea_id'}
 
@@ -111,7 +75,7 @@ def get_colors(selected_color_by, filtered_gdf):
             13: "#ff9900", 11: '#ffffff', 12: "#ccbe00", 5: "#583500", 3: "#ff6f6f", 6: "#7a0000", 8: "#a1ff55"
         }
 
-        values_list = filtered_gdf[rename_selected_color_by[selected_color_by]].unique().tolist()
+        values_list = query_functions.get_field_values(rename_selected_color_by[selected_color_by], selected_filters)
         colors = {}
         for value in values_list:
             value_color = {value: color_options[value]}
@@ -120,7 +84,7 @@ def get_colors(selected_color_by, filtered_gdf):
     else:
         colors = {}
         random.seed(42)
-        values_list = filtered_gdf[rename_selected_color_by[selected_color_by]].unique().tolist()
+        values_list = query_functions.get_field_values(rename_selected_color_by[selected_color_by], selected_filters)
         
         for value in values_list:
             color = "#{:06x}".format(random.randint(0, 0xFFFFFF))
@@ -129,29 +93,31 @@ def get_colors(selected_color_by, filtered_gdf):
 
     return colors
 
-def get_scorecards(filtered_gdf):
+@trace_functions.traced
+def get_scorecards(selected_filters):
     region_col, district_col, hub_col, camp_col, fs_col, pea_col, farmer_col = st.columns(7)
+    field_metrics = query_functions.get_field_metrics(selected_filters)
 
     region_metric = region_col.metric(
-        "Regions", filtered_gdf['region_id'].nunique(), border=True
+        "Regions", field_metrics['regions'], border=True
         )
     district_metric = district_col.metric(
-        "Districts", filtered_gdf['district_id'].nunique(), border=True
+        "Districts", field_metrics['districts'], border=True
         )
     hub_metric = hub_col.metric(
-        "Hubs", filtered_gdf['hub'].nunique(), border=True
+        "Hubs", field_metrics['hubs'], border=True
         )
     camp_metric = camp_col.metric(
-        "Camps", filtered_gdf['camp_id'].nunique(), border=True
+        "Camps", field_metrics['camps'], border=True
         )
     fs_metric = fs_col.metric(
-        "FSs", filtered_gdf['fs_id'].nunique(), border=True
+        "FSs", field_metrics['fss'], border=True
         )
     pea_metric = pea_col.metric(
-        "PEAs", filtered_gdf['pea_id'].nunique(), border=True
+        "PEAs", field_metrics['peas'], border=True
         )
     farmer_metric = farmer_col.metric(
-        "Fields", filtered_gdf['field_id'].nunique(), border=True
+        "Fields", field_metrics['fields'], border=True
         )
 
     return region_metric, district_metric, hub_metric, camp_metric, fs_metric, pea_metric, farmer_metric
@@ -173,36 +139,36 @@ def get_selected_chart_options():
 
     return selected_category, selected_sub_category, selected_value
 
-def get_altair_chart(filtered_gdf, selected_color_by, gotten_colors):
-    renamed_gdf = filtered_gdf.rename(columns={
-            'region': 'Region', 'district': 'District', 'hub': 'Hub',
-            'camp': 'Camp', 'fs': 'FS', 'pea': 'PEA'
-            })
+# Columns of the fields layer behind each chart category, and their names in the chart
+chart_rename_columns = {
+        'region': 'Region', 'district': 'District', 'hub': 'Hub',
+        'camp': 'Camp', 'fs': 'FS', 'pea': 'PEA'
+        }
+
+def get_chart_counts_args(selected_category, selected_sub_category, selected_value):
+    """Group, count and sort columns of query_functions.get_field_counts for a chart."""
+    category_columns = {category: column for column, category in chart_rename_columns.items()}
 
     value_options = {'Region':'region_id', 'District': 'district_id', 'Hub': 'hub_id', 'Camp': 'camp_id',
                     'FS': 'fs_id', 'PEA': 'pea_id', 'Field': 'field_id'}
 
-    chart_col, chart_selectors_col = st.columns([4,1])
-    with chart_selectors_col:
-        selected_category, selected_sub_category, selected_value = get_selected_chart_options()
-
     if selected_sub_category is not None:
-        df = renamed_gdf.groupby([value_options[selected_sub_category], selected_category, selected_sub_category]) \
-                .agg(**{selected_value: (value_options[selected_value], 'nunique')}) \
-                .reset_index().sort_values(
-                    [selected_value, selected_category], ascending=[False,  True]
-                    )
-        df.rename(columns={selected_value: f"{selected_value}s"}, inplace=True)
-
+        group_columns = [
+            value_options[selected_sub_category], category_columns[selected_category], category_columns[selected_sub_category]
+            ]
     else:
-        df = renamed_gdf.groupby([value_options[selected_category], selected_category]) \
-                .agg(**{selected_value: (value_options[selected_value], 'nunique')}) \
-                .reset_index().sort_values(
-                    [selected_value, selected_category], ascending=[False,  True]
-                    )
-        df.rename(columns={selected_value: f"{selected_value}s"}, inplace=True)
+        group_columns = [value_options[selected_category], category_columns[selected_category]]
+
+    return group_columns, value_options[selected_value], category_columns[selected_category]
 
+@trace_functions.traced
+def get_chart_df(selected_filters, selected_category, selected_sub_category, selected_value):
+    """Count of distinct `selected_value`s per category (and sub-category), with its percentage."""
     renamed_value = f"{selected_value}s"
+    df = query_functions.get_field_counts(
+        selected_filters, *get_chart_counts_args(selected_category, selected_sub_category, selected_value)
+        )
+    df = df.rename(columns={**chart_rename_columns, 'count': renamed_value})
 
     # Calculate total count
     total_count = df[renamed_value].sum()
@@ -214,8 +180,43 @@ def get_altair_chart(filtered_gdf, selected_color_by, gotten_colors):
     else:
         df["Percentage"] = "0.0%"
 
+    return df
+
+def add_chart_export(selected_filters, selected_category, selected_sub_category, selected_value):
+    """Export of the chart's table, read from the fields layer and written in chunks."""
+    counts_args = get_chart_counts_args(selected_category, selected_sub_category, selected_value)
+    rename_columns = {**chart_rename_columns, 'count': f"{selected_value}s", 'percentage': "Percentage"}
+    export_key = (selected_filters, counts_args, os.path.getmtime(query_functions.query_layers['fields']))
+
+    categories = [selected_category] + ([selected_sub_category] if selected_sub_category is not None else [])
+    file_stem = f"{selected_value}_counts_by_{'_'.join(categories)}".lower()
+
+    export_functions.add_export_controls(
+        file_stem, export_key,
+        lambda: (
+            batch.rename(columns=rename_columns)
+            for batch in query_functions.get_field_counts_batches(
+                selected_filters, *counts_args, export_functions.export_chunk_rows
+                )
+            ),
+        key="sh_chart_export",
+        )
+
+@trace_functions.traced
+def get_altair_chart(selected_filters, selected_color_by, gotten_colors):
+    value_options = {'Region':'region_id', 'District': 'district_id', 'Hub': 'hub_id', 'Camp': 'camp_id',
+                    'FS': 'fs_id', 'PEA': 'pea_id', 'Field': 'field_id'}
+
+    chart_col, chart_selectors_col = st.columns([4,1])
+    with chart_selectors_col:
+        selected_category, selected_sub_category, selected_value = get_selected_chart_options()
+        add_chart_export(selected_filters, selected_category, selected_sub_category, selected_value)
+
+    df = get_chart_df(selected_filters, selected_category, selected_sub_category, selected_value)
+    renamed_value = f"{selected_value}s"
+
     if selected_sub_category is not None or selected_color_by == selected_sub_category:
-        gotten_colors = get_colors(selected_sub_category, filtered_gdf)
+        gotten_colors = get_colors(selected_sub_category, selected_filters)
         color_domain = list(gotten_colors.keys())
         color_range = list(gotten_colors.values())
     elif selected_color_by == selected_category:
@@ -276,6 +277,7 @@ def get_altair_chart(filtered_gdf, selected_color_by, gotten_colors):
 
     return altair_chart, selected_category, selected_sub_category, selected_value 
 
+@trace_functions.traced
 def add_map_cicle_markers(filtered_gdf, gotten_colors, selected_color_by, rename_color_by, marker_cluster):
     # Add points as circle markers
     for _, row in filtered_gdf.iterrows():
@@ -299,4 +301,95 @@ def add_map_cicle_markers(filtered_gdf, gotten_colors, selected_color_by, rename
             radius=1,
             tooltip=folium.Tooltip(tooltip_text, sticky=True),
             color=color,
-        ).add_to(marker_cluster)
\ No newline at end of file
+        ).add_to(marker_cluster)
+
+def get_fields_base_map():
+    """Dark basemap with imagery and a measure control, for the fields maps."""
+    m = folium.Map(tiles="CartoDB dark_matter", control_scale=True,
+                   draw_control=False, layer_control=False)
+    
+    folium.TileLayer(
+        tiles=xyz.Esri.WorldImagery.build_url(),
+        name="Esri WorldImagery",
+        attr=xyz.Esri.WorldImagery.attribution,  # ✅ required
+        overlay=False,
+        control=True,
+        show=False
+    ).add_to(m)
+            
+    m.add_child(MeasureControl(
+        primary_length_unit='kilometers',
+        secondary_length_unit='meters',
+        primary_area_unit='sqmeters',
+        secondary_area_unit='hectares'
+    ))
+    return m
+
+@trace_functions.traced
+def get_fields_map(filtered_gdf, view_cluster, gotten_colors, selected_color_by, rename_color_by):
+    """Folium map of the filtered fields, clustered or coloured by `selected_color_by`."""
+    m = get_fields_base_map()
+
+    # Get bounds: [minx, miny, maxx, maxy]
+    minx, miny, maxx, maxy = filtered_gdf.total_bounds
+
+    # Fit map to bounds
+    m.fit_bounds([[miny, minx], [maxy, maxx]])
+
+    # Create a FeatureGroup named "Farms"
+    farms_group = folium.FeatureGroup(name="Farms")
+
+    if view_cluster:
+        # Add marker cluster to the feature group
+        marker_cluster = MarkerCluster().add_to(farms_group)
+    else:
+        marker_cluster = m
+
+    add_map_cicle_markers(
+        filtered_gdf, gotten_colors, selected_color_by, rename_color_by, marker_cluster
+        )
+
+    # Add the feature group (with clustered points) to the map
+    farms_group.add_to(m)
+
+    # Add layer control
+    folium.LayerControl(collapsed=True).add_to(m)
+
+    return m
+
+@trace_functions.traced
+def get_fields_hex_map(selected_filters):
+    """Folium map of the filtered fields' density in H3 hexagons, with the fields themselves at high zoom."""
+    m = get_fields_base_map()
+
+    # The fields are only sent when there are few enough of them
+    points_layer = None
+    if query_functions.get_field_metrics(selected_filters)['fields'] <= hex_functions.hex_max_points:
+        points_layer = folium.FeatureGroup(name="Farms", control=False)
+        add_map_cicle_markers(query_functions.get_fields_gdf(selected_filters), None, "None", None, points_layer)
+
+    hex_functions.add_hex_layers(m, selected_filters, points_layer)
+
+    folium.LayerControl(collapsed=True).add_to(m)
+
+    return m
+
+# Columns of the fields shown in the WebGL map's tooltips, as in add_map_cicle_markers
+kepler_tooltip_columns = ['farmer_id', 'camp', 'pea', 'hub', 'fs', 'district', 'region']
+
+@trace_functions.traced
+def get_fields_kepler_map(selected_filters, gotten_colors, selected_color_by, rename_color_by):
+    """Datasets and config of a WebGL map of the filtered fields, coloured as get_colors colours them."""
+    columns = ['lon', 'lat'] + kepler_tooltip_columns
+    color_column = None
+    if gotten_colors is not None:
+        # Coloured as strings, whatever the column's type, to match the colour map's keys
+        color_column = rename_color_by[selected_color_by]
+        columns.append(f"CAST({color_column} AS VARCHAR) AS {color_column}")
+
+    fields_table = query_functions.get_fields_table(selected_filters, columns)
+    fields_layer = kepler_functions.get_point_layer(
+        "fields", "Farms", color_column=color_column, colors=gotten_colors
+        )
+    config = kepler_functions.get_map_config([fields_layer], {'fields': kepler_tooltip_columns})
+    return {'fields': fields_table}, config
@@ -2,15 +2,42 @@ import streamlit as st
 import geemap.foliumap as geemap_folium
 from folium.plugins import MeasureControl
 import geopandas as gpd
-from apps import soil_functions, ee_functions
+from apps import soil_functions, ee_functions, suitability_functions, zonal_stats_functions, tile_functions, map_functions, trace_functions, variables
 
 
-aoi_gdf = gpd.read_file(r"data/vector/zambia_aoi.gpkg")
+aoi_gdf = variables.get_zambia_boundaries()
 texture_classes = ['Clay', 'Sandy Clay', 'Clay Loam',
                     'Sandy Clay Loam', 'Sandy Loam', 'Loamy Sand','Sand']
 
+@trace_functions.traced
 def app():
-    soil_tab, = st.tabs(['Soil Suitability'])
+    soil_tab, stats_tab = st.tabs(['Soil Suitability', 'Soil Statistics'])
+
+    with stats_tab:
+        st.header("Soil Statistics per Farm and Catchment")
+
+        layer_name = st.radio(
+            "Select layer", list(zonal_stats_functions.zonal_stats_layers), horizontal=True, key=66
+        )
+        try:
+            zonal_stats_df = zonal_stats_functions.get_zonal_stats(layer_name)
+        except Exception as e:
+            print(f"Could not compute soil statistics for {layer_name}: {e}")
+            st.warning(f"Soil statistics for {layer_name.lower()} could not be computed; they will be tried again on the next visit.")
+            zonal_stats_df = None
+        else:
+            if zonal_stats_df is None:
+                st.info(f"Soil statistics for {layer_name.lower()} are being computed and will show on a later visit.")
+
+        if zonal_stats_df is not None:
+            st.dataframe(zonal_stats_df, hide_index=True)
+            st.download_button(
+                "Download statistics (CSV)",
+                zonal_stats_df.to_csv(index=False),
+                file_name=f"soil_statistics_{layer_name.lower().replace(' ', '_')}.csv",
+                mime="text/csv",
+                key=67
+            )
 
     with soil_tab:
         st.header("Analyse Soil Suitability")
@@ -22,6 +49,8 @@ def app():
         options = soil_functions.get_soil_dataset(None)
         selected_dataset_names_list = []
         selected_datasets = {}
+        local_scoring = False
+        weights = {}
         with col1:
             dataset1_name = st.selectbox(
                 "Select dataset",
@@ -182,7 +211,27 @@ def app():
                         if dataset5_name:
                             selected_datasets.update({dataset5_name:list(dataset5_range)})
 
-            if dataset1_name:
+            # Score overlays locally from cached soil rasters instead of Earth Engine
+            if len(selected_datasets) > 1:
+                local_scoring = st.checkbox("Score locally from cached soil rasters", value=False, key=65)
+
+            if local_scoring:
+                with st.expander("Click to weight selected datasets"):
+                    weight_cols = st.columns(5)
+                    for weight_col, selected_dataset_name in zip(weight_cols, selected_datasets):
+                        with weight_col:
+                            weights[selected_dataset_name] = st.slider(
+                                f"Weight {selected_dataset_name}",
+                                min_value=0, max_value=5, value=1,
+                                key=f"weight_{selected_dataset_name}"
+                            )
+
+                with st.spinner("Scoring soil suitability...", show_time=True):
+                    # Only criteria whose filters changed are recomputed
+                    suitability_engine = suitability_functions.get_suitability_engine()
+                    suitability_engine.update(selected_datasets)
+
+            elif dataset1_name:
                 with st.spinner(f"Getting {dataset1_name}...", show_time=True):
                     overlaid_dataset = soil_functions.get_overlaid_dataset(selected_datasets, aoi_gdf)
 
@@ -192,23 +241,32 @@ def app():
                 overlaid_palette = overlaid_palette[::-1]
                 overlaid_names = [rank + 1 for rank in range(len(selected_datasets))]
                 overlaid_visparams = {'min': 1, 'max': len(selected_datasets), 'palette': overlaid_palette}
+                weighted_palette = palette[::-1]
             else:
                 if dataset1_name == 'Texture Class':
                     overlaid_visparams, overlaid_texture_names, overlaid_texture_palette = soil_functions. \
-                                                get_soil_dataset_visparams(dataset1_name, overlaid_dataset)
+                                                get_soil_dataset_visparams(dataset1_name, overlaid_dataset, aoi_gdf, dataset1_range)
                 elif dataset1_name and dataset1_range:
-                    overlaid_visparams = soil_functions.get_soil_dataset_visparams(dataset1_name, overlaid_dataset)
+                    overlaid_visparams = soil_functions.get_soil_dataset_visparams(dataset1_name, overlaid_dataset, aoi_gdf)
                     overlaid_visparams ['min'] = dataset1_range[0]
                     overlaid_visparams ['max'] = dataset1_range[1]
 
         else:
             if dataset1_name:
-                with st.spinner(f"Getting {dataset1_name}...", show_time=True):
-                    soil_dataset = soil_functions.get_soil_dataset(aoi_gdf)[dataset1_name]
+                # Use the pre-rendered national tiles when they have been built
+                soil_tiles = tile_functions.get_soil_tiles_metadata(dataset1_name)
+                if soil_tiles is not None:
+                    visparams = soil_tiles['legend']['visparams']
                     if dataset1_name == 'Texture Class':
-                        visparams, texture_names, texture_palette = soil_functions.get_soil_dataset_visparams(dataset1_name, soil_dataset)
-                    else:
-                        visparams = soil_functions.get_soil_dataset_visparams(dataset1_name, soil_dataset)
+                        texture_names = soil_tiles['legend']['texture_names']
+                        texture_palette = soil_tiles['legend']['texture_palette']
+                else:
+                    with st.spinner(f"Getting {dataset1_name}...", show_time=True):
+                        soil_dataset = soil_functions.get_soil_image(dataset1_name, aoi_gdf)
+                        if dataset1_name == 'Texture Class':
+                            visparams, texture_names, texture_palette = soil_functions.get_soil_dataset_visparams(dataset1_name, soil_dataset, aoi_gdf)
+                        else:
+                            visparams = soil_functions.get_soil_dataset_visparams(dataset1_name, soil_dataset, aoi_gdf)
 
         with st.spinner("Analysing soil properties...", show_time=True):
             m = geemap_folium.Map(control_scale=True, draw_control=False, layer_control=False)
@@ -223,10 +281,17 @@ def app():
             ))
 
             m.add_basemap('CartoDB.DarkMatter',False)
-            m.add_gdf(aoi_gdf, layer_name="Zambia", info_mode="on_click")
+            map_functions.add_gdf_layer(
+                m, aoi_gdf, "Zambia",
+                style={"color": "#3388ff", "weight": 2, "opacity": 1, "fillOpacity": 0},
+                tooltip_fields=["country"], display_level="National"
+            )
 
             if dataset1_name and not toggle:
-                m.add_ee_layer(soil_dataset, visparams=visparams, name=dataset1_name)
+                if soil_tiles is not None:
+                    tile_functions.add_soil_tile_layer(m, dataset1_name)
+                else:
+                    m.add_ee_layer(soil_dataset, visparams=visparams, name=dataset1_name)
 
                 if dataset1_name == 'Texture Class':
                     legend_dict = dict(zip(texture_names, texture_palette))
@@ -245,6 +310,22 @@ def app():
                     #     orientation='vertical'
                     #     )
 
+            elif dataset1_name and toggle and local_scoring:
+                # Equal weights rank pixels by the number of criteria met
+                if len(set(weights.values())) <= 1:
+                    suitability_functions.add_suitability_overlay(
+                        m, suitability_engine.get_counts(), 1, len(selected_datasets),
+                        overlaid_palette, "Suitability Rank"
+                    )
+                    legend_dict = dict(zip(overlaid_names[::-1], overlaid_palette[::-1]))
+                    soil_functions.add_categorical_legend(m, "Suitability Rank", list(legend_dict.values()), list(legend_dict.keys()))
+                else:
+                    suitability_functions.add_suitability_overlay(
+                        m, suitability_engine.get_weighted_scores(weights), 0, 1,
+                        weighted_palette, "Suitability Score"
+                    )
+                    soil_functions.add_vertical_colorbar(m, "Suitability Score", 0, 1, weighted_palette)
+
             elif dataset1_name and toggle and dataset1_range:
                 m.add_ee_layer(overlaid_dataset, visparams=overlaid_visparams, name=dataset1_name)
 
@@ -276,4 +357,4 @@ def app():
 
             m.zoom_to_gdf(aoi_gdf)
 
-            m.to_streamlit(height=550)
+            map_functions.show_map(m, "soil_app", height=550)
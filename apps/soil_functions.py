@@ -1,47 +1,129 @@
 import streamlit as st
 import math
+from collections.abc import Mapping
 import ee
 import geemap
 import geopandas as gpd
 from branca.element import Template, MacroElement
+from apps import aoi_functions, rainfall_functions, trace_functions, ee_client
+
+# iSDA soil properties, their units, the transform from the stored values
+# to real units ("divide": x / n, "expm1": exp(x / n) - 1) and the range of
+# real values over Zambia offered by the sliders and colour ramps
+soil_dataset_registry = {
+    "Annual Rainfall (mm)": {"asset": "UCSB-CHG/CHIRPS/PENTAD", "units": "mm", "transform": None, "min": 400, "max": 1600},
+    "Texture Class": {"asset": "ISDASOIL/Africa/v1/texture_class", "units": None, "transform": None, "min": None, "max": None},
+    "pH": {"asset": "ISDASOIL/Africa/v1/ph", "units": None, "transform": ("divide", 10), "min": 4.6, "max": 7.6},
+    "Clay Content (%)": {"asset": "ISDASOIL/Africa/v1/clay_content", "units": "%", "transform": None, "min": 3.0, "max": 53.0},
+    "Sand Content (%)": {"asset": "ISDASOIL/Africa/v1/sand_content", "units": "%", "transform": None, "min": 19.0, "max": 90.0},
+    "Stone Content (%)": {"asset": "ISDASOIL/Africa/v1/stone_content", "units": "%", "transform": ("expm1", 10), "min": 0.0, "max": 5.0},
+    "Silt Content (%)": {"asset": "ISDASOIL/Africa/v1/silt_content", "units": "%", "transform": ("expm1", 10), "min": 0.49182, "max": 26.0},
+    "Carbon Organic (g/kg)": {"asset": "ISDASOIL/Africa/v1/carbon_organic", "units": "g/kg", "transform": ("expm1", 10), "min": 2.66929, "max": 16.0},
+    "Carbon Total (g/kg)": {"asset": "ISDASOIL/Africa/v1/carbon_total", "units": "g/kg", "transform": ("expm1", 10), "min": 2.66929, "max": 48.402449},
+    "Nitrogen Total (g/kg)": {"asset": "ISDASOIL/Africa/v1/nitrogen_total", "units": "g/kg", "transform": ("expm1", 100), "min": 0.28402, "max": 1.7},
+    "Potassium Extractable (ppm)": {"asset": "ISDASOIL/Africa/v1/potassium_extractable", "units": "ppm", "transform": ("expm1", 10), "min": 10.023176, "max": 400.0},
+    "Phosphorus Extractable (ppm)": {"asset": "ISDASOIL/Africa/v1/phosphorus_extractable", "units": "ppm", "transform": ("expm1", 10), "min": 3.05519, "max": 20.0},
+    "Magnesium Extractable (ppm)": {"asset": "ISDASOIL/Africa/v1/magnesium_extractable", "units": "ppm", "transform": ("expm1", 10), "min": 8.97418, "max": 900.0},
+    "Iron Extractable (ppm)": {"asset": "ISDASOIL/Africa/v1/iron_extractable", "units": "ppm", "transform": ("expm1", 10), "min": 30.0, "max": 150.0},
+    "Zinc Extractable (ppm)": {"asset": "ISDASOIL/Africa/v1/zinc_extractable", "units": "ppm", "transform": ("expm1", 10), "min": 0.349858, "max": 5.5},
+    "Calcium Extractable (ppm)": {"asset": "ISDASOIL/Africa/v1/calcium_extractable", "units": "ppm", "transform": ("expm1", 10), "min": 23.53253, "max": 3050.0},
+    "Sulphur Extractable (ppm)": {"asset": "ISDASOIL/Africa/v1/sulphur_extractable", "units": "ppm", "transform": ("expm1", 10), "min": 1.013752, "max": 30.0},
+    "Aluminium Extractable (ppm)": {"asset": "ISDASOIL/Africa/v1/aluminium_extractable", "units": "ppm", "transform": ("expm1", 10), "min": 17.17414, "max": 300.0},
+    "Effective Cation Exchange Capacity (cmol(+)/kg)": {"asset": "ISDASOIL/Africa/v1/cation_exchange_capacity", "units": "cmol(+)/kg", "transform": ("expm1", 10), "min": 1.22554, "max": 35.0},
+}
+
+# iSDA texture class names and their stored values
+texture_class_values = {
+    'Clay': 1, 'Silty Clay': 2, 'Sandy Clay': 3, 'Clay Loam': 4,
+    'Silty Clay Loam': 5, 'Sandy Clay Loam': 6, 'Loam': 7, 'Silt Loam': 8,
+    'Sandy Loam': 9, 'Silt': 10, 'Loamy Sand': 11, 'Sand': 12
+}
+
+class LazySoilDatasets(Mapping):
+    """Read-only mapping of soil dataset names to images, built only when indexed."""
+    def __init__(self, aoi_gdf):
+        self.aoi_gdf = aoi_gdf
+
+    def __getitem__(self, selected_dataset_name):
+        return get_soil_image(selected_dataset_name, self.aoi_gdf)
+
+    def __iter__(self):
+        return iter(soil_dataset_registry)
+
+    def __len__(self):
+        return len(soil_dataset_registry)
 
 def get_soil_dataset(selected_aoi_gdf):
     if selected_aoi_gdf is None:
-        soil_datasets = [
-            "Annual Rainfall (mm)", "Texture Class", "pH", "Clay Content (%)", "Sand Content (%)",
-            "Stone Content (%)", "Silt Content (%)", "Carbon Organic (g/kg)", "Carbon Total (g/kg)",
-            "Nitrogen Total (g/kg)", "Potassium Extractable (ppm)", "Phosphorus Extractable (ppm)",
-            "Magnesium Extractable (ppm)", "Iron Extractable (ppm)", "Zinc Extractable (ppm)",
-            "Calcium Extractable (ppm)", "Sulphur Extractable (ppm)", "Aluminium Extractable (ppm)",
-            "Effective Cation Exchange Capacity (cmol(+)/kg)"
-        ]
+        soil_datasets = list(soil_dataset_registry)
         return soil_datasets
     else:
-        aoi_ee = geemap.gdf_to_ee(selected_aoi_gdf)
-        soil_datasets = {
-            "Annual Rainfall (mm)": get_avg_rainfall(2019, 2024, aoi_ee),
-            "Texture Class": ee.Image("ISDASOIL/Africa/v1/texture_class").clip(aoi_ee).select(0),
-            "pH": ee.Image("ISDASOIL/Africa/v1/ph").clip(aoi_ee).select(0).divide(10),
-            "Clay Content (%)": ee.Image("ISDASOIL/Africa/v1/clay_content").clip(aoi_ee).select(0),
-            "Sand Content (%)": ee.Image("ISDASOIL/Africa/v1/sand_content").clip(aoi_ee).select(0),
-            "Stone Content (%)": ee.Image("ISDASOIL/Africa/v1/stone_content").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Silt Content (%)": ee.Image("ISDASOIL/Africa/v1/silt_content").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Carbon Organic (g/kg)": ee.Image("ISDASOIL/Africa/v1/carbon_organic").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Carbon Total (g/kg)": ee.Image("ISDASOIL/Africa/v1/carbon_total").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Nitrogen Total (g/kg)": ee.Image("ISDASOIL/Africa/v1/nitrogen_total").clip(aoi_ee).select(0).divide(100).exp().subtract(1),
-            "Potassium Extractable (ppm)": ee.Image("ISDASOIL/Africa/v1/potassium_extractable").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Phosphorus Extractable (ppm)": ee.Image("ISDASOIL/Africa/v1/phosphorus_extractable").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Magnesium Extractable (ppm)": ee.Image("ISDASOIL/Africa/v1/magnesium_extractable").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Iron Extractable (ppm)": ee.Image("ISDASOIL/Africa/v1/iron_extractable").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Zinc Extractable (ppm)": ee.Image("ISDASOIL/Africa/v1/zinc_extractable").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Calcium Extractable (ppm)": ee.Image("ISDASOIL/Africa/v1/calcium_extractable").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Sulphur Extractable (ppm)": ee.Image("ISDASOIL/Africa/v1/sulphur_extractable").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Aluminium Extractable (ppm)": ee.Image("ISDASOIL/Africa/v1/aluminium_extractable").clip(aoi_ee).select(0).divide(10).exp().subtract(1),
-            "Effective Cation Exchange Capacity (cmol(+)/kg)": ee.Image("ISDASOIL/Africa/v1/cation_exchange_capacity").clip(aoi_ee).select(0).divide(10).exp().subtract(1)
-        }
+        soil_datasets = LazySoilDatasets(selected_aoi_gdf)
         return soil_datasets
 
-def get_soil_dataset_visparams(selected_dataset_name, selected_dataset):
+def get_dataset_file_name(selected_dataset_name):
+    """File-system friendly name of a dataset, e.g. 'Clay Content (%)' -> 'clay_content'."""
+    return selected_dataset_name.split(" (")[0].lower().replace(" ", "_")
+
+def apply_soil_transform(image, transform):
+    if transform is None:
+        return image
+
+    operation, divisor = transform
+    if operation == "divide":
+        return image.divide(divisor)
+    elif operation == "expm1":
+        return image.divide(divisor).exp().subtract(1)
+    else:
+        raise ValueError(f"Unknown soil dataset transform: {operation}")
+
+@trace_functions.traced
+def build_soil_image(selected_dataset_name):
+    """Unclipped image of one soil dataset in real units."""
+    if selected_dataset_name == "Annual Rainfall (mm)":
+        return rainfall_functions.get_rainfall_climatology(
+            rainfall_functions.default_start_year, rainfall_functions.default_end_year
+            )
+
+    dataset_info = soil_dataset_registry[selected_dataset_name]
+    soil_image = ee.Image(dataset_info["asset"]).select(0)
+    soil_image = apply_soil_transform(soil_image, dataset_info["transform"])
+
+    return soil_image
+
+@trace_functions.traced
+@st.cache_resource(hash_funcs=aoi_functions.gdf_hash_funcs, show_spinner=False)
+def get_soil_image(selected_dataset_name, aoi_gdf):
+    """Build the clipped image for one soil dataset, memoised per dataset and AOI."""
+    aoi_ee = aoi_functions.get_aoi_ee(aoi_gdf, "iSDA Soil")
+    soil_image = build_soil_image(selected_dataset_name).clip(aoi_ee)
+
+    return soil_image
+
+@trace_functions.traced
+@st.cache_data(hash_funcs=aoi_functions.gdf_hash_funcs, persist="disk", show_spinner=False)
+def get_texture_class_inventory(aoi_gdf):
+    """Distinct texture classes in an AOI and the share of its area each class covers."""
+    texture_dataset = get_soil_image('Texture Class', aoi_gdf)
+    aoi_ee = aoi_functions.get_aoi_ee(aoi_gdf, "iSDA Soil")
+
+    # Sum pixel areas grouped by texture class in a single reduction
+    class_areas = ee_client.get_info(ee.Image.pixelArea().addBands(texture_dataset).reduceRegion(
+        reducer=ee.Reducer.sum().group(groupField=1, groupName='class'),
+        geometry=aoi_ee.geometry(),
+        scale=aoi_functions.analysis_scales["iSDA Soil"],
+        maxPixels=1e10
+    ).get('groups'), kind="reduce")
+
+    total_area = sum(group['sum'] for group in class_areas)
+    texture_inventory = {
+        int(group['class']): round(group['sum'] / total_area, 4) if total_area > 0 else 0
+        for group in class_areas
+    }
+    return dict(sorted(texture_inventory.items()))
+
+@trace_functions.traced
+def get_soil_dataset_visparams(selected_dataset_name, selected_dataset, aoi_gdf=None, texture_classes=None):
     if selected_dataset_name == 'Texture Class':
         class_colors = {
                 1: ['Clay', "#d5c36b"],
@@ -57,9 +139,21 @@ def get_soil_dataset_visparams(selected_dataset_name, selected_dataset):
                 11: ['Loamy Sand', '#ff5a9d'],
                 12: ['Sand', '#ff005b']
             }
-        texture_values = sorted(geemap.image_value_list(selected_dataset).getInfo())
-        texture_values = [int(value) for value in texture_values]
-        texture_values = sorted(texture_values)
+        # Use the cached class inventory of the AOI when it is known
+        if aoi_gdf is not None:
+            texture_values = list(get_texture_class_inventory(aoi_gdf).keys())
+            # Small AOIs may hold no whole pixel at the reduction scale
+            if not texture_values:
+                texture_values = sorted(texture_class_values.values())
+        else:
+            texture_values = sorted(ee_client.get_info(geemap.image_value_list(selected_dataset), kind="reduce"))
+            texture_values = [int(value) for value in texture_values]
+            texture_values = sorted(texture_values)
+
+        # Restrict to the classes kept by a texture filter
+        if texture_classes is not None:
+            selected_values = [value for value, (name, _) in class_colors.items() if name in texture_classes]
+            texture_values = [value for value in texture_values if value in selected_values]
 
         texture_names = [class_colors[int(x)][0] for x in texture_values]
         texture_palette = [class_colors[int(x)][1] for x in texture_values]
@@ -72,8 +166,9 @@ def get_soil_dataset_visparams(selected_dataset_name, selected_dataset):
     else:
         # min = geemap.image_min_value(selected_dataset, aoi_ee, 30)
         # max = geemap.image_max_value(selected_dataset, aoi_ee, 30)
-        min = math.floor(get_datasets_min_max(selected_dataset_name)[0] * 100)/100.0
-        max = math.ceil(get_datasets_min_max(selected_dataset_name)[1] * 100)/100.0
+        dataset_info = soil_dataset_registry[selected_dataset_name]
+        min = math.floor(dataset_info["min"] * 100)/100.0
+        max = math.ceil(dataset_info["max"] * 100)/100.0
         visparams = {
                 'min': min, #min.getInfo()['mean_0_20'], 
                 'max': max, #max.getInfo()['mean_0_20'], 
@@ -84,51 +179,29 @@ def get_soil_dataset_visparams(selected_dataset_name, selected_dataset):
             }
         return visparams
 
+@trace_functions.traced
 def get_selected_datasets(selected_dataset_names_list, aoi_gdf):
     selected_datasets = []
     for selected_dataset_name in selected_dataset_names_list:
-        selected_dataset = get_soil_dataset(aoi_gdf)[selected_dataset_name]
+        selected_dataset = get_soil_image(selected_dataset_name, aoi_gdf)
         selected_datasets.append(selected_dataset)
     return selected_datasets
 
+@trace_functions.traced
 def get_datasets_min_max(selected_dataset_name):
-    dataset_min_max = {
-        "Annual Rainfall (mm)": (400, 1600),
-        'pH': (4.6, 7.6),
-        'Clay Content (%)': (3.0, 53.0),
-        'Sand Content (%)': (19.0, 90.0),
-        'Stone Content (%)': (0.0, 5.0),
-        'Silt Content (%)': (0.49182, 26.0),
-        'Carbon Organic (g/kg)': (2.66929, 16.0),
-        'Carbon Total (g/kg)': (2.66929, 48.402449),
-        'Nitrogen Total (g/kg)': (0.28402, 1.7),
-        'Potassium Extractable (ppm)': (10.023176, 400.0),
-        'Phosphorus Extractable (ppm)': (3.05519, 20.0),
-        'Magnesium Extractable (ppm)': (8.97418, 900.0),
-        'Iron Extractable (ppm)': (30.0, 150.0),
-        'Zinc Extractable (ppm)': (0.349858, 5.5),
-        'Calcium Extractable (ppm)': (23.53253, 3050.0),
-        'Sulphur Extractable (ppm)': (1.013752, 30.0),
-        'Aluminium Extractable (ppm)': (17.17414, 300.0),
-        'Effective Cation Exchange Capacity (cmol(+)/kg)': (1.22554, 35.0)
-        }
-    selected_dataset_min_max = dataset_min_max[selected_dataset_name]
+    dataset_info = soil_dataset_registry[selected_dataset_name]
+    selected_dataset_min_max = (dataset_info["min"], dataset_info["max"])
     return selected_dataset_min_max
 
+@trace_functions.traced
 def get_filtered_dataset(selected_dataset_name, aoi_gdf, min_value, max_value, texture_classes):
-    selected_dataset = get_soil_dataset(aoi_gdf)[selected_dataset_name]
+    selected_dataset = get_soil_image(selected_dataset_name, aoi_gdf)
 
     if selected_dataset_name == 'Texture Class':
-        texture_values = {
-                'Clay': 1, 'Silty Clay': 2, 'Sandy Clay': 3, 'Clay Loam': 4,
-                'Silty Clay Loam': 5, 'Sandy Clay Loam': 6, 'Loam': 7, 'Silt Loam': 8,
-                'Sandy Loam': 9, 'Silt': 10, 'Loamy Sand': 11, 'Sand': 12
-            }
-
         mask = ee.Image(0)
 
         for selected_texture in texture_classes:
-            texture_value = texture_values[selected_texture]
+            texture_value = texture_class_values[selected_texture]
             texture_mask = selected_dataset.eq(texture_value)
             mask = mask.Or(texture_mask)
 
@@ -140,10 +213,11 @@ def get_filtered_dataset(selected_dataset_name, aoi_gdf, min_value, max_value, t
 
         return filtered_dataset
 
+@trace_functions.traced
 def get_overlaid_dataset(selected_datasets, aoi_gdf):
     if len(selected_datasets) > 1:
         with st.spinner(f"Analysing soil properties...", show_time=True):
-            aoi_ee = geemap.gdf_to_ee(aoi_gdf)
+            aoi_ee = aoi_functions.get_aoi_ee(aoi_gdf, "iSDA Soil")
             overlaid_dataset = ee.Image(0).clip(aoi_ee)
             for dataset in selected_datasets:
                 if dataset == 'Texture Class':
@@ -174,41 +248,10 @@ def get_overlaid_dataset(selected_datasets, aoi_gdf):
             filtered_dataset = get_filtered_dataset(name, aoi_gdf, min, max, None)
         return filtered_dataset
 
-# Get images for rainy season (Nov to Mar) only
-def get_rain_season_images(rainfall_dataset, start_year, end_year):
-    # Create empty image collection
-    merged_image_collection = ee.ImageCollection([])
-
-    for year in range(start_year, end_year):
-        # Nov to Dec of current year
-        start1 = ee.Date(f'{year}-11-01')
-        end1 = ee.Date(f'{year}-12-31')
-        season_part1 = rainfall_dataset.filterDate(start1, end1)
-
-        # Jan to Mar of following year
-        start2 = ee.Date(f'{year + 1}-01-01')
-        end2 = ee.Date(f'{year + 1}-03-31')
-        season_part2 = rainfall_dataset.filterDate(start2, end2)
-
-        # Merge image collection
-        merged_year_collection = season_part1.merge(season_part2)
-        merged_image_collection = merged_image_collection.merge(merged_year_collection)
-
-    return merged_image_collection
-
+@trace_functions.traced
 def get_avg_rainfall(start_year, end_year, aoi_ee):
-
-    rainfall_dataset = ee.ImageCollection("UCSB-CHG/CHIRPS/PENTAD") \
-            .select('precipitation')
-
-    no_years = end_year - start_year
-
-    # Get images for rainfal season between selected dates
-    seasonal_rainfall_dataset = get_rain_season_images(rainfall_dataset, start_year, end_year)
-
-    # Clip images to AOI and compute the mean
-    avg_rainfall = seasonal_rainfall_dataset.sum() \
-                    .divide(no_years) \
+    # Clip the rainy-season climatology to AOI
+    avg_rainfall = rainfall_functions.get_rainfall_climatology(start_year, end_year) \
                     .clip(aoi_ee)
 
     return avg_rainfall
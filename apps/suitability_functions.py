@@ -0,0 +1,227 @@
+import math
+import os
+import streamlit as st
+import ee
+import numpy as np
+import folium
+import rasterio
+from rasterio import features
+from rasterio.transform import Affine
+from apps import rainfall_functions, soil_functions, variables, ee_client
+
+# Local soil grid for Zambia (degrees, ~275 m) and the size of download tiles
+soil_grid_resolution = 0.0025
+download_tile_size = 2048
+
+@st.cache_resource(show_spinner=False)
+def get_soil_grid():
+    """Grid shared by all cached soil rasters: (transform, width, height, AOI mask)."""
+    zambia_gdf = variables.get_zambia_boundaries()
+    minx, miny, maxx, maxy = zambia_gdf.total_bounds
+
+    west = math.floor(minx / soil_grid_resolution) * soil_grid_resolution
+    north = math.ceil(maxy / soil_grid_resolution) * soil_grid_resolution
+    width = math.ceil((maxx - west) / soil_grid_resolution)
+    height = math.ceil((north - miny) / soil_grid_resolution)
+    transform = Affine(soil_grid_resolution, 0, west, 0, -soil_grid_resolution, north)
+
+    aoi_mask = features.geometry_mask(
+        zambia_gdf.to_crs(epsg=4326).geometry, out_shape=(height, width),
+        transform=transform, invert=True
+        )
+
+    return transform, width, height, aoi_mask
+
+def get_stored_soil_image(selected_dataset_name):
+    """Soil image as stored by iSDA (before the transform to real units)."""
+    if selected_dataset_name == "Annual Rainfall (mm)":
+        return rainfall_functions.get_rainfall_climatology(
+            rainfall_functions.default_start_year, rainfall_functions.default_end_year
+            ).toFloat()
+
+    asset = soil_functions.soil_dataset_registry[selected_dataset_name]["asset"]
+    return ee.Image(asset).select(0).toUint8()
+
+def download_soil_raster(selected_dataset_name, raster_path):
+    transform, width, height, _ = get_soil_grid()
+    stored_image = get_stored_soil_image(selected_dataset_name).unmask(0).rename('value')
+
+    dtype = 'float32' if selected_dataset_name == "Annual Rainfall (mm)" else 'uint8'
+    stored_values = np.zeros((height, width), dtype=dtype)
+
+    # Fetch the grid tile by tile to stay within computePixels request limits
+    for row_off in range(0, height, download_tile_size):
+        for col_off in range(0, width, download_tile_size):
+            tile_height = min(download_tile_size, height - row_off)
+            tile_width = min(download_tile_size, width - col_off)
+            tile_x, tile_y = transform * (col_off, row_off)
+
+            pixels = ee_client.compute_pixels({
+                'expression': stored_image,
+                'fileFormat': 'NUMPY_NDARRAY',
+                'grid': {
+                    'dimensions': {'width': tile_width, 'height': tile_height},
+                    'affineTransform': {
+                        'scaleX': transform.a, 'shearX': 0, 'translateX': tile_x,
+                        'shearY': 0, 'scaleY': transform.e, 'translateY': tile_y,
+                    },
+                    'crsCode': 'EPSG:4326',
+                },
+            })
+            stored_values[row_off:row_off + tile_height, col_off:col_off + tile_width] = pixels['value']
+
+    # Write to a temporary file first so a failed download is never cached
+    with variables.temp_write_path(raster_path) as temp_path:
+        with rasterio.open(
+            temp_path, 'w', driver='GTiff', width=width, height=height, count=1,
+            dtype=dtype, crs='EPSG:4326', transform=transform, compress='deflate'
+        ) as dst:
+            dst.write(stored_values, 1)
+
+@st.cache_resource(show_spinner=False)
+def load_soil_raster(selected_dataset_name):
+    """Stored values of a soil dataset on the local grid, shared across sessions."""
+    file_name = soil_functions.get_dataset_file_name(selected_dataset_name)
+    raster_path = variables.get_cache_path("soil", f"{file_name}.tif")
+
+    if not os.path.exists(raster_path):
+        download_soil_raster(selected_dataset_name, raster_path)
+
+    with rasterio.open(raster_path) as src:
+        stored_values = src.read(1)
+    stored_values.setflags(write=False)
+
+    return stored_values
+
+def to_stored_value(value, transform):
+    """Inverse of soil_functions.apply_soil_transform for a threshold value."""
+    if transform is None:
+        return value
+
+    operation, divisor = transform
+    if operation == "divide":
+        return value * divisor
+    elif operation == "expm1":
+        return divisor * math.log1p(value)
+    else:
+        raise ValueError(f"Unknown soil dataset transform: {operation}")
+
+def get_criterion_mask(selected_dataset_name, criterion):
+    """Boolean mask of pixels meeting one criterion (a [min, max] range or texture names)."""
+    stored_values = load_soil_raster(selected_dataset_name)
+    _, _, _, aoi_mask = get_soil_grid()
+
+    if selected_dataset_name == 'Texture Class':
+        texture_values = [soil_functions.texture_class_values[name] for name in criterion]
+        mask = np.isin(stored_values, texture_values)
+    else:
+        # Compare in stored units so the raster never has to be converted
+        transform = soil_functions.soil_dataset_registry[selected_dataset_name]["transform"]
+        min_value = to_stored_value(criterion[0], transform)
+        max_value = to_stored_value(criterion[1], transform)
+        mask = (stored_values >= min_value) & (stored_values <= max_value)
+
+    return mask & aoi_mask
+
+class SuitabilityEngine:
+    """Per-session suitability stack with one packed bitmask per criterion.
+
+    Changing one criterion recomputes only its mask; the per-pixel count of
+    satisfied criteria is updated by removing the old bits and adding the new.
+    """
+    def __init__(self):
+        _, width, height, _ = get_soil_grid()
+        self.shape = (height, width)
+        self.size = height * width
+        self.criteria = {}
+        self.masks = {}
+        self.counts = np.zeros(self.size, dtype=np.uint8)
+
+    def unpack(self, packed_mask):
+        return np.unpackbits(packed_mask, count=self.size)
+
+    def set_criterion(self, selected_dataset_name, criterion):
+        criterion = list(criterion)
+        if self.criteria.get(selected_dataset_name) == criterion:
+            return False
+
+        self.remove_criterion(selected_dataset_name)
+
+        mask = get_criterion_mask(selected_dataset_name, criterion).ravel()
+        self.masks[selected_dataset_name] = np.packbits(mask)
+        self.criteria[selected_dataset_name] = criterion
+        self.counts += mask
+
+        return True
+
+    def remove_criterion(self, selected_dataset_name):
+        if selected_dataset_name in self.masks:
+            self.counts -= self.unpack(self.masks.pop(selected_dataset_name))
+            del self.criteria[selected_dataset_name]
+
+    def update(self, selected_datasets):
+        """Sync with the {dataset name: criterion} selections, recomputing only what changed."""
+        for selected_dataset_name in list(self.criteria):
+            if selected_dataset_name not in selected_datasets:
+                self.remove_criterion(selected_dataset_name)
+
+        changed = [
+            selected_dataset_name for selected_dataset_name, criterion in selected_datasets.items()
+            if self.set_criterion(selected_dataset_name, criterion)
+        ]
+        return changed
+
+    def get_counts(self):
+        return self.counts.reshape(self.shape)
+
+    def get_weighted_scores(self, weights):
+        """Weighted share (0 to 1) of the criteria met by each pixel."""
+        total_weight = sum(weights.get(name, 1) for name in self.masks)
+        scores = np.zeros(self.size, dtype=np.float32)
+        if total_weight == 0:
+            return scores.reshape(self.shape)
+
+        for selected_dataset_name, packed_mask in self.masks.items():
+            weight = weights.get(selected_dataset_name, 1)
+            if weight:
+                scores += self.unpack(packed_mask) * np.float32(weight / total_weight)
+
+        return scores.reshape(self.shape)
+
+def get_suitability_engine():
+    if 'suitability_engine' not in st.session_state:
+        st.session_state['suitability_engine'] = SuitabilityEngine()
+    return st.session_state['suitability_engine']
+
+def hex_to_rgb(color):
+    color = color.lstrip('#')
+    return [int(color[i:i + 2], 16) for i in (0, 2, 4)]
+
+def add_suitability_overlay(m, scores, min_value, max_value, palette, name, display_stride=2):
+    """Add a local score array to a folium map, transparent where the score is zero."""
+    transform, _, _, aoi_mask = get_soil_grid()
+    scores = scores[::display_stride, ::display_stride]
+    visible = (scores > 0) & aoi_mask[::display_stride, ::display_stride]
+
+    # Map scores onto the palette
+    palette_rgb = np.array([hex_to_rgb(color) for color in palette], dtype=np.uint8)
+    scaled = (scores.astype(np.float32) - min_value) / max(max_value - min_value, 1e-9)
+    palette_index = np.clip(np.rint(scaled * (len(palette) - 1)), 0, len(palette) - 1).astype(int)
+
+    rgba = np.zeros(scores.shape + (4,), dtype=np.uint8)
+    rgba[..., :3] = palette_rgb[palette_index]
+    rgba[..., 3] = np.where(visible, 255, 0)
+
+    height, width = aoi_mask.shape
+    west, north = transform * (0, 0)
+    east, south = transform * (width, height)
+
+    folium.raster_layers.ImageOverlay(
+        image=rgba,
+        bounds=[[south, west], [north, east]],
+        mercator_project=True,
+        name=name,
+        overlay=True,
+        control=True,
+    ).add_to(m)
+    return m
@@ -0,0 +1,92 @@
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+import streamlit as st
+
+# Slow Earth Engine statistics run in background workers while the rest of
+# the page is already displayed; fragments showing them poll at this interval
+background_workers = 4
+poll_interval = "1s"
+
+class TaskCancelled(CancelledError):
+    """Raised inside a background task whose result is no longer needed."""
+
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise TaskCancelled()
+
+@st.cache_resource(show_spinner=False)
+def get_background_executor():
+    """Worker pool shared by all sessions of the process."""
+    return ThreadPoolExecutor(max_workers=background_workers, thread_name_prefix="background_task")
+
+def get_session_tasks():
+    if 'background_tasks' not in st.session_state:
+        st.session_state['background_tasks'] = {}
+    return st.session_state['background_tasks']
+
+def cancel_task(task_name):
+    """Cancel a session's task: dropped if still queued, stopped at its next check if running."""
+    task = get_session_tasks().pop(task_name, None)
+    if task is not None:
+        task['cancel_event'].set()
+        task['future'].cancel()
+
+def submit_task(task_name, task_key, task_function, *args, **kwargs):
+    """Run `task_function` in the background for this session.
+
+    `task_key` identifies the selection the result belongs to. Submitting the
+    same key again returns the running or finished task; a new key cancels
+    the older task first. The function is given a `cancel_event` to check
+    between expensive steps.
+    """
+    task = get_session_tasks().get(task_name)
+    if task is not None and task['key'] == task_key:
+        return task['future']
+
+    cancel_task(task_name)
+
+    cancel_event = threading.Event()
+    future = get_background_executor().submit(
+        task_function, *args, cancel_event=cancel_event, **kwargs
+        )
+    get_session_tasks()[task_name] = {'key': task_key, 'future': future, 'cancel_event': cancel_event}
+
+    return future
+
+def get_task(task_name, task_key):
+    """Future of the session's task for `task_key`, or None if none was submitted for it."""
+    task = get_session_tasks().get(task_name)
+    if task is None or task['key'] != task_key:
+        return None
+    return task['future']
+
+def show_task_result_fragment(task_future, show_result, pending_message, error_message, polling):
+    if not task_future.done():
+        st.info(pending_message)
+        return
+
+    # Rerun the page around the fragment, which shows the result without polling
+    if polling:
+        st.rerun(scope="app")
+
+    try:
+        task_result = task_future.result()
+    except CancelledError:
+        return
+    except Exception as e:
+        st.warning(f"{error_message}: {e}")
+        return
+
+    show_result(task_result)
+
+def show_task_result(task_future, show_result, pending_message="Calculating metrics...",
+                     error_message="Unable to calculate metrics"):
+    """Show a background task's result with `show_result`, polling until it is done.
+
+    Only this fragment reruns while polling; once the result arrives the page
+    is rerun so that it is shown by a fragment that no longer polls.
+    """
+    polling = not task_future.done()
+    st.fragment(show_task_result_fragment, run_every=poll_interval if polling else None)(
+        task_future, show_result, pending_message, error_message, polling
+        )
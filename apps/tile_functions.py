@@ -0,0 +1,207 @@
+import json
+import math
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import folium
+from shapely.geometry import box
+from apps import aoi_functions, soil_functions, variables, ee_client
+
+# Zoom levels pre-rendered for national soil layers; Leaflet upsamples beyond
+# the last level, which is already finer than the iSDA analysis scale
+soil_tile_zoom_range = (5, 10)
+tile_download_workers = 8
+
+# The tiles are written out of their MBTiles archives as <z>/<x>/<y>.png
+# files under static/tiles, which Streamlit's static file server
+# (server.enableStaticServing) serves to the maps; set SOIL_TILE_URL when they
+# are served from elsewhere
+soil_tile_dir = os.path.join("static", "tiles")
+soil_tile_url = os.environ.get("SOIL_TILE_URL", "app/static/tiles")
+
+# The sessions of a process write the static tiles one at a time
+static_tiles_lock = threading.Lock()
+
+def get_mbtiles_path(selected_dataset_name):
+    file_name = soil_functions.get_dataset_file_name(selected_dataset_name)
+    return variables.get_cache_path("tiles", f"{file_name}.mbtiles")
+
+def lonlat_to_tile(lon, lat, zoom):
+    n = 2 ** zoom
+    x = int((lon + 180) / 360 * n)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_to_bounds(x, y, zoom):
+    """(west, south, east, north) of a web mercator tile."""
+    n = 2 ** zoom
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    south = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+def get_aoi_tiles(aoi_gdf, zoom):
+    """Tiles at a zoom level that intersect the AOI polygons."""
+    aoi_geometry = aoi_functions.get_simplified_aoi_gdf(aoi_gdf, "iSDA Soil").union_all()
+    minx, miny, maxx, maxy = aoi_geometry.bounds
+    min_x, min_y = lonlat_to_tile(minx, maxy, zoom)
+    max_x, max_y = lonlat_to_tile(maxx, miny, zoom)
+
+    aoi_tiles = [
+        (x, y)
+        for x in range(min_x, max_x + 1)
+        for y in range(min_y, max_y + 1)
+        if aoi_geometry.intersects(box(*tile_to_bounds(x, y, zoom)))
+    ]
+    return aoi_tiles
+
+def get_soil_tile_legend(selected_dataset_name, soil_dataset, aoi_gdf):
+    """Visparams and legend entries stored alongside the tiles."""
+    if selected_dataset_name == 'Texture Class':
+        visparams, texture_names, texture_palette = soil_functions.get_soil_dataset_visparams(
+            selected_dataset_name, soil_dataset, aoi_gdf
+            )
+        return {'visparams': visparams, 'texture_names': texture_names, 'texture_palette': texture_palette}
+
+    visparams = soil_functions.get_soil_dataset_visparams(selected_dataset_name, soil_dataset, aoi_gdf)
+    return {'visparams': visparams}
+
+def fetch_tile(url_format, zoom, x, y):
+    tile_url = url_format.format(z=zoom, x=x, y=y)
+    with urllib.request.urlopen(tile_url, timeout=60) as response:
+        return zoom, x, y, response.read()
+
+def build_soil_tile_pyramid(selected_dataset_name, min_zoom=None, max_zoom=None):
+    """Render a national soil dataset into an MBTiles archive."""
+    min_zoom = soil_tile_zoom_range[0] if min_zoom is None else min_zoom
+    max_zoom = soil_tile_zoom_range[1] if max_zoom is None else max_zoom
+
+    zambia_gdf = variables.get_zambia_boundaries()
+    soil_dataset = soil_functions.get_soil_image(selected_dataset_name, zambia_gdf)
+    legend = get_soil_tile_legend(selected_dataset_name, soil_dataset, zambia_gdf)
+    url_format = ee_client.get_map_id(soil_dataset, legend['visparams'])['tile_fetcher'].url_format
+
+    mbtiles_path = get_mbtiles_path(selected_dataset_name)
+    with variables.temp_write_path(mbtiles_path) as temp_path:
+        connection = sqlite3.connect(temp_path)
+        connection.execute("CREATE TABLE metadata (name TEXT, value TEXT)")
+        connection.execute(
+            "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)"
+            )
+        connection.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+
+        minx, miny, maxx, maxy = zambia_gdf.total_bounds
+        metadata = {
+            'name': selected_dataset_name,
+            'format': 'png',
+            'type': 'overlay',
+            'minzoom': str(min_zoom),
+            'maxzoom': str(max_zoom),
+            'bounds': f"{minx},{miny},{maxx},{maxy}",
+            'legend': json.dumps(legend),
+        }
+        connection.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+
+        with ThreadPoolExecutor(max_workers=tile_download_workers) as executor:
+            for zoom in range(min_zoom, max_zoom + 1):
+                tile_requests = [
+                    executor.submit(fetch_tile, url_format, zoom, x, y)
+                    for x, y in get_aoi_tiles(zambia_gdf, zoom)
+                ]
+                for tile_request in tile_requests:
+                    zoom_level, x, y, tile_data = tile_request.result()
+                    # MBTiles rows count from the bottom (TMS)
+                    connection.execute(
+                        "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                        (zoom_level, x, 2 ** zoom_level - 1 - y, sqlite3.Binary(tile_data))
+                        )
+                connection.commit()
+
+        connection.close()
+    write_static_tiles(selected_dataset_name)
+
+def get_soil_tiles_metadata(selected_dataset_name):
+    """Metadata of a dataset's tile pyramid, or None if it has not been built."""
+    mbtiles_path = get_mbtiles_path(selected_dataset_name)
+    if not os.path.exists(mbtiles_path):
+        return None
+
+    connection = sqlite3.connect(f"file:{mbtiles_path}?mode=ro", uri=True)
+    metadata = dict(connection.execute("SELECT name, value FROM metadata").fetchall())
+    connection.close()
+
+    metadata['legend'] = json.loads(metadata['legend'])
+    return metadata
+
+def get_static_tiles_dir(selected_dataset_name):
+    return os.path.join(soil_tile_dir, soil_functions.get_dataset_file_name(selected_dataset_name))
+
+def write_static_tiles(selected_dataset_name):
+    """Write the tiles of a dataset's MBTiles archive as files for the static file server."""
+    tiles_dir = get_static_tiles_dir(selected_dataset_name)
+    os.makedirs(soil_tile_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(suffix=".part", dir=soil_tile_dir)
+
+    connection = sqlite3.connect(f"file:{get_mbtiles_path(selected_dataset_name)}?mode=ro", uri=True)
+    for zoom, x, tile_row, tile_data in connection.execute(
+        "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"
+        ):
+        # MBTiles rows count from the bottom (TMS)
+        tile_path = os.path.join(temp_dir, str(zoom), str(x), f"{2 ** zoom - 1 - tile_row}.png")
+        os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+        with open(tile_path, "wb") as tile_file:
+            tile_file.write(tile_data)
+    connection.close()
+
+    # The tiles of an older archive are replaced as a whole
+    shutil.rmtree(tiles_dir, ignore_errors=True)
+    try:
+        os.replace(temp_dir, tiles_dir)
+    except OSError:
+        # Written by another process in the meantime
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def get_static_tiles_url(selected_dataset_name):
+    """URL template of a dataset's static tiles, written anew when its archive has changed."""
+    tiles_dir = get_static_tiles_dir(selected_dataset_name)
+    with static_tiles_lock:
+        if not os.path.isdir(tiles_dir) or os.path.getmtime(tiles_dir) < os.path.getmtime(get_mbtiles_path(selected_dataset_name)):
+            write_static_tiles(selected_dataset_name)
+
+    file_name = soil_functions.get_dataset_file_name(selected_dataset_name)
+    return f"{soil_tile_url}/{file_name}/{{z}}/{{x}}/{{y}}.png"
+
+def add_soil_tile_layer(m, selected_dataset_name, shown=True, opacity=1.0):
+    """Add a pre-rendered soil dataset to a folium map from its static tiles."""
+    metadata = get_soil_tiles_metadata(selected_dataset_name)
+    minx, miny, maxx, maxy = map(float, metadata['bounds'].split(","))
+
+    # Tiles are scaled beyond the rendered zoom levels, and only requested
+    # within the rendered bounds
+    folium.raster_layers.TileLayer(
+        tiles=get_static_tiles_url(selected_dataset_name),
+        attr='iSDA soil / CHIRPS via Google Earth Engine',
+        name=selected_dataset_name,
+        overlay=True,
+        control=True,
+        show=shown,
+        opacity=opacity,
+        min_zoom=0,
+        min_native_zoom=int(metadata['minzoom']),
+        max_native_zoom=int(metadata['maxzoom']),
+        bounds=[[miny, minx], [maxy, maxx]],
+    ).add_to(m)
+    return m
+
+if __name__ == "__main__":
+    # Build the national tile pyramids offline: python -m apps.tile_functions
+    from apps import access
+    access.ee_to_st()
+    for selected_dataset_name in soil_functions.get_soil_dataset(None):
+        print(f"Rendering tiles for {selected_dataset_name}...")
+        build_soil_tile_pyramid(selected_dataset_name)
@@ -0,0 +1,132 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import streamlit as st
+import pandas as pd
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+# Spans of each rerun are kept in the session for the sidebar panel, and
+# optionally appended to a JSONL file for offline analysis: set TRACE_FILE
+# (e.g. data/cache/traces/spans.jsonl). The file is rotated to <file>.1 once
+# it grows past TRACE_FILE_MAX_MB.
+trace_file_path = os.environ.get("TRACE_FILE", "")
+trace_file_max_bytes = float(os.environ.get("TRACE_FILE_MAX_MB", 50)) * 1024 * 1024
+trace_file_lock = threading.Lock()
+
+current_span_var = contextvars.ContextVar("current_span", default=None)
+
+def get_payload_size(value, deep=False):
+    """Approximate size in bytes of a span's payload, or None if unknown.
+
+    DataFrames are measured without their objects (strings, geometries)
+    unless `deep`, which costs a pass over every value.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=deep).sum())
+    if isinstance(value, (dict, list)):
+        return len(json.dumps(value, default=str))
+    return None
+
+def get_rerun_trace():
+    """Trace of the current rerun, or None outside a script run (e.g. background tasks)."""
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.get('trace_rerun')
+
+def start_rerun(page):
+    st.session_state['trace_rerun'] = {
+        'rerun_id': uuid.uuid4().hex[:12],
+        'page': page,
+        'spans': [],
+    }
+
+def write_span(span_record):
+    if not trace_file_path:
+        return
+    os.makedirs(os.path.dirname(trace_file_path) or ".", exist_ok=True)
+    with trace_file_lock:
+        with open(trace_file_path, "a") as trace_file:
+            trace_file.write(json.dumps(span_record, default=str) + "\n")
+        if os.path.getsize(trace_file_path) > trace_file_max_bytes:
+            os.replace(trace_file_path, f"{trace_file_path}.1")
+
+@contextmanager
+def span(name):
+    """Time a block of code; set span["bytes"] inside the block to record its payload size."""
+    parent = current_span_var.get()
+    current_span = {
+        'name': name,
+        'parent': parent['name'] if parent else None,
+        'depth': parent['depth'] + 1 if parent else 0,
+        'bytes': None,
+    }
+    token = current_span_var.set(current_span)
+    start_time = time.time()
+    start_counter = time.perf_counter()
+    error = None
+    try:
+        yield current_span
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        current_span_var.reset(token)
+
+        rerun_trace = get_rerun_trace()
+        span_record = {
+            'rerun_id': rerun_trace['rerun_id'] if rerun_trace else None,
+            'page': rerun_trace['page'] if rerun_trace else None,
+            'thread': threading.current_thread().name,
+            'start': round(start_time, 3),
+            'duration_ms': round((time.perf_counter() - start_counter) * 1000, 2),
+            'error': error,
+            **current_span,
+        }
+        if rerun_trace is not None:
+            rerun_trace['spans'].append(span_record)
+        write_span(span_record)
+
+def traced(func=None, name=None):
+    """Decorator recording a span per call, with the size of the returned value."""
+    if func is None:
+        return functools.partial(traced, name=name)
+
+    span_name = name or f"{func.__module__.split('.')[-1]}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(span_name) as current_span:
+            result = func(*args, **kwargs)
+            current_span['bytes'] = get_payload_size(result)
+        return result
+
+    return wrapper
+
+def show_trace_panel():
+    """Optional sidebar table of the spans recorded in the last rerun."""
+    rerun_trace = get_rerun_trace()
+    if rerun_trace is None:
+        return
+
+    with st.sidebar:
+        if not st.checkbox("Show performance trace", value=False, key="show_trace_panel"):
+            return
+
+        spans_df = pd.DataFrame(
+            rerun_trace['spans'], columns=['start', 'depth', 'name', 'duration_ms', 'bytes', 'error']
+            ).sort_values('start')
+        spans_df['name'] = spans_df['depth'].map(lambda depth: "  " * depth) + spans_df['name']
+
+        st.caption(f"Rerun {rerun_trace['rerun_id']} of {rerun_trace['page']}")
+        st.dataframe(
+            spans_df[['name', 'duration_ms', 'bytes', 'error']], hide_index=True
+            )
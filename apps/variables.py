@@ -1,17 +1,123 @@
+import os
 import streamlit as st
 import geopandas as gpd
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.ipc
 import datetime
+import functools
+import tempfile
+import threading
+from contextlib import contextmanager
+from apps import trace_functions
+
+# Directory for locally cached derived data (rasters, tables, tiles)
+cache_dir = r"data/cache"
+
+# Vector layers are read from their files on every load by default. With
+# VECTOR_LOADER=arrow each layer is written once to an Arrow IPC file
+# (geometry as WKB) that every Streamlit process memory-maps, so the layer's
+# pages are shared between the processes instead of copied into each one
+vector_loader = os.environ.get("VECTOR_LOADER", "file")
+
+# The sessions of a process check and write the Arrow files one at a time
+arrow_lock = threading.Lock()
+
+def get_cache_path(*path_parts):
+    cache_path = os.path.join(cache_dir, *path_parts)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    return cache_path
+
+@contextmanager
+def temp_write_path(path):
+    """Temporary path to write a file to, moved into place as `path` once written.
+
+    Its name is unique to the writer, so threads and processes writing the
+    same file at once never write into each other's file, and readers never
+    see a partial one. It is removed if the write fails.
+    """
+    temp_fd, temp_path = tempfile.mkstemp(
+        prefix=f"{os.path.basename(path)}.", suffix=".part", dir=os.path.dirname(path) or "."
+        )
+    os.close(temp_fd)
+    try:
+        yield temp_path
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def get_arrow_path(vector_path):
+    file_name = os.path.splitext(os.path.basename(vector_path))[0]
+    return get_cache_path("arrow", f"{file_name}.arrow")
+
+def write_arrow_layer(vector_path, arrow_path):
+    """Write a vector layer to an Arrow IPC file with WKB geometry."""
+    table = pa.table(gpd.read_file(vector_path).to_arrow(geometry_encoding="WKB", index=False))
+
+    with temp_write_path(arrow_path) as temp_path:
+        with pa.OSFile(temp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+@st.cache_resource(show_spinner=False)
+def open_arrow_layer(arrow_path, modified_time):
+    """Memory-mapped table of a layer, opened once per process and file version."""
+    return pa.ipc.open_file(pa.memory_map(arrow_path)).read_all()
+
+def get_vector_table(vector_path):
+    """Memory-mapped Arrow table of a vector layer, written anew when the layer has changed."""
+    arrow_path = get_arrow_path(vector_path)
+    with arrow_lock:
+        if not os.path.exists(arrow_path) or os.path.getmtime(arrow_path) < os.path.getmtime(vector_path):
+            write_arrow_layer(vector_path, arrow_path)
+
+    return open_arrow_layer(arrow_path, os.path.getmtime(arrow_path))
+
+def read_vector(vector_path, columns=None, filters=None):
+    """GeoDataFrame of a vector layer, optionally with only some of its columns
+    and only the rows whose columns equal the values of `filters`.
+
+    In arrow mode the rows and columns are selected on the mapped table, so
+    only those are copied and only their geometries decoded.
+    """
+    filters = filters or {}
+    if vector_loader != "arrow":
+        gdf = gpd.read_file(vector_path, columns=columns)
+        for column, value in filters.items():
+            gdf = gdf[gdf[column] == value]
+        return gdf
+
+    table = get_vector_table(vector_path)
+    if filters:
+        table = table.filter(functools.reduce(
+            lambda mask, condition: mask & condition,
+            [pc.field(column) == value for column, value in filters.items()],
+            ))
+    if columns is not None:
+        table = table.select(list(dict.fromkeys(columns + ["geometry"])))
+    return gpd.GeoDataFrame.from_arrow(table)
+
+def read_vector_attributes(vector_path, columns):
+    """DataFrame of some columns of a vector layer, without its geometry."""
+    if vector_loader != "arrow":
+        return gpd.read_file(vector_path, columns=columns, ignore_geometry=True)
+    return get_vector_table(vector_path).select(columns).to_pandas()
 
 # import farms vector file as a gdf
 
+@trace_functions.traced
 def get_farms_gdf():
-    farms_gdf = gpd.read_file(r"data/vector/ce_farms.gpkg")
-    farms_gdf = farms_gdf[['farmer','Classifica', 'crop','variety','model', 'district', 'province', 'area_hectares', 'geometry', 'year']]
+    farm_cols = ['farmer','Classifica', 'crop','variety','model', 'district', 'province', 'area_hectares', 'geometry', 'year']
+    farms_gdf = read_vector(r"data/vector/ce_farms.gpkg", columns=farm_cols)
+    farms_gdf = farms_gdf[farm_cols]
     return farms_gdf
 
 
+@trace_functions.traced
 def get_sh_farms():
-    gdf = gpd.read_file(r"data/vector/field_measure_farms.gpkg")
+    gdf = read_vector(r"data/vector/field_measure_farms.gpkg")
     # gdf = gdf[:500]
     # gdf = gdf[['farmer_id', 'camp', 'pea', 'hub', 'fs', 'district', 'region','geometry']]
     gdf['lon'] = gdf.geometry.x
@@ -19,30 +125,68 @@ def get_sh_farms():
 
     return gdf
 
+@trace_functions.traced
 def get_pea_locations():
-    gdf5 = gpd.read_file(r"data/vector/Pea_locations.gpkg")
+    gdf5 = read_vector(r"data/vector/Pea_locations.gpkg")
     return gdf5
 
-def get_fs_catchment_boundaries():
-    gdf6 = gpd.read_file(r"data/vector/fs_catchment_boundaries.gpkg")
+@trace_functions.traced
+def get_fs_catchment_boundaries(filters=None):
+    gdf6 = read_vector(r"data/vector/fs_catchment_boundaries.gpkg", filters=filters)
     return gdf6
 
+@trace_functions.traced
+def get_fs_catchment_attributes(columns):
+    """Attributes of the FS catchments, e.g. for selectors, without their boundaries."""
+    return read_vector_attributes(r"data/vector/fs_catchment_boundaries.gpkg", columns)
+
+@trace_functions.traced
 def get_zambia_boundaries():
-    gdf7 = gpd.read_file(r"data/vector/zambia_aoi.gpkg")
+    gdf7 = read_vector(r"data/vector/zambia_aoi.gpkg")
     return gdf7
 
+@trace_functions.traced
 def get_foundation_farm_boundaries():
-    gdf2 = gpd.read_file(r"data/vector/Foundation_Farm_Boundary.gpkg")
+    gdf2 = read_vector(r"data/vector/Foundation_Farm_Boundary.gpkg")
     return gdf2
 
+@trace_functions.traced
 def get_buildings():
-    gdf3 = gpd.read_file(r"data/vector/Buildings_2.gpkg")
+    gdf3 = read_vector(r"data/vector/Buildings_2.gpkg")
     return gdf3
 
+@trace_functions.traced
 def get_Crop_blocks():
-    gdf4 = gpd.read_file(r"data/vector/Crop_Blocks.gpkg")
+    gdf4 = read_vector(r"data/vector/Crop_Blocks.gpkg")
     return gdf4
 
+@trace_functions.traced
+@st.cache_data(show_spinner=False)
+def get_planting_history():
+    """Foundation Farm planting records, normalised and indexed on (block, year, season, rotation)."""
+    history = pd.read_csv("planting_records.csv")
+    history = history.rename(columns={"Name": "Block_name", "rotation_o": "rotation_order"})
+
+    history["Block_name"] = history["Block_name"].str.strip().str.lower()
+    history["season"] = history["season"].str.strip().str.lower()
+
+    history = history.set_index(["Block_name", "year", "season", "rotation_order"])
+    return history
+
+@trace_functions.traced
+def get_filtered_planting_history(selected_year="All", selected_season="All", selected_rotation="All"):
+    history = get_planting_history()
+
+    mask = pd.Series(True, index=history.index)
+    if selected_year != "All":
+        mask &= history.index.get_level_values("year") == selected_year
+    if selected_season != "All":
+        mask &= history.index.get_level_values("season") == selected_season
+    if selected_rotation != "All":
+        mask &= history.index.get_level_values("rotation_order") == selected_rotation
+
+    return history[mask.to_numpy()].reset_index()
+
 def available_crop_health_metrics():
     health_metrics = ['Crop Health', 'Crop Moisture', ]
     return health_metrics
@@ -212,3 +356,13 @@ def add_selectors_crop_monitor(backtrack_days=7):
             )
 
     return selected_year, selected_farm_name, selected_index, selected_start_date, selected_end_date, max_cloud_cover
+
+if __name__ == "__main__":
+    # Write the Arrow files before starting the app processes:
+    # python -m apps.variables
+    vector_dir = r"data/vector"
+    for file_name in sorted(os.listdir(vector_dir)):
+        if file_name.endswith(".gpkg"):
+            print(f"Writing {file_name} to Arrow...")
+            vector_path = os.path.join(vector_dir, file_name)
+            write_arrow_layer(vector_path, get_arrow_path(vector_path))
@@ -0,0 +1,136 @@
+import os
+import streamlit as st
+import ee
+import geemap
+import pandas as pd
+from apps import aoi_functions, soil_functions, variables, ee_client, task_functions
+
+# Polygon layers with the columns identifying each polygon and the reduction
+# scale (m): iSDA native resolution for farms, coarser for large catchments
+zonal_stats_layers = {
+    "Farms": {
+        "loader": variables.get_farms_gdf,
+        "id_cols": ['farmer', 'year', 'crop'],
+        "scale": 30,
+    },
+    "FS Catchments": {
+        "loader": variables.get_fs_catchment_boundaries,
+        "id_cols": ['Name', 'Hub Name', 'FE Region'],
+        "scale": 250,
+    },
+}
+zonal_percentiles = [10, 50, 90]
+zonal_chunk_size = 25
+
+def get_zonal_stats_path(layer_name):
+    file_name = layer_name.lower().replace(" ", "_")
+    return variables.get_cache_path("zonal_stats", f"{file_name}.parquet")
+
+def get_zonal_reducer(selected_dataset_name):
+    # Texture classes are categorical, so only the dominant class is meaningful
+    if selected_dataset_name == 'Texture Class':
+        return ee.Reducer.mode()
+
+    reducer = ee.Reducer.mean() \
+        .combine(ee.Reducer.minMax(), sharedInputs=True) \
+        .combine(ee.Reducer.percentile(zonal_percentiles), sharedInputs=True)
+    return reducer
+
+def get_zonal_stat_names(selected_dataset_name):
+    if selected_dataset_name == 'Texture Class':
+        return ['mode']
+    return ['mean', 'min', 'max'] + [f"p{percentile}" for percentile in zonal_percentiles]
+
+def get_zone_chunks(layer_gdf, scale):
+    """Earth Engine FeatureCollections of at most zonal_chunk_size polygons each."""
+    zones_gdf = layer_gdf[['geometry']].copy()
+    zones_gdf['zone_index'] = range(len(zones_gdf))
+
+    chunks = []
+    for chunk_start in range(0, len(zones_gdf), zonal_chunk_size):
+        chunk_gdf = zones_gdf.iloc[chunk_start:chunk_start + zonal_chunk_size]
+        analysis_scale = "iSDA Soil" if scale >= 250 else "Sentinel-2"
+        chunk_gdf = aoi_functions.get_simplified_aoi_gdf(chunk_gdf, analysis_scale)
+        chunks.append(geemap.gdf_to_ee(chunk_gdf))
+
+    return chunks
+
+def reduce_dataset_over_zones(selected_dataset_name, zone_chunks, scale):
+    """One chunked reduceRegions pass of a dataset over every polygon of a layer."""
+    soil_image = soil_functions.build_soil_image(selected_dataset_name)
+    reducer = get_zonal_reducer(selected_dataset_name)
+    stat_names = get_zonal_stat_names(selected_dataset_name)
+
+    rows = []
+    for zone_chunk in zone_chunks:
+        reduced_zones = ee_client.get_info(soil_image.reduceRegions(
+            collection=zone_chunk, reducer=reducer, scale=scale, tileScale=4
+            ), kind="reduce")
+
+        for feature in reduced_zones['features']:
+            properties = feature['properties']
+            row = {'zone_index': properties['zone_index']}
+            for stat_name in stat_names:
+                row[f"{selected_dataset_name} {stat_name}"] = properties.get(stat_name)
+            rows.append(row)
+
+    dataset_stats_df = pd.DataFrame(rows).set_index('zone_index')
+    return dataset_stats_df
+
+def build_zonal_stats(layer_name):
+    """Compute every soil dataset over every polygon of a layer and store a wide Parquet table."""
+    layer_info = zonal_stats_layers[layer_name]
+    layer_gdf = layer_info["loader"]().reset_index(drop=True)
+    zone_chunks = get_zone_chunks(layer_gdf, layer_info["scale"])
+
+    zonal_stats_df = layer_gdf[layer_info["id_cols"]].copy()
+    for selected_dataset_name in soil_functions.get_soil_dataset(None):
+        dataset_stats_df = reduce_dataset_over_zones(
+            selected_dataset_name, zone_chunks, layer_info["scale"]
+            )
+        zonal_stats_df = zonal_stats_df.join(dataset_stats_df)
+
+    # Store texture classes by name rather than by value
+    texture_names = {value: name for name, value in soil_functions.texture_class_values.items()}
+    zonal_stats_df['Texture Class mode'] = zonal_stats_df['Texture Class mode'].map(
+        lambda value: texture_names.get(int(value)) if pd.notna(value) else None
+        )
+
+    zonal_stats_path = get_zonal_stats_path(layer_name)
+    with variables.temp_write_path(zonal_stats_path) as temp_path:
+        zonal_stats_df.to_parquet(temp_path, index=False)
+
+    return zonal_stats_df
+
+@st.cache_data(show_spinner=False)
+def load_zonal_stats(layer_name, modified_time):
+    return pd.read_parquet(get_zonal_stats_path(layer_name))
+
+@st.cache_resource(show_spinner=False)
+def get_zonal_stats_build(layer_name):
+    """Build of a layer's statistics in a background worker, started once per process."""
+    return task_functions.get_background_executor().submit(build_zonal_stats, layer_name)
+
+def get_zonal_stats(layer_name):
+    """Stored soil statistics of a layer, or None while they are built in the background.
+
+    Raises the error of a failed build, which is tried again on the next request.
+    """
+    zonal_stats_path = get_zonal_stats_path(layer_name)
+    if not os.path.exists(zonal_stats_path):
+        zonal_stats_build = get_zonal_stats_build(layer_name)
+        if not zonal_stats_build.done():
+            return None
+        get_zonal_stats_build.clear(layer_name)
+        zonal_stats_build.result()
+
+    # The file's modification time invalidates the in-memory copy after a rebuild
+    return load_zonal_stats(layer_name, os.path.getmtime(zonal_stats_path))
+
+if __name__ == "__main__":
+    # Rebuild the tables offline: python -m apps.zonal_stats_functions
+    from apps import access
+    access.ee_to_st()
+    for layer_name in zonal_stats_layers:
+        print(f"Computing soil statistics for {layer_name}...")
+        build_zonal_stats(layer_name)
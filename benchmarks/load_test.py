@@ -0,0 +1,400 @@
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+from unittest.mock import MagicMock
+
+# Headless load test: N concurrent sessions click through the app with
+# Streamlit's AppTest against the offline Earth Engine stand-in:
+#   python -m benchmarks.load_test --sessions 8 --iterations 2
+# Reports per-rerun latencies, peak RSS, and data loads and Earth Engine
+# calls per session. With EE_CASSETTE_MODE=replay the sessions are answered
+# from a cassette recorded against Earth Engine (see apps/ee_client.py).
+# With --check-prewarm it only checks that a session opening the prewarmed
+# pages with their default selections is served prewarmed maps.
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+from benchmarks import offline_ee
+
+# Must happen before the app modules import ee and geemap; a replayed
+# cassette needs the real client, whose expressions its requests were keyed on
+if os.environ.get("EE_CASSETTE_MODE") != "replay":
+    offline_ee.install()
+
+import geopandas as gpd
+import pandas as pd
+import streamlit as st
+from streamlit import config as st_config
+from streamlit import logger as st_logger
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.testing.v1 import AppTest, app_test
+
+st_logger.set_log_level("error")
+
+app_script = os.path.join(repo_dir, "streamlit_app.py")
+default_sessions = 4
+default_iterations = 1
+default_timeout = 300
+rss_sample_interval = 0.2
+
+# Page and selector sequences of a typical visit to each page. Steps are
+# ("page", title), ("selectbox", key or label, option index),
+# ("checkbox", key or label, value) and ("radio", key or label, option index);
+# each step is one rerun.
+scenarios = {
+    "small_holder": [
+        ("page", "small holder"),
+        ("selectbox", "30", 0),
+        ("selectbox", "31", 0),
+        ("checkbox", "43", False),
+        ("checkbox", "41", False),
+        ("radio", "42", 1),
+    ],
+    "foundation_farm": [
+        ("page", "foundation farm"),
+        ("selectbox", "Select Year", 1),
+        ("selectbox", "Select Season", 1),
+    ],
+    "hub_definition": [
+        ("page", "hub definition"),
+        ("selectbox", "Select Region", 1),
+        ("selectbox", "Select Hub", 1),
+    ],
+    "crop_health": [
+        ("page", "c&e"),
+        ("selectbox", "0", 0),
+        ("selectbox", "1", 0),
+        ("selectbox", "2", 0),
+    ],
+    "fca": [
+        ("page", "fca"),
+        ("selectbox", "fs_catchment_name", 0),
+        ("selectbox", "fs_metric", 0),
+    ],
+    "analysis": [
+        ("page", "analysis"),
+    ],
+}
+
+# Pages whose hot map states are prewarmed at startup (see streamlit_app.py)
+prewarmed_scenarios = ["small_holder", "foundation_farm", "hub_definition"]
+
+# File reads are counted in the session of the script that makes them;
+# reads from background tasks (outside any session) are not counted
+load_functions = [(gpd, "read_file"), (gpd, "read_parquet"), (pd, "read_csv"), (pd, "read_parquet")]
+
+def count_data_loads(load_function):
+    def counted_load_function(*args, **kwargs):
+        if get_script_run_ctx(suppress_warning=True) is not None:
+            st.session_state["load_test_data_loads"] = st.session_state.get("load_test_data_loads", 0) + 1
+        return load_function(*args, **kwargs)
+    return counted_load_function
+
+def instrument_data_loads():
+    for module, function_name in load_functions:
+        setattr(module, function_name, count_data_loads(getattr(module, function_name)))
+
+class SessionRuntime(Runtime):
+    """The Runtime class as AppTest sees it.
+
+    Each AppTest run installs a runtime of its own and removes it when it
+    ends, pulling it out from under the runs of the other sessions; here they
+    set and clear this class's instance instead of the shared one.
+    """
+
+def install_shared_runtime():
+    """One runtime for all the sessions, as in a server process."""
+    shared_runtime = MagicMock(spec=Runtime)
+    shared_runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared_runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = shared_runtime
+    app_test.Runtime = SessionRuntime
+    # AppTest sets this option for the length of each run only; setting an
+    # option resets the log level
+    st_config.set_option("global.appTest", True)
+    st_logger.set_log_level("error")
+
+def get_rss_mb():
+    """Current resident set size of the process."""
+    with open("/proc/self/statm") as statm:
+        resident_pages = int(statm.read().split()[1])
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+class RssSampler(threading.Thread):
+    """Peak RSS while the sessions run, sampled in the background."""
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.peak_mb = get_rss_mb()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(rss_sample_interval):
+            self.peak_mb = max(self.peak_mb, get_rss_mb())
+
+def get_widget(at, widget_type, widget_id):
+    """A widget of the current page by key, or else by label."""
+    widgets = list(getattr(at, widget_type))
+    for widget in widgets:
+        if widget.key == widget_id:
+            return widget
+    for widget in widgets:
+        if widget.label == widget_id:
+            return widget
+    raise LookupError(f"No {widget_type} {widget_id!r} on the page")
+
+def apply_step(at, step):
+    step_type, widget_id, *value = step
+    if step_type == "page":
+        at.query_params["page"] = widget_id
+        return
+
+    widget = get_widget(at, step_type, widget_id)
+    if step_type == "checkbox":
+        widget.set_value(value[0])
+        return
+
+    options = widget.options
+    if not options:
+        raise LookupError(f"{step_type} {widget_id!r} has no options")
+    option_index = min(value[0], len(options) - 1)
+    if step_type == "selectbox":
+        widget.select_index(option_index)
+    else:
+        widget.set_value(options[option_index])
+
+def run_session(session_index, scenario_names, iterations, timeout, reruns, session_reports):
+    """One user: a new AppTest session going through the scenarios in a random order."""
+    session_random = random.Random(session_index)
+    at = AppTest.from_file(app_script, default_timeout=timeout)
+    session_report = {'session': session_index, 'reruns': 0, 'exceptions': []}
+    visits = [
+        (iteration, scenario_name)
+        for iteration in range(iterations)
+        for scenario_name in session_random.sample(scenario_names, len(scenario_names))
+    ]
+
+    timed_out = False
+    for iteration, scenario_name in visits:
+        if timed_out:
+            break
+        for step in scenarios[scenario_name]:
+            try:
+                apply_step(at, step)
+            except LookupError as e:
+                session_report['exceptions'].append(f"{scenario_name}: {e}")
+                continue
+
+            start_counter = time.perf_counter()
+            try:
+                at.run()
+            except RuntimeError as e:
+                # A timed out rerun leaves the session unusable; stop it here
+                session_report['exceptions'].append(f"{scenario_name}: {e}")
+                timed_out = True
+                break
+            latency_ms = (time.perf_counter() - start_counter) * 1000
+
+            reruns.append({
+                'session': session_index, 'iteration': iteration, 'scenario': scenario_name,
+                'step': " ".join(str(part) for part in step), 'latency_ms': round(latency_ms, 2),
+            })
+            session_report['reruns'] += 1
+            session_report['exceptions'] += [f"{scenario_name}: {e.message}" for e in at.exception]
+
+    session_state = at.session_state
+    session_report['data_loads'] = session_state["load_test_data_loads"] if "load_test_data_loads" in session_state else 0
+    session_report['ee_calls'] = list(session_state["ee_call_records"]) if "ee_call_records" in session_state else []
+    session_reports.append(session_report)
+
+def record_map_cache_keys(map_cache_keys):
+    """Collect the map cache keys of the prewarm and of the sessions into `map_cache_keys`."""
+    from apps import map_cache_functions
+    get_map_cache_key = map_cache_functions.get_map_cache_key
+
+    def recorded_get_map_cache_key(page, filters, basemap, source_paths):
+        cache_key = get_map_cache_key(page, filters, basemap, source_paths)
+        source = "prewarm" if threading.current_thread().name.startswith("map_prewarm") else "session"
+        map_cache_keys[source].add((page, cache_key))
+        return cache_key
+    map_cache_functions.get_map_cache_key = recorded_get_map_cache_key
+
+def check_prewarmed_maps(timeout):
+    """Whether a session opening the prewarmed pages with their default selections gets prewarmed maps."""
+    map_cache_keys = collections.defaultdict(set)
+    record_map_cache_keys(map_cache_keys)
+
+    at = AppTest.from_file(app_script, default_timeout=timeout)
+    for scenario_name in prewarmed_scenarios:
+        apply_step(at, scenarios[scenario_name][0])
+        at.run()
+        for e in at.exception:
+            print(f"{scenario_name}: {e.message}")
+
+    # The prewarm renders in one background thread, which ends when it is done
+    while any(thread.name.startswith("map_prewarm") for thread in threading.enumerate()):
+        time.sleep(1)
+
+    if not map_cache_keys["prewarm"]:
+        print("No map was prewarmed (is MAP_CACHE_PREWARM=0?)")
+        return False
+    missed_keys = map_cache_keys["session"] - map_cache_keys["prewarm"]
+    for page, cache_key in sorted(missed_keys):
+        print(f"{page}: the map of the default selections ({cache_key}) is not prewarmed")
+    print(f"{len(map_cache_keys['session']) - len(missed_keys)} of {len(map_cache_keys['session'])} default maps were prewarmed")
+    return not missed_keys
+
+def get_latency_stats(latencies_ms):
+    if not latencies_ms:
+        return {'reruns': 0}
+    quantiles = statistics.quantiles(latencies_ms, n=100, method="inclusive") if len(latencies_ms) > 1 else latencies_ms * 99
+    return {
+        'reruns': len(latencies_ms),
+        'p50_ms': round(quantiles[49], 1),
+        'p90_ms': round(quantiles[89], 1),
+        'p95_ms': round(quantiles[94], 1),
+        'p99_ms': round(quantiles[98], 1),
+        'max_ms': round(max(latencies_ms), 1),
+    }
+
+def get_session_summary(session_report):
+    ee_calls = session_report.pop('ee_calls')
+    return {
+        **session_report,
+        'ee_calls': len(ee_calls),
+        'ee_cache_misses': sum(call_record['cache'] == "miss" for call_record in ee_calls),
+        'ee_calls_by_kind': dict(collections.Counter(call_record['kind'] for call_record in ee_calls)),
+    }
+
+def run_load_test(sessions, iterations, scenario_names, timeout):
+    """Run the sessions concurrently and summarise their reruns, memory and calls."""
+    instrument_data_loads()
+    reruns, session_reports = [], []
+
+    rss_start_mb = get_rss_mb()
+    rss_sampler = RssSampler()
+    rss_sampler.start()
+
+    start_counter = time.perf_counter()
+    session_threads = [
+        threading.Thread(
+            target=run_session, name=f"session_{session_index}",
+            args=(session_index, scenario_names, iterations, timeout, reruns, session_reports),
+        )
+        for session_index in range(sessions)
+    ]
+    for session_thread in session_threads:
+        session_thread.start()
+    for session_thread in session_threads:
+        session_thread.join()
+    duration_s = time.perf_counter() - start_counter
+
+    rss_sampler.stopped.set()
+    rss_sampler.join()
+
+    session_summaries = sorted(
+        (get_session_summary(session_report) for session_report in session_reports),
+        key=lambda session_summary: session_summary['session']
+        )
+    reruns_by_scenario = collections.defaultdict(list)
+    for rerun in reruns:
+        reruns_by_scenario[rerun['scenario']].append(rerun['latency_ms'])
+
+    load_test_results = {
+        'duration_s': round(duration_s, 1),
+        'latency': get_latency_stats([rerun['latency_ms'] for rerun in reruns]),
+        'latency_by_scenario': {
+            scenario_name: get_latency_stats(latencies_ms) for scenario_name, latencies_ms in reruns_by_scenario.items()
+        },
+        'rss_start_mb': round(rss_start_mb, 1),
+        'rss_peak_mb': round(rss_sampler.peak_mb, 1),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'per_session': {
+            'data_loads': statistics.mean(summary['data_loads'] for summary in session_summaries),
+            'ee_calls': statistics.mean(summary['ee_calls'] for summary in session_summaries),
+            'ee_cache_misses': statistics.mean(summary['ee_cache_misses'] for summary in session_summaries),
+        },
+        'sessions': session_summaries,
+        'reruns': reruns,
+    }
+    return load_test_results
+
+def print_summary(load_test_results):
+    print(f"\n{'scenario':<18} {'reruns':>7} {'p50':>9} {'p90':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    latency_rows = list(load_test_results['latency_by_scenario'].items()) + [("all", load_test_results['latency'])]
+    for scenario_name, latency_stats in latency_rows:
+        if not latency_stats['reruns']:
+            continue
+        print(
+            f"{scenario_name:<18} {latency_stats['reruns']:>7} {latency_stats['p50_ms']:>9.0f} {latency_stats['p90_ms']:>9.0f} "
+            f"{latency_stats['p95_ms']:>9.0f} {latency_stats['p99_ms']:>9.0f} {latency_stats['max_ms']:>9.0f}"
+        )
+
+    print(f"\nRSS: {load_test_results['rss_start_mb']} MB at start, {load_test_results['rss_peak_mb']} MB peak")
+    print(f"\n{'session':<8} {'reruns':>7} {'data loads':>11} {'EE calls':>9} {'EE cache misses':>16} {'exceptions':>11}")
+    for session_summary in load_test_results['sessions']:
+        print(
+            f"{session_summary['session']:<8} {session_summary['reruns']:>7} {session_summary['data_loads']:>11} "
+            f"{session_summary['ee_calls']:>9} {session_summary['ee_cache_misses']:>16} {len(session_summary['exceptions']):>11}"
+        )
+        for exception in session_summary['exceptions'][:3]:
+            print(f"    {exception[:160]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app with concurrent headless sessions.")
+    parser.add_argument("--sessions", type=int, default=default_sessions)
+    parser.add_argument("--iterations", type=int, default=default_iterations, help="visits of every scenario per session")
+    parser.add_argument("--scenarios", nargs="+", choices=list(scenarios), default=list(scenarios))
+    parser.add_argument("--timeout", type=int, default=default_timeout, help="seconds allowed per rerun")
+    parser.add_argument("--ee-latency", type=float, help="seconds added to every Earth Engine round trip")
+    parser.add_argument("--cold-map-cache", action="store_true", help="remove the rendered maps cached by earlier runs")
+    parser.add_argument("--output", help="results file (default: data/cache/benchmarks/load_test_<time>.json)")
+    parser.add_argument(
+        "--check-prewarm", action="store_true",
+        help="only check that the default maps of the prewarmed pages are prewarmed, exiting with an error if not",
+        )
+    args = parser.parse_args()
+
+    if args.ee_latency is not None:
+        offline_ee.latencies.update(dict.fromkeys(offline_ee.latencies, args.ee_latency))
+
+    # The app reads its data relative to the repository
+    os.chdir(repo_dir)
+    if args.cold_map_cache:
+        from apps import map_cache_functions
+        map_cache_functions.clear_map_cache()
+    install_shared_runtime()
+    if args.check_prewarm:
+        sys.exit(0 if check_prewarmed_maps(args.timeout) else 1)
+
+    created = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    load_test_results = {
+        'created': created,
+        'sessions': args.sessions,
+        'iterations': args.iterations,
+        'scenarios': args.scenarios,
+        'cold_map_cache': args.cold_map_cache,
+        'ee_latencies': offline_ee.latencies,
+        'results': run_load_test(args.sessions, args.iterations, args.scenarios, args.timeout),
+    }
+    print_summary(load_test_results['results'])
+
+    output_path = args.output or os.path.join(repo_dir, "data", "cache", "benchmarks", f"load_test_{created}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as output_file:
+        json.dump(load_test_results, output_file, indent=2, default=str)
+    print(f"\nResults written to {output_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+import numpy as np
+import rasterio
+from rasterio.transform import Affine
+
+# Offline stand-in for the earthengine-api and geemap modules, so load tests
+# run without Earth Engine credentials or network access. Expressions are
+# built lazily as in the real client; getInfo, getMapId, computePixels and
+# getDownloadURL answer with plausible responses after a simulated latency.
+# Install it before any app module is imported: offline_ee.install()
+latencies = {
+    'getInfo': 0.3,
+    'getMapId': 0.2,
+    'computePixels': 0.5,
+    'getDownloadURL': 0.5,
+}
+
+# Sentinel-2 revisit; image dates fall on the same days for every query
+image_interval_days = 5
+offline_tile_url = "http://localhost/offline-ee/{z}/{x}/{y}.png"
+default_bounds = (22.0, -18.0, 33.7, -8.2)
+
+class EEException(Exception):
+    pass
+
+class TileFetcher:
+    def __init__(self, url_format, map_name=None):
+        self.url_format = url_format
+        self.map_name = map_name
+
+class OfflineType(type):
+    """Class-level calls (ee.Image.pixelArea(), ee.Reducer.sum(), ...) start a new expression."""
+    def __getattr__(cls, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: cls.from_call(cls(), name, args, kwargs)
+
+class ComputedObject(metaclass=OfflineType):
+    """A lazy expression: the chain of constructor and method calls that built it."""
+    # Methods returning another type; all others return the type they are called on
+    result_types = {'get': "ComputedObject"}
+
+    def __init__(self, *args, **kwargs):
+        source = args[0] if args and isinstance(args[0], ComputedObject) else None
+        if source is not None:
+            self.chain = source.chain + ((type(self).__name__, (), {}),)
+        else:
+            self.chain = ((type(self).__name__, args, kwargs),)
+        self._aoi_bounds = get_bounds(args, kwargs, source)
+        self.gdf = source.gdf if source is not None else None
+
+    @classmethod
+    def from_call(cls, parent, name, args, kwargs):
+        computed_object = cls.__new__(cls)
+        computed_object.chain = parent.chain + ((name, args, kwargs),)
+        computed_object._aoi_bounds = get_bounds(args, kwargs, parent)
+        computed_object.gdf = parent.gdf
+        return computed_object
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def method(*args, **kwargs):
+            result_type = offline_types[self.result_types.get(name, type(self).__name__)]
+            return result_type.from_call(self, name, args, kwargs)
+        return method
+
+    def __repr__(self):
+        return self.serialize()
+
+    def serialize(self):
+        return "".join(f".{name}({args!r},{kwargs!r})" for name, args, kwargs in self.chain)
+
+    def getInfo(self):
+        time.sleep(latencies['getInfo'])
+        return get_info_response(self)
+
+    def getMapId(self, visparams=None):
+        time.sleep(latencies['getMapId'])
+        map_name = str(abs(hash(self.serialize())))
+        return {'mapid': map_name, 'token': "", 'tile_fetcher': TileFetcher(offline_tile_url, map_name)}
+
+    def getDownloadURL(self, params):
+        time.sleep(latencies['getDownloadURL'])
+        return write_download_raster(params)
+
+class Number(ComputedObject):
+    pass
+
+class String(ComputedObject):
+    pass
+
+class Date(ComputedObject):
+    result_types = {'format': "String"}
+
+class List(ComputedObject):
+    result_types = {'contains': "ComputedObject"}
+
+class Dictionary(ComputedObject):
+    pass
+
+class Filter(ComputedObject):
+    pass
+
+class Reducer(ComputedObject):
+    pass
+
+class Algorithms(ComputedObject):
+    pass
+
+class Geometry(ComputedObject):
+    pass
+
+class Feature(ComputedObject):
+    pass
+
+class FeatureCollection(ComputedObject):
+    result_types = {'geometry': "Geometry", 'first': "Feature", 'size': "Number", 'get': "ComputedObject"}
+
+class Image(ComputedObject):
+    result_types = {
+        'reduceRegion': "Dictionary", 'reduceRegions': "FeatureCollection", 'get': "ComputedObject",
+        'propertyNames': "List", 'date': "Date", 'geometry': "Geometry",
+    }
+
+class ImageCollection(ComputedObject):
+    result_types = {
+        'first': "Image", 'mosaic': "Image", 'median': "Image", 'mean': "Image", 'sum': "Image",
+        'qualityMosaic': "Image", 'size': "Number", 'toList': "List", 'get': "ComputedObject",
+    }
+
+offline_types = {
+    offline_type.__name__: offline_type
+    for offline_type in [
+        ComputedObject, Number, String, Date, List, Dictionary, Filter, Reducer, Algorithms,
+        Geometry, Feature, FeatureCollection, Image, ImageCollection,
+    ]
+}
+
+def get_bounds(args, kwargs, source=None):
+    """Bounds of the first AOI an expression was built from, if any."""
+    if source is not None and source._aoi_bounds is not None:
+        return source._aoi_bounds
+    for arg in list(args) + list(kwargs.values()):
+        if isinstance(arg, ComputedObject) and arg._aoi_bounds is not None:
+            return arg._aoi_bounds
+    return None
+
+def iter_calls(computed_object):
+    """Calls of an expression from the last one back, including those of its arguments."""
+    for name, args, kwargs in reversed(computed_object.chain):
+        yield name, args, kwargs
+        for arg in list(args) + list(kwargs.values()):
+            if isinstance(arg, ComputedObject):
+                yield from iter_calls(arg)
+
+def get_call_args(computed_object, name):
+    """Arguments of the last call of `name` in an expression, or None."""
+    for call_name, args, kwargs in iter_calls(computed_object):
+        if call_name == name:
+            return args, kwargs
+    return None
+
+def get_image_dates(computed_object):
+    """Dates of the images an expression's collection holds: every few days within its filterDate."""
+    date_args = get_call_args(computed_object, "filterDate")
+    if date_args is None:
+        return []
+
+    start_date, end_date = (datetime.date.fromisoformat(str(date)[:10]) for date in date_args[0][:2])
+    first_ordinal = -(-start_date.toordinal() // image_interval_days) * image_interval_days
+    return [
+        datetime.date.fromordinal(ordinal)
+        for ordinal in range(first_ordinal, end_date.toordinal(), image_interval_days)
+    ]
+
+def get_timestamp(image_date):
+    acquisition_time = datetime.datetime(
+        image_date.year, image_date.month, image_date.day, 8, 30, tzinfo=datetime.timezone.utc
+        )
+    return int(acquisition_time.timestamp() * 1000)
+
+def get_info_response(computed_object):
+    last_call = computed_object.chain[-1][0]
+    image_dates = get_image_dates(computed_object)
+
+    if last_call == "size":
+        return len(image_dates)
+    if last_call == "image_value_list":
+        return list(range(1, 13))
+    if isinstance(computed_object, Number):
+        return 25.0
+    if isinstance(computed_object, String):
+        return image_dates[0].strftime("%d %B %Y") if image_dates else "Imagery date unavailable"
+    if isinstance(computed_object, ImageCollection):
+        return {
+            'type': "ImageCollection",
+            'features': [
+                {'type': "Image", 'properties': {'system:time_start': get_timestamp(image_date)}}
+                for image_date in image_dates
+            ],
+        }
+    if isinstance(computed_object, Image):
+        properties = {'system:time_start': get_timestamp(image_dates[0])} if image_dates else {}
+        return {'type': "Image", 'bands': [], 'properties': properties}
+    if isinstance(computed_object, FeatureCollection):
+        if last_call == "reduceRegions":
+            return get_reduce_regions_response(computed_object)
+        if computed_object.gdf is not None:
+            return json.loads(computed_object.gdf.to_json(drop_id=True))
+        return {'type': "FeatureCollection", 'features': []}
+    if last_call == "get" and computed_object.chain[-1][1] == ("groups",):
+        # Grouped pixel areas (m2) per class
+        return [{'class': class_value, 'sum': 1e8 / class_value} for class_value in range(1, 13)]
+    if isinstance(computed_object, Dictionary):
+        return {}
+    return None
+
+def get_reduce_regions_response(computed_object):
+    """Constant statistics for every zone of a reduceRegions call."""
+    _, kwargs = get_call_args(computed_object, "reduceRegions")
+    zones = kwargs.get('collection')
+    zones_gdf = zones.gdf if zones is not None else None
+    if zones_gdf is None:
+        return {'type': "FeatureCollection", 'features': []}
+
+    stats = {'mean': 50.0, 'min': 10.0, 'max': 90.0, 'mode': 1, 'p10': 20.0, 'p50': 50.0, 'p90': 80.0}
+    features = [
+        {'type': "Feature", 'properties': {**properties, **stats}}
+        for properties in zones_gdf.drop(columns="geometry").to_dict(orient="records")
+    ]
+    return {'type': "FeatureCollection", 'features': features}
+
+def write_download_raster(params):
+    """Write a constant GeoTIFF on the requested grid and return its file URL."""
+    region = params.get('region')
+    minx, miny, maxx, maxy = region._aoi_bounds if isinstance(region, ComputedObject) and region._aoi_bounds else default_bounds
+    scale_x, _, origin_x, _, scale_y, origin_y = params['crs_transform']
+
+    col_start, col_stop = int((minx - origin_x) // scale_x), int(-(-(maxx - origin_x) // scale_x))
+    row_start, row_stop = int((maxy - origin_y) // scale_y), int(-(-(miny - origin_y) // scale_y))
+    width, height = col_stop - col_start, row_stop - row_start
+    transform = Affine(scale_x, 0, origin_x + col_start * scale_x, 0, scale_y, origin_y + row_start * scale_y)
+
+    raster_file, raster_path = tempfile.mkstemp(prefix="offline_ee_", suffix=".tif")
+    os.close(raster_file)
+    with rasterio.open(
+        raster_path, 'w', driver='GTiff', width=width, height=height, count=1,
+        dtype='float32', crs=params.get('crs', 'EPSG:4326'), transform=transform
+    ) as dst:
+        dst.write(np.full((height, width), 800, dtype='float32'), 1)
+    return f"file://{raster_path}"
+
+def compute_pixels(request):
+    time.sleep(latencies['computePixels'])
+    dimensions = request['grid']['dimensions']
+    pixels = np.zeros((dimensions['height'], dimensions['width']), dtype=[('value', 'f4')])
+    pixels['value'] = 1
+    return pixels
+
+def gdf_to_ee(gdf, *args, **kwargs):
+    feature_collection = FeatureCollection(f"gdf:{len(gdf)}:{tuple(np.round(gdf.total_bounds, 6))}")
+    feature_collection._aoi_bounds = tuple(gdf.total_bounds)
+    feature_collection.gdf = gdf
+    return feature_collection
+
+def image_value_list(image, *args, **kwargs):
+    return List.from_call(image, "image_value_list", args, kwargs)
+
+def ee_initialize(*args, **kwargs):
+    return None
+
+def get_ee_module():
+    ee_module = types.ModuleType("ee")
+    ee_module.__dict__.update(offline_types)
+    ee_module.EEException = EEException
+    ee_module.Initialize = ee_initialize
+    ee_module.Authenticate = ee_initialize
+    ee_module.data = types.SimpleNamespace(
+        computePixels=compute_pixels, TileFetcher=TileFetcher, getAlgorithms=dict, initialize=ee_initialize,
+        )
+    ee_module.oauth = types.SimpleNamespace(SCOPES=[])
+    return ee_module
+
+def get_geemap_modules():
+    # Maps are leafmap's folium maps, which have the same methods the pages use
+    import leafmap.foliumap as leafmap
+
+    foliumap_module = types.ModuleType("geemap.foliumap")
+    foliumap_module.Map = type("Map", (leafmap.Map,), {})
+    foliumap_module.ee_initialize = ee_initialize
+
+    geemap_module = types.ModuleType("geemap")
+    geemap_module.__path__ = []
+    geemap_module.foliumap = foliumap_module
+    geemap_module.Map = foliumap_module.Map
+    geemap_module.ee_initialize = ee_initialize
+    geemap_module.gdf_to_ee = gdf_to_ee
+    geemap_module.image_value_list = image_value_list
+    return geemap_module, foliumap_module
+
+def install():
+    """Replace ee and geemap with the offline stand-ins for this process."""
+    if any(module_name in sys.modules for module_name in ("apps.ee_client", "apps.access")):
+        raise RuntimeError("offline_ee.install() must run before the app modules are imported")
+
+    ee_module = get_ee_module()
+    geemap_module, foliumap_module = get_geemap_modules()
+    sys.modules.update({
+        'ee': ee_module,
+        'ee.oauth': ee_module.oauth,
+        'geemap': geemap_module,
+        'geemap.foliumap': foliumap_module,
+    })
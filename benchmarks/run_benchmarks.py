@@ -0,0 +1,425 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# Benchmarks of the hot functions of the Small Holder, FCA, Hub Definition and
+# Foundation Farm pages on synthetic data at several scales:
+#   python -m benchmarks.run_benchmarks --scales 10000 100000 1000000
+# Results are written as JSON for comparison across commits (--compare), and
+# rendered maps are checked against the map payload budget (--check-budget).
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import duckdb
+import folium
+import geopandas as gpd
+import pandas as pd
+import shapely
+import streamlit as st
+from streamlit import logger as st_logger
+
+# Caches and page config warn on every call outside a running app
+st_logger.set_log_level("error")
+
+from apps import variables, query_functions, hex_functions, kepler_functions, sh_functions, map_functions, map_cache_functions, trace_functions, sh_app, hb_app, ff_app, fs_app
+from benchmarks import synthetic_data
+
+default_scales = [10000, 100000, 1000000]
+default_repeat = 3
+benchmarks_dir = os.path.join(repo_dir, "data", "cache", "benchmarks")
+
+# Maps with one folium marker per field take about a second per thousand
+# fields; larger maps are recorded as skipped unless the limit is raised
+default_max_map_fields = 25000
+
+def get_commit():
+    """Short hash of HEAD and whether the tree has uncommitted changes."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True
+            ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir, capture_output=True, text=True, check=True
+            ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+def get_environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'packages': {
+            'pandas': pd.__version__, 'geopandas': gpd.__version__, 'shapely': shapely.__version__,
+            'folium': folium.__version__, 'streamlit': st.__version__, 'duckdb': duckdb.__version__,
+        },
+    }
+
+def clear_caches():
+    """Drop cached data and rendered maps, for cold cache steps."""
+    st.cache_data.clear()
+    map_cache_functions.clear_map_cache()
+
+def measure(results, scale, page, kind, step, func, repeat, setup=None):
+    """Time `func` `repeat` times, calling `setup` before each run, and record the result.
+
+    Map steps return the rendered map and its payload (map_functions.render_map),
+    recorded by layer kind and checked against the map payload budget.
+    Returns the last result so later steps can use it.
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start_counter = time.perf_counter()
+        result = func()
+        durations.append((time.perf_counter() - start_counter) * 1000)
+
+    result_record = {
+        'scale': scale,
+        'page': page,
+        'kind': kind,
+        'step': step,
+        'runs': repeat,
+        'min_ms': round(min(durations), 2),
+        'median_ms': round(statistics.median(durations), 2),
+        'bytes': trace_functions.get_payload_size(result, deep=True),
+        'rows': len(result) if isinstance(result, pd.DataFrame) else None,
+    }
+    if kind == "map_html":
+        _, payload = result
+        result_record['bytes'] = payload['total']
+        result_record['payload'] = payload
+        result_record['within_budget'] = payload['total'] <= map_functions.map_payload_budget_kb * 1024
+    results.append(result_record)
+    print(f"{scale:>9} {page:<16} {kind:<10} {step:<62} {result_record['median_ms']:>10.1f} ms")
+    return result
+
+def remove_cached_file(cache_path):
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+
+def skip(results, scale, page, kind, step, reason):
+    results.append({'scale': scale, 'page': page, 'kind': kind, 'step': step, 'skipped': reason})
+    print(f"{scale:>9} {page:<16} {kind:<10} {step:<62} skipped ({reason})")
+
+def benchmark_small_holder(results, scale, repeat, max_map_fields):
+    page = "small_holder"
+    fields_path = query_functions.query_layers['fields']
+    measure(
+        results, scale, page, "load", "query_functions.get_parquet_layer (write)",
+        lambda: query_functions.get_parquet_layer(fields_path), repeat,
+        setup=lambda: remove_cached_file(query_functions.get_parquet_path(fields_path))
+        )
+    measure(
+        results, scale, page, "load", "hex_functions.update_hex_index (all fields)",
+        hex_functions.update_hex_index, repeat,
+        setup=lambda: remove_cached_file(hex_functions.get_hex_index_path())
+        )
+
+    gdf = query_functions.get_fields_gdf({})
+    selected_region = gdf['region'].mode()[0]
+    selected_district = gdf[gdf['region'] == selected_region]['district'].mode()[0]
+    no_filters = dict.fromkeys(query_functions.field_filter_columns)
+    district_filters = {**no_filters, 'selected_region': selected_region, 'selected_district': selected_district}
+
+    measure(
+        results, scale, page, "filter", "query_functions.get_field_options (districts of region)",
+        lambda: query_functions.get_field_options('district', {'selected_region': selected_region}), repeat
+        )
+    measure(
+        results, scale, page, "filter", "query_functions.get_fields_gdf (no filter)",
+        lambda: query_functions.get_fields_gdf(no_filters), repeat
+        )
+    district_gdf = measure(
+        results, scale, page, "filter", "query_functions.get_fields_gdf (region, district)",
+        lambda: query_functions.get_fields_gdf(district_filters), repeat
+        )
+
+    region_colors = measure(
+        results, scale, page, "aggregate", "sh_functions.get_colors (Region)",
+        lambda: sh_functions.get_colors("Region", no_filters), repeat
+        )
+    measure(
+        results, scale, page, "aggregate", "sh_functions.get_colors (District)",
+        lambda: sh_functions.get_colors("District", no_filters), repeat
+        )
+    measure(
+        results, scale, page, "aggregate", "query_functions.get_field_metrics (no filter)",
+        lambda: query_functions.get_field_metrics(no_filters), repeat
+        )
+    measure(
+        results, scale, page, "aggregate", "sh_functions.get_chart_df (Region, Field)",
+        lambda: sh_functions.get_chart_df(no_filters, "Region", None, "Field"), repeat
+        )
+    measure(
+        results, scale, page, "aggregate", "sh_functions.get_chart_df (Region, District, Field)",
+        lambda: sh_functions.get_chart_df(no_filters, "Region", "District", "Field"), repeat
+        )
+
+    map_cases = [
+        ("district, clustered", district_gdf, True, None, "None"),
+        ("all fields, clustered", gdf, True, None, "None"),
+        ("all fields, coloured by region", gdf, False, region_colors, "Region"),
+    ]
+    for label, map_gdf, view_cluster, gotten_colors, selected_color_by in map_cases:
+        step = f"sh_functions.get_fields_map ({label})"
+        if len(map_gdf) > max_map_fields:
+            skip(results, scale, page, "map_html", step, f"{len(map_gdf)} fields > --max-map-fields")
+            continue
+        measure(
+            results, scale, page, "map_html", step,
+            lambda: map_functions.render_map(sh_functions.get_fields_map(
+                map_gdf, view_cluster, gotten_colors, selected_color_by, sh_app.rename_color_by
+                )),
+            repeat
+            )
+
+    for label, hex_filters in [("all fields", no_filters), ("district", district_filters)]:
+        measure(
+            results, scale, page, "map_html", f"sh_functions.get_fields_hex_map ({label})",
+            lambda: map_functions.render_map(sh_functions.get_fields_hex_map(hex_filters)), repeat
+            )
+
+    # WebGL maps send the fields as Arrow rather than rendered HTML, so they have no field limit
+    for label, webgl_filters in [("all fields", no_filters), ("district", district_filters)]:
+        measure(
+            results, scale, page, "webgl", f"sh_functions.get_fields_kepler_map ({label}, coloured by region)",
+            lambda: kepler_functions.get_arrow_bytes(sh_functions.get_fields_kepler_map(
+                webgl_filters, region_colors, "Region", sh_app.rename_color_by
+                )[0]['fields']),
+            repeat
+            )
+
+def benchmark_fca(results, scale, repeat, max_map_fields):
+    # Only the vector side of the page; Earth Engine layers are not part of the benchmark
+    page = "fca"
+    fs_gdf = measure(results, scale, page, "load", "fs_app._load_fs_catchments", fs_app._load_fs_catchments, repeat)
+    busiest_fs = query_functions.run_query(
+        "SELECT fs FROM fields WHERE fs IS NOT NULL GROUP BY fs ORDER BY count(*) DESC, fs LIMIT 1", layer_names=['fields']
+        )['fs'][0]
+
+    selected_fs_gdf = fs_gdf[fs_gdf["FS"] == busiest_fs]
+    sh_in_catchment = measure(
+        results, scale, page, "filter", "query_functions.get_fields_within (busiest catchment)",
+        lambda: query_functions.get_fields_within(selected_fs_gdf.union_all()),
+        repeat
+        )
+
+    def get_fs_map_html():
+        m = folium.Map(control_scale=True)
+        map_functions.add_gdf_layer(
+            m, selected_fs_gdf, "FS Catchment", style=fs_app.fs_catchment_style,
+            tooltip_fields=[fs_app.FS_NAME_COL], display_level="Catchment",
+        )
+        fs_app._add_smallholder_circle_layer(m, sh_in_catchment)
+        return map_functions.render_map(m)
+
+    step = "catchment and fields map (cold cache)"
+    if len(sh_in_catchment) > max_map_fields:
+        skip(results, scale, page, "map_html", step, f"{len(sh_in_catchment)} fields > --max-map-fields")
+    else:
+        measure(
+            results, scale, page, "map_html", step, get_fs_map_html, repeat,
+            setup=clear_caches
+            )
+
+def benchmark_hub_definition(results, scale, repeat):
+    page = "hub_definition"
+    catchments = measure(
+        results, scale, page, "load", "variables.get_fs_catchment_boundaries",
+        variables.get_fs_catchment_boundaries, repeat
+        )
+    measure(results, scale, page, "load", "variables.get_pea_locations", variables.get_pea_locations, repeat)
+    measure(results, scale, page, "load", "variables.get_zambia_boundaries", variables.get_zambia_boundaries, repeat)
+
+    measure(
+        results, scale, page, "aggregate", "map_functions.get_compact_geojson (catchments)",
+        lambda: map_functions.get_compact_geojson(
+            map_functions.get_layer_gdf(catchments, ["Name", "Hub Name", "FE Region", "FS", "RM"]), "Catchment"
+        ),
+        repeat, setup=clear_caches
+        )
+
+    selected_region = catchments["FE Region"].mode()[0]
+    measure(
+        results, scale, page, "map_html", "hb_app.get_hub_map_html (all, cold cache)",
+        lambda: hb_app.get_hub_map_html("All", "All", "All"),
+        repeat, setup=clear_caches
+        )
+    measure(
+        results, scale, page, "map_html", "hb_app.get_hub_map_html (region, cold cache)",
+        lambda: hb_app.get_hub_map_html(selected_region, "All", "All"),
+        repeat, setup=clear_caches
+        )
+    measure(
+        results, scale, page, "map_html", "hb_app.get_hub_map_html (region, cached)",
+        lambda: hb_app.get_hub_map_html(selected_region, "All", "All"),
+        repeat
+        )
+
+def benchmark_foundation_farm(results, scale, repeat):
+    page = "foundation_farm"
+    measure(
+        results, scale, page, "load", "variables.get_planting_history (cold cache)",
+        variables.get_planting_history, repeat, setup=clear_caches
+        )
+    gardens = measure(results, scale, page, "load", "variables.get_Crop_blocks", variables.get_Crop_blocks, repeat)
+
+    history = variables.get_filtered_planting_history()
+    selected_year = history["year"].max()
+    selected_season = history["season"].iloc[0]
+    measure(
+        results, scale, page, "filter", "variables.get_filtered_planting_history (year)",
+        lambda: variables.get_filtered_planting_history(selected_year), repeat
+        )
+    filtered_history = measure(
+        results, scale, page, "filter", "variables.get_filtered_planting_history (year, season, rotation)",
+        lambda: variables.get_filtered_planting_history(selected_year, selected_season, 1), repeat
+        )
+
+    # As prepared by ff_app.get_farm_map_html
+    gardens = gardens.rename(columns={"Block_Name": "Block_name"})
+    gardens["Block_name"] = gardens["Block_name"].str.strip().str.lower()
+    measure(
+        results, scale, page, "aggregate", "ff_app.get_gardens_history",
+        lambda: ff_app.get_gardens_history(gardens, filtered_history), repeat
+        )
+
+    measure(
+        results, scale, page, "map_html", "ff_app.get_farm_map_html (all, cold cache)",
+        lambda: ff_app.get_farm_map_html("All", "All", "All"),
+        repeat, setup=clear_caches
+        )
+    measure(
+        results, scale, page, "map_html", "ff_app.get_farm_map_html (year, season, rotation, cold cache)",
+        lambda: ff_app.get_farm_map_html(selected_year, selected_season, 1),
+        repeat, setup=clear_caches
+        )
+
+def get_dataset_root(scale, regenerate=False):
+    """Directory holding the synthetic dataset of a scale, generated on first use."""
+    data_root = os.path.join(benchmarks_dir, f"fields_{scale}")
+    if regenerate or not os.path.exists(os.path.join(data_root, "planting_records.csv")):
+        print(f"Generating synthetic data for {scale} fields in {data_root}...")
+        layer_sizes = synthetic_data.write_synthetic_dataset(data_root, scale)
+        print(", ".join(f"{layer_name}: {size}" for layer_name, size in layer_sizes.items()))
+    return data_root
+
+def run_benchmarks(scales, pages, repeat, max_map_fields, regenerate=False):
+    results = []
+    for scale in scales:
+        data_root = get_dataset_root(scale, regenerate)
+
+        # The loaders read data/vector and planting_records.csv relative to the
+        # working directory; cached results of the previous scale are dropped
+        os.chdir(data_root)
+        clear_caches()
+        try:
+            if "small_holder" in pages:
+                benchmark_small_holder(results, scale, repeat, max_map_fields)
+            if "fca" in pages:
+                benchmark_fca(results, scale, repeat, max_map_fields)
+            if "hub_definition" in pages:
+                benchmark_hub_definition(results, scale, repeat)
+            if "foundation_farm" in pages:
+                benchmark_foundation_farm(results, scale, repeat)
+        finally:
+            os.chdir(repo_dir)
+
+    return results
+
+def compare_results(baseline, current):
+    """Print the change in median time of each step from a baseline run."""
+    baseline_medians = {
+        (record['scale'], record['page'], record['step']): record['median_ms']
+        for record in baseline['results'] if 'median_ms' in record
+    }
+    print(f"\nCompared with {baseline['commit']} ({baseline['created']}):")
+    for record in current['results']:
+        baseline_ms = baseline_medians.get((record['scale'], record['page'], record['step']))
+        if baseline_ms is None or 'median_ms' not in record:
+            continue
+        change = (record['median_ms'] - baseline_ms) / baseline_ms * 100 if baseline_ms else 0
+        print(
+            f"{record['scale']:>9} {record['page']:<16} {record['step']:<62} "
+            f"{baseline_ms:>10.1f} -> {record['median_ms']:>10.1f} ms ({change:+.0f}%)"
+            )
+
+def check_map_budgets(results):
+    """Print the maps over the payload budget; returns whether all maps fit."""
+    over_budget = [record for record in results if record.get('within_budget') is False]
+    if not over_budget:
+        print(f"\nAll maps are within the {map_functions.map_payload_budget_kb:.0f} KB payload budget")
+        return True
+
+    print(f"\nMaps over the {map_functions.map_payload_budget_kb:.0f} KB payload budget:")
+    for record in over_budget:
+        layer_sizes = ", ".join(
+            f"{layer_kind} {size / 1024:.0f} KB" for layer_kind, size in record['payload'].items()
+            if layer_kind != 'total' and size
+        )
+        print(f"{record['scale']:>9} {record['page']:<16} {record['step']:<62} {record['bytes'] / 1024:>8.0f} KB ({layer_sizes})")
+    return False
+
+def main():
+    pages = ["small_holder", "fca", "hub_definition", "foundation_farm"]
+
+    parser = argparse.ArgumentParser(description="Benchmark the app's pages on synthetic data.")
+    parser.add_argument("--scales", type=int, nargs="+", default=default_scales, help="number of fields")
+    parser.add_argument("--pages", nargs="+", choices=pages, default=pages)
+    parser.add_argument("--repeat", type=int, default=default_repeat)
+    parser.add_argument("--max-map-fields", type=int, default=default_max_map_fields)
+    parser.add_argument("--regenerate", action="store_true", help="rewrite the synthetic datasets")
+    parser.add_argument(
+        "--vector-loader", choices=["file", "arrow"], default=variables.vector_loader,
+        help="how layers are loaded (default: VECTOR_LOADER or file)"
+        )
+    parser.add_argument("--output", help="results file (default: data/cache/benchmarks/results_<time>_<commit>.json)")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    parser.add_argument(
+        "--map-budget-kb", type=float, default=map_functions.map_payload_budget_kb,
+        help="payload budget of a rendered map (default: MAP_PAYLOAD_BUDGET_KB or 2048)"
+        )
+    parser.add_argument("--check-budget", action="store_true", help="exit with an error if a map is over budget")
+    args = parser.parse_args()
+    map_functions.map_payload_budget_kb = args.map_budget_kb
+    variables.vector_loader = args.vector_loader
+
+    commit, dirty = get_commit()
+    created = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
+    benchmark_results = {
+        'commit': commit,
+        'dirty': dirty,
+        'created': created,
+        'environment': get_environment(),
+        'repeat': args.repeat,
+        'max_map_fields': args.max_map_fields,
+        'vector_loader': args.vector_loader,
+        'map_budget_kb': args.map_budget_kb,
+        'results': run_benchmarks(args.scales, args.pages, args.repeat, args.max_map_fields, args.regenerate),
+    }
+
+    output_path = args.output or os.path.join(benchmarks_dir, f"results_{created}_{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as output_file:
+        json.dump(benchmark_results, output_file, indent=2, default=str)
+    print(f"\nResults written to {output_path}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare_results(json.load(baseline_file), benchmark_results)
+
+    within_budget = check_map_budgets(benchmark_results['results'])
+    if args.check_budget and not within_budget:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from shapely.geometry import box
+
+# Synthetic layers shaped like the files in data/vector, scaled by the number
+# of smallholder fields. Ratios between levels follow today's data (about
+# 15k fields in 52 catchments, 356 PEAs and 21 Foundation Farm blocks).
+fields_per_camp = 60
+fields_per_hub = 300
+fields_per_fs = 250
+fields_per_pea = 40
+fields_per_block = 700
+fields_per_district = 400
+
+zambia_bounds = (22.0, -18.0, 33.7, -8.2)
+foundation_farm_bounds = (28.20, -15.30, 28.26, -15.25)
+
+# Region ids with a colour in sh_functions.get_colors
+region_ids = [1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 12, 13]
+crop_types = ["Apples", "Beans", "Cow Pea", "Groundnuts", "Maize", "Oranges", "Soy Bean", "Sunflower", "Sunhemp"]
+planting_years = range(2020, 2026)
+planting_seasons = ["rainy", "dry"]
+rotation_orders = [1, 2]
+
+def get_level_count(n_fields, fields_per_unit, minimum=1):
+    return max(minimum, n_fields // fields_per_unit)
+
+def get_zambia_boundaries():
+    # A box densified to roughly the vertex count of the real national boundary
+    zambia_polygon = shapely.segmentize(box(*zambia_bounds), 0.01)
+    return gpd.GeoDataFrame({'country': ["Zambia"]}, geometry=[zambia_polygon], crs="EPSG:4326")
+
+def get_hierarchy(n_fields, rng):
+    """Region, district, hub, FS and PEA tables with their parents and centres."""
+    n_districts = get_level_count(n_fields, fields_per_district, minimum=len(region_ids))
+    n_hubs = get_level_count(n_fields, fields_per_hub)
+    n_fs = get_level_count(n_fields, fields_per_fs)
+    n_peas = get_level_count(n_fields, fields_per_pea)
+    n_camps = get_level_count(n_fields, fields_per_camp)
+
+    minx, miny, maxx, maxy = zambia_bounds
+    districts = pd.DataFrame({
+        'district_id': np.arange(1, n_districts + 1),
+        'region_id': np.resize(region_ids, n_districts),
+    })
+    districts['district'] = "District " + districts['district_id'].astype(str)
+    districts['region'] = "Region " + districts['region_id'].astype(str)
+
+    hubs = pd.DataFrame({
+        'hub_id': [f"x{hub:08x}" for hub in rng.integers(0, 2 ** 32, n_hubs)],
+        'hub': [f"Hub {hub}" for hub in range(1, n_hubs + 1)],
+        'district_index': rng.integers(0, n_districts, n_hubs),
+        'lon': rng.uniform(minx + 0.5, maxx - 0.5, n_hubs),
+        'lat': rng.uniform(miny + 0.5, maxy - 0.5, n_hubs),
+    })
+
+    fs = pd.DataFrame({
+        'fs_id': np.arange(1, n_fs + 1, dtype=float),
+        'fs': [f"FS {fs_id}" for fs_id in range(1, n_fs + 1)],
+        'rm': [f"RM {fs_id % 20 + 1}" for fs_id in range(1, n_fs + 1)],
+        'hub_index': np.resize(rng.permutation(n_hubs), n_fs),
+    })
+    fs['lon'] = hubs['lon'].to_numpy()[fs['hub_index']] + rng.normal(0, 0.1, n_fs)
+    fs['lat'] = hubs['lat'].to_numpy()[fs['hub_index']] + rng.normal(0, 0.1, n_fs)
+
+    peas = pd.DataFrame({
+        'pea_id': np.arange(1, n_peas + 1, dtype=float),
+        'pea': [f"PEA {pea_id}" for pea_id in range(1, n_peas + 1)],
+        'fs_index': np.resize(rng.permutation(n_fs), n_peas),
+    })
+
+    camps = pd.DataFrame({
+        'camp_id': np.arange(1, n_camps + 1),
+        'camp': [f"Camp {camp_id}" for camp_id in range(1, n_camps + 1)],
+        'hub_index': np.resize(rng.permutation(n_hubs), n_camps),
+    })
+
+    return districts, hubs, fs, peas, camps
+
+def get_sh_farms(n_fields, hierarchy, rng):
+    """Points shaped like field_measure_farms.gpkg."""
+    districts, hubs, fs, peas, camps = hierarchy
+
+    pea_index = rng.integers(0, len(peas), n_fields)
+    fs_index = peas['fs_index'].to_numpy()[pea_index]
+    hub_index = fs['hub_index'].to_numpy()[fs_index]
+    district_index = hubs['district_index'].to_numpy()[hub_index]
+
+    # A camp of the field's hub, or any camp when the hub has none
+    camp_order = np.argsort(camps['hub_index'].to_numpy(), kind="stable")
+    hub_camp_counts = np.bincount(camps['hub_index'], minlength=len(hubs))
+    hub_camp_offsets = np.concatenate([[0], np.cumsum(hub_camp_counts)[:-1]])
+    field_camp_counts = hub_camp_counts[hub_index]
+    camp_position = hub_camp_offsets[hub_index] + (rng.random(n_fields) * field_camp_counts).astype(int)
+    camp_index = np.where(
+        field_camp_counts > 0,
+        camp_order[np.minimum(camp_position, len(camps) - 1)],
+        rng.integers(0, len(camps), n_fields),
+    )
+
+    fields = pd.DataFrame({
+        'farmer_id': rng.integers(1, max(2, n_fields // 2), n_fields).astype("int32"),
+        'field_id': np.arange(1, n_fields + 1, dtype="int32"),
+        'farmer': [f"Farmer {farmer}" for farmer in rng.integers(1, max(2, n_fields // 2), n_fields)],
+        'camp_id': camps['camp_id'].to_numpy()[camp_index].astype("int32"),
+        'camp': camps['camp'].to_numpy()[camp_index],
+        'pea_id': peas['pea_id'].to_numpy()[pea_index],
+        'pea': peas['pea'].to_numpy()[pea_index],
+        'hub_id': hubs['hub_id'].to_numpy()[hub_index],
+        'hub': hubs['hub'].to_numpy()[hub_index],
+        'fs_id': fs['fs_id'].to_numpy()[fs_index],
+        'fs': fs['fs'].to_numpy()[fs_index],
+        'district_id': districts['district_id'].to_numpy()[district_index].astype("int32"),
+        'district': districts['district'].to_numpy()[district_index],
+        'region_id': districts['region_id'].to_numpy()[district_index].astype("int32"),
+        'region': districts['region'].to_numpy()[district_index],
+        'created_at': pd.Timestamp("2025-01-01") + pd.to_timedelta(rng.integers(0, 365 * 86400, n_fields), unit="s"),
+    })
+
+    minx, miny, maxx, maxy = zambia_bounds
+    lon = np.clip(fs['lon'].to_numpy()[fs_index] + rng.normal(0, 0.08, n_fields), minx, maxx)
+    lat = np.clip(fs['lat'].to_numpy()[fs_index] + rng.normal(0, 0.08, n_fields), miny, maxy)
+
+    return gpd.GeoDataFrame(fields, geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326")
+
+def get_fs_catchment_boundaries(hierarchy):
+    """One catchment per FS, tiling the country like fs_catchment_boundaries.gpkg."""
+    districts, hubs, fs, peas, camps = hierarchy
+
+    # Voronoi cells of the FS centres share their borders, like real catchments
+    zambia_polygon = box(*zambia_bounds)
+    centres = shapely.points(fs['lon'].clip(zambia_bounds[0], zambia_bounds[2]), fs['lat'].clip(zambia_bounds[1], zambia_bounds[3]))
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(centres), extend_to=zambia_polygon))
+    cell_index = shapely.STRtree(cells).query(centres, predicate="within")
+    catchment_cells = np.empty(len(fs), dtype=object)
+    catchment_cells[cell_index[0]] = cells[cell_index[1]]
+
+    # Empty cells only happen for duplicate centres; give those a small square
+    missing = pd.isna(catchment_cells)
+    catchment_cells[missing] = shapely.buffer(centres[missing], 0.01, cap_style="square")
+
+    # Densify borders to real vertex counts; snapping to a grid keeps the points
+    # added on either side of a shared border identical
+    geometries = shapely.segmentize(shapely.intersection(catchment_cells, zambia_polygon), 0.05)
+    geometries = shapely.set_precision(geometries, 1e-6)
+    geometries = [shapely.MultiPolygon([geometry]) if geometry.geom_type == "Polygon" else geometry for geometry in geometries]
+
+    hub_index = fs['hub_index'].to_numpy()
+    district_index = hubs['district_index'].to_numpy()[hub_index]
+    catchments = pd.DataFrame({
+        'id': fs['fs_id'],
+        'Name': [f"Catchment {fs_id}" for fs_id in range(1, len(fs) + 1)],
+        'Hub Id': hubs['hub_id'].to_numpy()[hub_index],
+        'FE Region': districts['region'].to_numpy()[district_index],
+        'RM': fs['rm'],
+        'FS': fs['fs'],
+        'Hub Name': hubs['hub'].to_numpy()[hub_index],
+    })
+    return gpd.GeoDataFrame(catchments, geometry=geometries, crs="EPSG:4326")
+
+def get_pea_locations(hierarchy, rng):
+    districts, hubs, fs, peas, camps = hierarchy
+
+    fs_index = peas['fs_index'].to_numpy()
+    hub_index = fs['hub_index'].to_numpy()[fs_index]
+    lon = fs['lon'].to_numpy()[fs_index] + rng.normal(0, 0.05, len(peas))
+    lat = fs['lat'].to_numpy()[fs_index] + rng.normal(0, 0.05, len(peas))
+
+    pea_locations = pd.DataFrame({
+        'pea': peas['pea'],
+        'fs': fs['fs'].to_numpy()[fs_index],
+        'rm': fs['rm'].to_numpy()[fs_index],
+        'hub': hubs['hub'].to_numpy()[hub_index],
+        'region': districts['region'].to_numpy()[hubs['district_index'].to_numpy()[hub_index]],
+        'latitude': lat,
+        'longitude': lon,
+        'accuracy': 1.0,
+    })
+    return gpd.GeoDataFrame(pea_locations, geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326")
+
+def get_foundation_farm_layers(n_fields, rng):
+    """Farm boundary, buildings, crop blocks and their planting records."""
+    minx, miny, maxx, maxy = foundation_farm_bounds
+    facility = gpd.GeoDataFrame({'Name': ["Foundation Farm"]}, geometry=[box(*foundation_farm_bounds)], crs="EPSG:4326")
+    buildings = gpd.GeoDataFrame(
+        {'Name': ["Offices", "Reservoir"]},
+        geometry=[box(minx + 0.001, miny + 0.001, minx + 0.002, miny + 0.002),
+                  box(minx + 0.003, miny + 0.001, minx + 0.004, miny + 0.002)],
+        crs="EPSG:4326",
+    )
+
+    # Blocks on a square grid inside the farm
+    n_blocks = get_level_count(n_fields, fields_per_block, minimum=21)
+    grid_size = int(np.ceil(np.sqrt(n_blocks)))
+    block_width, block_height = (maxx - minx) / grid_size, (maxy - miny) / grid_size
+    blocks = [
+        box(minx + column * block_width, miny + row * block_height,
+            minx + (column + 0.9) * block_width, miny + (row + 0.9) * block_height)
+        for row in range(grid_size) for column in range(grid_size)
+    ][:n_blocks]
+    block_names = [f"Block {block}" for block in range(1, n_blocks + 1)]
+    crop_blocks = gpd.GeoDataFrame({
+        'Block_Name': block_names,
+        'Crop_class': rng.choice(crop_types, n_blocks),
+        'Crop_varie': None,
+        'Plant_date': pd.Timestamp("2024-09-06"),
+    }, geometry=[shapely.MultiPolygon([block]) for block in blocks], crs="EPSG:4326")
+
+    # One record per block, year, season and rotation, with the untidy spacing
+    # and casing of the real records
+    planting_records = pd.MultiIndex.from_product(
+        [block_names, planting_years, planting_seasons, rotation_orders],
+        names=["Name", "year", "season", "rotation_o"],
+    ).to_frame(index=False)
+    planting_records['Name'] = planting_records['Name'].str.lower() + " "
+    planting_records['season'] = planting_records['season'].str.title()
+    planting_records['crop_type'] = rng.choice(crop_types, len(planting_records))
+
+    return facility, buildings, crop_blocks, planting_records
+
+def write_synthetic_dataset(data_root, n_fields, seed=42):
+    """Write a synthetic dataset for `n_fields` fields under `data_root`.
+
+    Files use the same names and layout as the app's data, so the loaders in
+    apps.variables read them unchanged when run from `data_root`.
+    """
+    rng = np.random.default_rng(seed)
+    vector_dir = os.path.join(data_root, "data", "vector")
+    os.makedirs(vector_dir, exist_ok=True)
+
+    hierarchy = get_hierarchy(n_fields, rng)
+    facility, buildings, crop_blocks, planting_records = get_foundation_farm_layers(n_fields, rng)
+
+    layers = {
+        'field_measure_farms': get_sh_farms(n_fields, hierarchy, rng),
+        'fs_catchment_boundaries': get_fs_catchment_boundaries(hierarchy),
+        'Pea_locations': get_pea_locations(hierarchy, rng),
+        'zambia_aoi': get_zambia_boundaries(),
+        'Foundation_Farm_Boundary': facility,
+        'Buildings_2': buildings,
+        'Crop_Blocks': crop_blocks,
+    }
+    for layer_name, layer_gdf in layers.items():
+        layer_gdf.to_file(os.path.join(vector_dir, f"{layer_name}.gpkg"), driver="GPKG")
+
+    planting_records.to_csv(os.path.join(data_root, "planting_records.csv"), index=False)
+
+    return {layer_name: len(layer_gdf) for layer_name, layer_gdf in layers.items()} | {
+        'planting_records': len(planting_records)
+    }
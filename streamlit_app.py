@@ -1,6 +1,6 @@
 import streamlit as st
 from streamlit_option_menu import option_menu
-from apps import ce_app, access, sh_app, soil_app , ff_app, hb_app , fs_app
+from apps import ce_app, access, sh_app, soil_app , ff_app, hb_app , fs_app, trace_functions, ee_client, map_cache_functions
 
 access.ee_to_st()
 st.set_page_config(page_title="Streamlit Geospatial", layout="wide")
@@ -14,10 +14,22 @@ apps = [
     {"func": fs_app.app, "title": "FCA", "icon": ":seedling:"},
 ]
 
+# The most opened map states are rendered into the shared map cache in the
+# background when the process starts
+map_cache_functions.prewarm_map_cache({
+    "sh_app": (sh_app.get_hot_map_filters, sh_app.get_fields_map_html),
+    "ff_app": (ff_app.get_hot_map_filters, ff_app.get_farm_map_html),
+    "hb_app": (hb_app.get_hot_map_filters, hb_app.get_hub_map_html),
+})
+
 titles = [app["title"] for app in apps]
 titles_lower = [title.lower() for title in titles]
 icons = [app["icon"] for app in apps]
 
+# A page can be opened directly with ?page=<title>, e.g. ?page=small holder
+page_query = st.query_params.get("page", "").lower()
+default_index = titles_lower.index(page_query) if page_query in titles_lower else 0
+
 with st.sidebar:
     st.logo(r"data/images/logo_white_no_bg.png", size="large")
 
@@ -26,7 +38,7 @@ with st.sidebar:
         options=titles,
         icons=icons,
         menu_icon="globe-europe-africa",
-        # default_index=default_index,
+        default_index=default_index,
     )
 
     st.sidebar.title("Info")
@@ -37,7 +49,13 @@ with st.sidebar:
     """
     )
 
+# Spans recorded while the page runs are grouped under this rerun
+trace_functions.start_rerun(selected)
+
 for app in apps:
     if app["title"] == selected:
         app["func"]()
         break
+
+trace_functions.show_trace_panel()
+ee_client.show_ee_panel()